@@ -0,0 +1,88 @@
+"""
+Checks that the foreach implementation of Adafactor matches the per parameter loop
+and measures the time of an optimizer step for both.
+
+Usage:
+    python benchmarks/adafactor_step.py --device cuda --steps 100
+"""
+import argparse
+import copy
+import time
+import torch
+from pytorch_fob.optimizers.adafactor.optimizer import Adafactor
+
+
+def transformer_params(d_model: int, n_layers: int, vocab_size: int, device: str) -> list[torch.nn.Parameter]:
+    """parameter shapes of an encoder-decoder transformer similar to t5-small"""
+    shapes = [(vocab_size, d_model)]
+    for _ in range(n_layers):
+        shapes += [(d_model, d_model)] * 4 + [(d_model,)] + [(4 * d_model, d_model), (d_model, 4 * d_model), (d_model,)]
+    return [torch.nn.Parameter(torch.randn(s, device=device) * 0.02) for s in shapes]
+
+
+def optimizer(params: list[torch.nn.Parameter], foreach: bool) -> Adafactor:
+    matrices = [p for p in params if p.ndim > 1]
+    vectors = [p for p in params if p.ndim <= 1]
+    return Adafactor(
+        [{"params": matrices}, {"params": vectors, "weight_decay": 0.0}],
+        lr=1.e-3, beta1=0.9, weight_decay=0.01, relative_step=False, foreach=foreach
+    )
+
+
+def set_grads(params: list[torch.nn.Parameter], seed: int):
+    generator = torch.Generator(device=params[0].device)
+    generator.manual_seed(seed)
+    for p in params:
+        p.grad = torch.randn(p.shape, device=p.device, generator=generator)
+
+
+def check_equivalence(args: argparse.Namespace) -> float:
+    params = transformer_params(args.d_model, args.layers, args.vocab_size, args.device)
+    params_foreach = copy.deepcopy(params)
+    opt = optimizer(params, foreach=False)
+    opt_foreach = optimizer(params_foreach, foreach=True)
+    for step in range(args.check_steps):
+        set_grads(params, step)
+        set_grads(params_foreach, step)
+        opt.step()
+        opt_foreach.step()
+    max_diff = 0.0
+    for p, q in zip(params, params_foreach):
+        torch.testing.assert_close(q, p, rtol=1e-5, atol=1e-7)
+        max_diff = max(max_diff, (p - q).abs().max().item())
+    return max_diff
+
+
+def time_steps(args: argparse.Namespace, foreach: bool) -> float:
+    params = transformer_params(args.d_model, args.layers, args.vocab_size, args.device)
+    opt = optimizer(params, foreach=foreach)
+    set_grads(params, 0)
+    for _ in range(5):
+        opt.step()
+    if args.device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        opt.step()
+    if args.device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.steps
+
+
+def main(args: argparse.Namespace):
+    max_diff = check_equivalence(args)
+    print(f"foreach matches loop after {args.check_steps} steps (max abs diff {max_diff:.2e})")
+    loop = time_steps(args, foreach=False)
+    foreach = time_steps(args, foreach=True)
+    print(f"step time on {args.device}: loop {loop * 1000:.2f}ms, foreach {foreach * 1000:.2f}ms ({loop / foreach:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark for the Adafactor optimizer step")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--steps", type=int, default=100, help="number of timed optimizer steps")
+    parser.add_argument("--check_steps", type=int, default=20, help="number of steps compared against the loop")
+    parser.add_argument("--d_model", type=int, default=512)
+    parser.add_argument("--layers", type=int, default=12)
+    parser.add_argument("--vocab_size", type=int, default=32128)
+    main(parser.parse_args())
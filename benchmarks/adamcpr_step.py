@@ -0,0 +1,122 @@
+"""
+Checks that the batched CPR update of AdamCPRfast gives bit-for-bit the same parameters as the
+per tensor update of `_single_tensor_adam` and measures the time of an optimizer step for both.
+The parameters have the shapes of the GIN of the graph task, i.e. many small tensors.
+
+Usage:
+    python benchmarks/adamcpr_step.py --device cuda --steps 100
+"""
+import argparse
+import copy
+import time
+import torch
+from pytorch_fob.optimizers.adamcpr_fast.adam_cpr_fast import AdamCPRfast
+
+
+ATOM_FEATURE_DIMS = [119, 5, 12, 12, 10, 6, 6, 2, 2]
+BOND_FEATURE_DIMS = [5, 6, 2]
+
+
+def gin_params(hidden: int, n_layers: int, device: str) -> list[torch.nn.Parameter]:
+    """
+    parameter shapes of the GIN (without virtual node) of the graph task,
+    the last tensor is constant and gets zero gradients like an unused norm weight
+    """
+    shapes = [(d, hidden) for d in ATOM_FEATURE_DIMS]
+    for _ in range(n_layers):
+        shapes += [(d, hidden) for d in BOND_FEATURE_DIMS]
+        shapes += [(1,), (2 * hidden, hidden), (2 * hidden,), (2 * hidden,), (2 * hidden,)]
+        shapes += [(hidden, 2 * hidden), (hidden,), (hidden,), (hidden,)]
+    shapes += [(2, hidden), (2,)]
+    params = [torch.nn.Parameter(torch.randn(s, device=device) * 0.1) for s in shapes]
+    return params + [torch.nn.Parameter(torch.ones(hidden, device=device))]
+
+
+def optimizer(
+        params: list[torch.nn.Parameter],
+        args: argparse.Namespace,
+        batched_cpr: bool,
+        foreach: bool
+        ) -> AdamCPRfast:
+    return AdamCPRfast(
+        params,
+        lr=1.e-3,
+        weight_decay=1.0,
+        kappa_init_param=args.warm_start,
+        kappa_init_method="warm_start",
+        reg_function=args.reg_function,
+        foreach=foreach,
+        capturable=args.capturable,
+        batched_cpr=batched_cpr
+    )
+
+
+def set_grads(params: list[torch.nn.Parameter], seed: int):
+    generator = torch.Generator(device=params[0].device)
+    generator.manual_seed(seed)
+    for p in params[:-1]:
+        p.grad = torch.randn(p.shape, device=p.device, generator=generator)
+    params[-1].grad = torch.zeros_like(params[-1])
+
+
+def check_equivalence(args: argparse.Namespace):
+    params = gin_params(args.hidden, args.layers, args.device)
+    params_batched = copy.deepcopy(params)
+    # the reference is always the per tensor loop
+    opt = optimizer(params, args, batched_cpr=False, foreach=False)
+    opt_batched = optimizer(params_batched, args, batched_cpr=True, foreach=args.foreach)
+    for step in range(args.check_steps):
+        set_grads(params, step)
+        set_grads(params_batched, step)
+        opt.step()
+        opt_batched.step()
+        # after every step, the warm start must not change the parameters
+        for i, (p, q) in enumerate(zip(params, params_batched)):
+            # the std of a tensor with a single element (or of a constant one) is nan in both implementations
+            torch.testing.assert_close(q, p, rtol=0, atol=0, equal_nan=True,
+                                       msg=f"parameter {i} differs after step {step + 1}")
+            for key in ["lagmul", "kappa"]:
+                torch.testing.assert_close(opt_batched.state[q][key], opt.state[p][key], rtol=0, atol=0,
+                                           equal_nan=True, msg=f"{key} of parameter {i} differs after step {step + 1}")
+
+
+def time_steps(args: argparse.Namespace, batched_cpr: bool, foreach: bool) -> float:
+    params = gin_params(args.hidden, args.layers, args.device)
+    # warm start at the first step, all timed steps regularize every tensor
+    opt = optimizer(params, argparse.Namespace(**vars(args) | {"warm_start": 1}), batched_cpr, foreach)
+    set_grads(params, 0)
+    for _ in range(5):
+        opt.step()
+    if args.device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        opt.step()
+    if args.device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.steps
+
+
+def main(args: argparse.Namespace):
+    n_params = len(gin_params(args.hidden, args.layers, "cpu"))
+    check_equivalence(args)
+    print(f"batched CPR matches per tensor CPR bit-for-bit in each of {args.check_steps} steps "
+          f"({n_params} tensors, warm start at step {args.warm_start})")
+    loop = time_steps(args, batched_cpr=False, foreach=False)
+    batched = time_steps(args, batched_cpr=True, foreach=args.foreach)
+    print(f"step time on {args.device}: per tensor {loop * 1000:.2f}ms, batched {batched * 1000:.2f}ms "
+          f"({loop / batched:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark for the CPR update of AdamCPRfast")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--steps", type=int, default=100, help="number of timed optimizer steps")
+    parser.add_argument("--check_steps", type=int, default=20, help="number of steps compared against the loop")
+    parser.add_argument("--warm_start", type=int, default=5, help="step at which kappa is initialized")
+    parser.add_argument("--reg_function", type=str, default="l2", choices=["l2", "l1", "std", "huber"])
+    parser.add_argument("--foreach", action="store_true", help="use the foreach implementation of the adam update")
+    parser.add_argument("--capturable", action="store_true", help="keep the step counts on the device")
+    parser.add_argument("--hidden", type=int, default=300)
+    parser.add_argument("--layers", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,66 @@
+"""
+Measures how long it takes to parse an experiment and create all of its runs.
+
+Usage:
+    python benchmarks/parse_experiment.py --runs 10000
+"""
+import argparse
+import time
+from pytorch_fob.engine.engine import Engine, engine_path
+from pytorch_fob.engine.parser import YAMLParser
+from pytorch_fob.evaluation import evaluation_path
+from pytorch_fob.optimizers import optimizer_path
+from pytorch_fob.tasks import task_path
+
+
+def searchspace(n_runs: int) -> dict:
+    return {
+        "task": {"name": "mnist"},
+        "optimizer": {"name": "adamw_baseline", "learning_rate": [1.e-3 + i * 1.e-6 for i in range(n_runs)]},
+        "engine": {"output_dir": "./benchmark_outputs"}
+    }
+
+
+def default_files() -> list:
+    return [
+        task_path("mnist") / "default.yaml",
+        optimizer_path("adamw_baseline") / "default.yaml",
+        engine_path() / "default.yaml",
+        evaluation_path() / "default.yaml",
+    ]
+
+
+def time_default_parsing(n_runs: int, cached: bool) -> float:
+    """each run parses every default.yaml twice (run config and default config)"""
+    parser = YAMLParser()
+    YAMLParser.clear_cache()
+    files = default_files()
+    start = time.perf_counter()
+    for _ in range(n_runs):
+        for file in files + files:
+            parser.parse_yaml(file, cached=cached)
+    return time.perf_counter() - start
+
+
+def time_engine(n_runs: int) -> float:
+    YAMLParser.clear_cache()
+    start = time.perf_counter()
+    engine = Engine()
+    engine.parse_experiment(searchspace(n_runs))
+    for _ in engine.runs():
+        pass
+    return time.perf_counter() - start
+
+
+def main(args: argparse.Namespace):
+    print(f"parsing default.yaml files for {args.runs} runs:")
+    print(f"  uncached: {time_default_parsing(args.runs, cached=False):.2f}s")
+    print(f"  cached:   {time_default_parsing(args.runs, cached=True):.2f}s")
+    print(f"parsing experiment and creating {args.runs} runs: {time_engine(args.runs):.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark for parsing large experiments")
+    parser.add_argument("--runs", type=int, default=10000,
+                        help="number of runs in the experiment")
+    main(parser.parse_args())
@@ -0,0 +1,194 @@
+from pathlib import Path
+import argparse
+import time
+from typing import Any, Optional
+import numpy as np
+import torch
+from torch.optim import Optimizer as TorchOptimizer
+from torch.profiler import ProfilerActivity, profile
+from pytorch_fob.engine.engine import Engine
+from pytorch_fob.engine.run import Run
+from pytorch_fob.engine.utils import log_info, log_warn, set_loglevel, write_results
+from pytorch_fob.optimizers import optimizer_names
+from pytorch_fob.tasks import task_names
+
+
+RESULT_FILE = "optimizer_benchmark.json"
+METRICS = ["step_time_ms", "peak_memory_mb", "state_bytes_per_param"]
+EXCLUDE = ["template"]
+
+
+def plot_config(metric: str) -> dict[str, Any]:
+    """heatmap of one metric with the tasks as rows and the optimizers as columns"""
+    return {
+        "experiment_name": f"optimizer_benchmark-{metric}",
+        "checkpoints": ["last"],
+        "column_split_key": None,
+        "experiment_files": {"last_model": RESULT_FILE},
+        "plot": {
+            "x_axis": ["optimizer.name"],
+            "y_axis": ["task.name"],
+            "metric": metric,
+            "test_metric_mode": "min",
+            "format": "0.2",
+            "limits": None,
+            "std": False
+        }
+    }
+
+
+def first_optimizer(optimizer_config: Any) -> TorchOptimizer:
+    """the (first) optimizer from the return value of `configure_optimizers`"""
+    if isinstance(optimizer_config, TorchOptimizer):
+        return optimizer_config
+    if isinstance(optimizer_config, dict):
+        return first_optimizer(optimizer_config["optimizer"])
+    if isinstance(optimizer_config, (list, tuple)) and len(optimizer_config) > 0:
+        return first_optimizer(optimizer_config[0])
+    raise TypeError(f"could not find an optimizer in {type(optimizer_config)}")
+
+
+def unique_tensors(tensors: list[torch.Tensor]) -> list[torch.Tensor]:
+    seen = set()
+    result = []
+    for t in tensors:
+        key = (t.device, t.data_ptr())
+        if key not in seen:
+            seen.add(key)
+            result.append(t)
+    return result
+
+
+def tensor_bytes(tensors: list[torch.Tensor]) -> int:
+    return sum(t.numel() * t.element_size() for t in unique_tensors(tensors))
+
+
+def state_tensors(optimizer: TorchOptimizer) -> list[torch.Tensor]:
+    return [v for state in optimizer.state.values() for v in state.values() if isinstance(v, torch.Tensor)]
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def transient_peak_bytes(optimizer: TorchOptimizer, device: torch.device) -> int:
+    """highest amount of memory allocated during a step on top of the memory allocated before the step"""
+    if device.type == "cuda":
+        synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_allocated(device)
+        optimizer.step()
+        synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - before
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        optimizer.step()
+    events = [e for e in prof.profiler.kineto_results.events() if e.name() == "[memory]"]  # type: ignore
+    events.sort(key=lambda e: e.start_us())
+    allocated = np.cumsum([0] + [e.nbytes() for e in events])
+    return int(allocated.max())
+
+
+def benchmark_optimizer(optimizer: TorchOptimizer, device: torch.device, warmup: int, steps: int) -> dict[str, float]:
+    """
+    Measures the optimizer step on synthetic gradients, the forward and backward pass of the task are not included.
+    The first steps create the optimizer state and are not timed.
+    """
+    params = unique_tensors([p for group in optimizer.param_groups for p in group["params"] if p.requires_grad])
+    generator = torch.Generator(device=device)
+    generator.manual_seed(0)
+    for p in params:
+        p.grad = torch.randn(p.shape, generator=generator, device=device, dtype=p.dtype) * 1e-3
+    for _ in range(warmup):
+        optimizer.step()
+    step_times = []
+    for _ in range(steps):
+        synchronize(device)
+        start = time.perf_counter()
+        optimizer.step()
+        synchronize(device)
+        step_times.append(time.perf_counter() - start)
+    num_params = sum(p.numel() for p in params)
+    state_bytes = tensor_bytes(state_tensors(optimizer))
+    static_bytes = tensor_bytes(params) + tensor_bytes([p.grad for p in params]) + state_bytes  # type: ignore
+    peak_bytes = static_bytes + transient_peak_bytes(optimizer, device)
+    return {
+        "step_time_ms": float(np.median(step_times)) * 1000,
+        "step_time_std_ms": float(np.std(step_times)) * 1000,
+        "peak_memory_mb": peak_bytes / 2**20,
+        "state_memory_mb": state_bytes / 2**20,
+        "state_bytes_per_param": state_bytes / max(num_params, 1),
+        "num_params": num_params,
+        "num_tensors": len(params)
+    }
+
+
+def benchmark_run(run: Run, device: torch.device, warmup: int, steps: int) -> Optional[dict[str, float]]:
+    if run.task.max_steps is None:
+        # the learning rate schedules need it, computing it would need the data
+        run.set_max_steps(warmup + steps + 1)
+    torch.manual_seed(run.engine.seed)
+    try:
+        model, _ = run.get_task()
+        model.to(device)
+        optimizer = first_optimizer(model.configure_optimizers())
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # e.g. optional dependencies of a task or optimizer which are not installed
+        log_warn(f"could not create {run.optimizer.name} for task '{run.task.name}', skipping it: "
+                 f"{type(e).__name__}: {e}")
+        return None
+    results = benchmark_optimizer(optimizer, device, warmup, steps)
+    results["device"] = str(device)  # type: ignore
+    return results
+
+
+def default_experiment(device: str) -> dict[str, Any]:
+    """all tasks with all optimizers, the experiment file overwrites them"""
+    return {
+        "task": [{"name": name} for name in sorted(task_names()) if name not in EXCLUDE],
+        "optimizer": [{"name": name} for name in sorted(optimizer_names()) if name not in EXCLUDE],
+        "engine": {"accelerator": "gpu" if device.startswith("cuda") else "cpu", "plot": True}
+    }
+
+
+def main(args: argparse.Namespace, extra_args: list[str]):
+    engine = Engine()
+    searchspace = default_experiment(args.device)
+    if args.experiment_file is not None:
+        engine.parser.merge_dicts_hierarchical(searchspace, engine.parser.parse_yaml(args.experiment_file))
+    # the plot settings of the experiment are for the task metrics
+    engine.parser.merge_dicts_hierarchical(searchspace, {"evaluation": plot_config(args.metric)})
+    engine.parse_experiment(searchspace, extra_args=extra_args)
+    device = torch.device(args.device)
+    finished = 0
+    for n, run in engine.numbered_runs():
+        log_info(f"Benchmarking run {n}/{engine.num_runs()}: {run.optimizer.name} on {run.task.name}...")
+        results = benchmark_run(run, device, args.warmup, args.steps)
+        if results is None:
+            continue
+        run.run_dir.mkdir(parents=True, exist_ok=True)
+        run.export_config()
+        write_results([results], run.run_dir / RESULT_FILE)
+        log_info(f"{results['step_time_ms']:.3f}ms per step, {results['peak_memory_mb']:.1f}MB peak memory, "
+                 f"{results['state_bytes_per_param']:.2f} bytes of state per parameter")
+        finished += 1
+    if finished > 0:
+        engine.plot()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="measures the time, peak memory and state size of an optimizer step for each run of an experiment"
+    )
+    parser.add_argument("experiment_file", type=Path, nargs="?", default=None,
+                        help="The yaml file specifying the experiment. Tasks and optimizers default to all of them.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--warmup", type=int, default=5, help="Number of untimed optimizer steps.")
+    parser.add_argument("--steps", type=int, default=20, help="Number of timed optimizer steps.")
+    parser.add_argument("--metric", type=str, choices=METRICS, default="step_time_ms",
+                        help="The metric to plot.")
+    parser.add_argument("--log_level", type=str, choices=["debug", "info", "warn", "silent"], default="info",
+                        help="Set the log level")
+    args, extra_args = parser.parse_known_args()
+    set_loglevel(args.log_level)
+    main(args, extra_args)
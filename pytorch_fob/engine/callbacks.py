@@ -1,11 +1,21 @@
+import json
 import math
 import time
-from typing import Optional
+from collections import deque
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Optional
 import deepspeed
+import numpy as np
 import torch
+from torch.profiler import ProfilerActivity, profile, record_function, schedule
 import lightning.pytorch as pl
 from lightning import Callback, Trainer, LightningModule
+from lightning.fabric.utilities.exceptions import MisconfigurationException
+from lightning.pytorch.utilities.data import extract_batch_size
 from lightning_utilities.core.rank_zero import rank_zero_only
+from pytorch_fob.engine.parameter_groups import GroupedModel
+from pytorch_fob.engine.tensor_statistics import MAX_QUANTILE_NUMEL, STATISTICS, tensor_statistics
 from pytorch_fob.engine.utils import log_debug, log_info, log_warn, seconds_to_str
 
 
@@ -90,73 +100,359 @@ class LogParamsAndGrads(Callback):
 
         if trainer.global_step % self.log_every_n_steps == 0 and (self.log_params or self.log_gradient):
 
-            q = torch.arange(.25, 1, .25).round(decimals=2).to(trainer.model.device)
-            stats = {}
+            param_names, params, grad_names, grads = [], [], [], []
             for k, v in pl_module.named_parameters():
                 if self.log_params:
-                    if trainer.global_rank == 0:
-                        v_detached = v.detach()
-
-                        if torch.isnan(v_detached).sum() > 0:
-                            log_warn(f"# NaN in param {k}")
-                        if torch.isinf(v_detached).sum() > 0:
-                            log_warn(f"# Inf in param {k}")
-
-                        stats[f"param/{k}/mean"] = v_detached.mean().item()
-                        if v_detached.shape[0] > 1:
-                            stats[f"param/{k}/std"] = v_detached.std().item()
-                            stats[f"param/{k}/min"] = v_detached.min().item()
-                            stats[f"param/{k}/max"] = v_detached.max().item()
-                            stats[f"param/{k}/abs_mean"] = v_detached.abs().mean().item()
-                            stats[f"param/{k}/abs_std"] = v_detached.abs().std().item()
-                            stats[f"param/{k}/l2m"] = (v_detached**2).mean().item()
-                            stats[f"param/{k}/l2s"] = (v_detached**2).sum().item()
-
-                            if self.log_quantiles and v_detached.size().numel() < 10000000:
-                                deciles = torch.quantile(v_detached.float(), q, interpolation='linear')
-                                for q_idx, d_val in enumerate(deciles):
-                                    stats[f"param/{k}/quantile-{q[q_idx]}"] = d_val.item()
-
+                    param_names.append(k)
+                    params.append(v)
                 if self.log_gradient and v.requires_grad:
-
+                    # called on every rank, sharded gradients are gathered
                     if trainer.num_devices > 1:
                         grad_data = deepspeed.utils.safe_get_full_grad(v)
                     else:
                         grad_data = v.grad
+                    if grad_data is not None:
+                        grad_names.append(k)
+                        grads.append(grad_data)
+
+            if trainer.global_rank != 0:
+                return
+
+            q = torch.arange(.25, 1, .25).round(decimals=2) if self.log_quantiles else None
+            # all statistics are computed on the device and moved to the host at once
+            values = tensor_statistics(params + grads, q).cpu().tolist()
+            quantile_names = [] if q is None else [f"quantile-{q_val}" for q_val in q.tolist()]
+
+            stats = {}
+            self._collect_stats(stats, "param", param_names, params, values[:len(params)], quantile_names,
+                                ["std", "min", "max", "abs_mean", "abs_std", "l2m", "l2s"])
+            self._collect_stats(stats, "grad", grad_names, grads, values[len(params):], quantile_names,
+                                ["std", "min", "max", "abs_mean", "abs_std"], non_finite_value=-10)
 
-                    if grad_data is not None and trainer.global_rank == 0:
-                        if torch.isnan(grad_data).sum() > 0:
-                            log_warn(f"# NaN in grad {k}")
-                        if torch.isinf(grad_data).sum() > 0:
-                            log_warn(f"# Inf in grad {k}")
-
-                        if torch.isnan(grad_data).sum() > 0 or torch.isinf(grad_data).sum() > 0:
-                            stats[f"grad/{k}/mean"] = -10
-                            if len(grad_data.shape) > 1 or grad_data.shape[0] > 1:
-                                stats[f"grad/{k}/std"] = -10
-                                stats[f"grad/{k}/min"] = -10
-                                stats[f"grad/{k}/max"] = -10
-                                stats[f"grad/{k}/abs_mean"] = -10
-                                stats[f"grad/{k}/abs_std"] = -10
-                                if self.log_quantiles and grad_data.size().numel() < 10000000:
-                                    for q_idx, _ in enumerate(q):
-                                        stats[f"param/{k}/quantile-{q[q_idx]}"] = -10
-
-                        stats[f"grad/{k}/mean"] = grad_data.mean().item()
-                        if len(grad_data.shape) > 1 or grad_data.shape[0] > 1:
-                            stats[f"grad/{k}/std"] = grad_data.std().item()
-                            stats[f"grad/{k}/min"] = grad_data.min().item()
-                            stats[f"grad/{k}/max"] = grad_data.max().item()
-                            stats[f"grad/{k}/abs_mean"] = grad_data.abs().mean().item()
-                            stats[f"grad/{k}/mean"] = grad_data.mean().item()
-                            stats[f"grad/{k}/abs_std"] = grad_data.abs().std().item()
-                            stats[f"grad/{k}/std"] = grad_data.std().item()
-
-                            if self.log_quantiles and grad_data.size().numel() < 10000000:
-                                deciles = torch.quantile(grad_data.float(), q, interpolation='linear')
-                                for q_idx, d_val in enumerate(deciles):
-                                    stats[f"grad/{k}/quantile-{q[q_idx]}"] = d_val.item()
-
-            if trainer.loggers is not None and trainer.global_rank == 0:
+            if trainer.loggers is not None:
                 for logger in trainer.loggers:
                     logger.log_metrics(stats, step=trainer.global_step)
+
+    def _collect_stats(
+            self,
+            stats: dict[str, float],
+            kind: str,
+            names: list[str],
+            tensors: list[torch.Tensor],
+            values: list[list[float]],
+            quantile_names: list[str],
+            logged: list[str],
+            non_finite_value: Optional[float] = None
+            ):
+        for k, v, row in zip(names, tensors, values):
+            row = dict(zip(STATISTICS + quantile_names, row))
+            if row["nan"] > 0:
+                log_warn(f"# NaN in {kind} {k}")
+            if row["inf"] > 0:
+                log_warn(f"# Inf in {kind} {k}")
+            replace = non_finite_value is not None and row["nan"] + row["inf"] > 0
+            keys = ["mean"]
+            if v.numel() > 1:
+                keys += logged
+                if v.numel() < MAX_QUANTILE_NUMEL:
+                    keys += quantile_names
+            for key in keys:
+                stats[f"{kind}/{k}/{key}"] = non_finite_value if replace else row[key]
+
+
+class RingBuffer():
+    """The last `size` values for percentiles, and the count and sum of all values."""
+    def __init__(self, size: int):
+        self.values = np.zeros(size, dtype=np.float64)
+        self.count = 0
+        self.total = 0.0
+
+    def append(self, value: float):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        self.total += value
+
+    def summary(self) -> dict[str, float]:
+        if self.count == 0:
+            return {"count": 0}
+        last = self.values[:min(self.count, len(self.values))]
+        p50, p90, p99 = np.percentile(last, [50, 90, 99])
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count,
+            "p50": float(p50),
+            "p90": float(p90),
+            "p99": float(p99),
+            "max": float(last.max())
+        }
+
+
+class StepTimer(Callback):
+    """
+    Measures every training step split into waiting for data (including the transfer to the device),
+    forward and backward pass, and optimizer step, and the throughput in samples and tokens per second.
+    On the gpu, CUDA events are recorded and only read once they completed, so training is never synchronized;
+    otherwise `time.perf_counter` is used.
+    Percentiles are computed over the last `window` steps, the summary is written to `output_file` after training.
+    """
+    phases = ["data", "compute", "optimizer", "step"]
+
+    def __init__(self, output_file: Path, window: int = 10_000):
+        super().__init__()
+        self.output_file = output_file
+        self.window = window
+        self.use_cuda_events = False
+        self.times = {phase: RingBuffer(window) for phase in self.phases}
+        self.samples_per_second = RingBuffer(window)
+        self.tokens_per_second = RingBuffer(window)
+        self.samples = 0
+        self.tokens = 0
+        self._pending: deque[dict[str, Any]] = deque()
+        self._current: dict[str, Any] = {}
+        self._data_start: Any = None
+
+    def _mark(self) -> Any:
+        if self.use_cuda_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed(self, start: Any, end: Any) -> float:
+        if self.use_cuda_events:
+            return start.elapsed_time(end) / 1000
+        return end - start
+
+    def _completed(self, mark: Any) -> bool:
+        return not self.use_cuda_events or mark.query()
+
+    def on_train_start(self, trainer: Trainer, pl_module: LightningModule):
+        self.use_cuda_events = pl_module.device.type == "cuda"
+
+    def on_train_epoch_start(self, trainer: Trainer, pl_module: LightningModule):
+        # the first step of each epoch includes starting the dataloader workers
+        self._data_start = self._mark()
+
+    def on_train_batch_start(self, trainer: Trainer, pl_module: LightningModule, batch: Any, batch_idx: int):
+        self._current = {
+            "data_start": self._data_start,
+            "batch_start": self._mark(),
+            "optimizer_start": None,
+            "samples": _num_samples(batch),
+            "tokens": _num_tokens(batch)
+        }
+
+    def on_before_optimizer_step(self, trainer: Trainer, pl_module: LightningModule, optimizer):
+        if self._current:
+            self._current["optimizer_start"] = self._mark()
+
+    def on_train_batch_end(self, trainer: Trainer, pl_module: LightningModule, outputs, batch: Any, batch_idx: int):
+        if not self._current:
+            return
+        self._current["end"] = self._mark()
+        self._pending.append(self._current)
+        self._data_start = self._current["end"]
+        self._current = {}
+        self._record_completed()
+
+    def on_validation_start(self, trainer: Trainer, pl_module: LightningModule):
+        # validation during training is not waiting for data
+        self._data_start = None
+
+    def on_validation_end(self, trainer: Trainer, pl_module: LightningModule):
+        self._data_start = self._mark()
+
+    def on_train_end(self, trainer: Trainer, pl_module: LightningModule):
+        self._record_completed(wait=True)
+        if trainer.global_rank == 0:
+            self.output_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.output_file, "w", encoding="utf8") as f:
+                json.dump(self.summary(), f, indent=4)
+
+    def _record_completed(self, wait: bool = False):
+        if wait and self._pending and self.use_cuda_events:
+            self._pending[-1]["end"].synchronize()
+        while self._pending and self._completed(self._pending[0]["end"]):
+            self._record(self._pending.popleft())
+
+    def _record(self, step: dict[str, Any]):
+        if step["optimizer_start"] is None:  # accumulating gradients
+            compute = self._elapsed(step["batch_start"], step["end"])
+            optimizer = 0.0
+        else:
+            compute = self._elapsed(step["batch_start"], step["optimizer_start"])
+            optimizer = self._elapsed(step["optimizer_start"], step["end"])
+            self.times["optimizer"].append(optimizer)
+        self.times["compute"].append(compute)
+        step_time = compute + optimizer
+        if step["data_start"] is not None:
+            data = self._elapsed(step["data_start"], step["batch_start"])
+            self.times["data"].append(data)
+            step_time += data
+        self.times["step"].append(step_time)
+        if step["samples"] is not None:
+            self.samples += step["samples"]
+            self.samples_per_second.append(step["samples"] / step_time)
+        if step["tokens"] is not None:
+            self.tokens += step["tokens"]
+            self.tokens_per_second.append(step["tokens"] / step_time)
+
+    def summary(self) -> dict[str, Any]:
+        total_time = self.times["step"].total
+        summary: dict[str, Any] = {
+            "clock": "cuda_event" if self.use_cuda_events else "perf_counter",
+            "window": self.window,
+            "seconds": {phase: buffer.summary() for phase, buffer in self.times.items()},
+            "data_fraction": self.times["data"].total / total_time if total_time > 0 else None
+        }
+        for name, buffer, count in [
+            ("samples_per_second", self.samples_per_second, self.samples),
+            ("tokens_per_second", self.tokens_per_second, self.tokens)
+        ]:
+            rate = buffer.summary()
+            rate.pop("total", None)
+            # the per step values weight fast and slow steps equally
+            rate["overall"] = count / total_time if total_time > 0 and count > 0 else None
+            summary[name] = rate
+        return summary
+
+
+def _num_samples(batch: Any) -> Optional[int]:
+    num_graphs = getattr(batch, "num_graphs", None)  # pytorch geometric
+    if num_graphs is not None:
+        return int(num_graphs)
+    try:
+        return extract_batch_size(batch)
+    except (MisconfigurationException, RecursionError):
+        return None
+
+
+def _num_tokens(batch: Any) -> Optional[int]:
+    """number of (padded) input tokens"""
+    if isinstance(batch, Mapping) and isinstance(batch.get("input_ids", None), torch.Tensor):
+        return batch["input_ids"].numel()
+    return None
+
+
+class ProfileSteps(Callback):
+    """
+    Profiles a window of training batches with `torch.profiler`: after `skip` batches, `warmup` batches are profiled
+    but discarded and the next `active` batches are recorded. A step lasts from the end of one training batch
+    to the end of the next, so it includes loading the batch (and validation if it runs in between).
+    Writes a chrome trace, tables of the operators and a per step time breakdown to `output_dir`.
+    The breakdown contains the forward pass of the model and its submodules up to `module_depth`
+    (named like the parameters of the `GroupedModel`) and the optimizer step.
+    """
+    def __init__(self, output_dir: Path, skip: int = 10, warmup: int = 2, active: int = 5, module_depth: int = 2):
+        super().__init__()
+        self.output_dir = output_dir
+        self.skip = skip
+        self.warmup = warmup
+        self.active = active
+        self.module_depth = module_depth
+        self.profiler: Optional[profile] = None
+        self._step = 0
+        self._saved = False
+        self._hooks: list[torch.utils.hooks.RemovableHandle] = []
+        self._ranges: list[record_function] = []
+        self._suffix = ""
+
+    def on_train_start(self, trainer: Trainer, pl_module: LightningModule):
+        self._suffix = f"_rank{trainer.global_rank}" if trainer.world_size > 1 else ""
+        self._step = 0
+        log_info(f"profiling training batches {self.skip + self.warmup + 1} to {self.skip + self.warmup + self.active}")
+
+    def on_train_batch_start(self, trainer: Trainer, pl_module: LightningModule, batch: Any, batch_idx: int):
+        if self._step == self.skip and self.profiler is None and not self._saved:
+            self._start(pl_module)
+
+    def on_train_batch_end(self, trainer: Trainer, pl_module: LightningModule, outputs, batch: Any, batch_idx: int):
+        self._step += 1
+        if self.profiler is not None:
+            self.profiler.step()
+            if self._saved:
+                self.profiler = None
+
+    def on_train_end(self, trainer: Trainer, pl_module: LightningModule):
+        if self.profiler is not None:
+            # training ended within the window, saves what was recorded so far
+            self.profiler.stop()
+            self.profiler = None
+        self._remove_hooks()
+        if not self._saved:
+            log_warn(f"training ended after {self._step} batches, before any batch was profiled")
+
+    def _start(self, pl_module: LightningModule):
+        activities = [ProfilerActivity.CPU]
+        if pl_module.device.type == "cuda":
+            activities.append(ProfilerActivity.CUDA)
+        model = getattr(pl_module, "model", pl_module)
+        # `GroupedModel.forward` calls the forward of the wrapped model directly, its hooks never run
+        network = model.model if isinstance(model, GroupedModel) else model
+        modules = [("model", model)] + [
+            (name, module) for name, module in network.named_modules()
+            if name and name.count(".") < self.module_depth
+        ]
+        for name, module in modules:
+            self._hooks.append(module.register_forward_pre_hook(self._enter_module(name)))
+            self._hooks.append(module.register_forward_hook(self._exit_module))
+        self.profiler = profile(
+            activities=activities,
+            schedule=schedule(wait=0, warmup=self.warmup, active=self.active, repeat=1),
+            on_trace_ready=self._trace_ready,
+            record_shapes=True
+        )
+        self.profiler.start()
+
+    def _enter_module(self, name: str):
+        def hook(module, args):
+            self._ranges.append(record_function(f"module::{name}").__enter__())
+        return hook
+
+    def _exit_module(self, module, args, output):
+        if self._ranges:
+            self._ranges.pop().__exit__(None, None, None)
+
+    def _remove_hooks(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        self._ranges = []
+
+    def _trace_ready(self, prof: profile):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        prof.export_chrome_trace(str(self.output_dir / f"trace{self._suffix}.json"))
+        on_cuda = ProfilerActivity.CUDA in prof.activities
+        averages = prof.key_averages()
+        sort_by = "self_cuda_time_total" if on_cuda else "self_cpu_time_total"
+        with open(self.output_dir / f"operators{self._suffix}.txt", "w", encoding="utf8") as f:
+            f.write(averages.table(sort_by=sort_by, row_limit=100))
+        with open(self.output_dir / f"operators_by_shape{self._suffix}.txt", "w", encoding="utf8") as f:
+            f.write(prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=100))
+        with open(self.output_dir / f"breakdown{self._suffix}.json", "w", encoding="utf8") as f:
+            json.dump(self._breakdown(averages, on_cuda), f, indent=4)
+        log_info(f"saved profile to {self.output_dir}")
+        self._saved = True
+        self._remove_hooks()
+
+    def _breakdown(self, averages, on_cuda: bool) -> dict[str, Any]:
+        """milliseconds per step (inclusive of nested ranges)"""
+        steps = max(1, sum(event.count for event in averages if event.key.startswith("ProfilerStep")))
+
+        def times(event) -> dict[str, float]:
+            result = {"cpu_ms": event.cpu_time_total / 1000 / steps, "calls_per_step": event.count / steps}
+            if on_cuda:
+                result["cuda_ms"] = event.cuda_time_total / 1000 / steps
+            return result
+
+        breakdown: dict[str, Any] = {"steps": steps, "step": None, "optimizer": {}, "modules": {}}
+        for event in averages:
+            if event.key.startswith("ProfilerStep"):
+                breakdown["step"] = times(event)
+            elif event.key.startswith("Optimizer."):
+                breakdown["optimizer"][event.key] = times(event)
+            elif event.key.startswith("module::"):
+                breakdown["modules"][event.key.removeprefix("module::")] = times(event)
+        breakdown["modules"] = dict(sorted(breakdown["modules"].items()))
+        return breakdown
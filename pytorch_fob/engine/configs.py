@@ -73,11 +73,13 @@ class EngineConfig(BaseConfig):
         self.gradient_clip_alg: str = cfg["gradient_clip_alg"]
         self.gradient_clip_val: Optional[float] = cfg["gradient_clip_val"]
         self.log_extra: bool = cfg["log_extra"]
+        self.log_timing: bool = cfg.get("log_timing", False)
         self.max_steps: int = config[task_key].get("max_steps", None)
         self.optimize_memory: bool = cfg["optimize_memory"]
         self.output_dir = Path(cfg["output_dir"]).resolve()
         self.plot: bool = cfg["plot"]
         self.precision: str = cfg["precision"]
+        self.profile: dict[str, Any] = some(cfg.get("profile", None), default={"enabled": False})
         self.restrict_train_epochs: Optional[int] = cfg["restrict_train_epochs"]
         _resume = cfg.get("resume", False)
         self.resume: Optional[Path] | bool = Path(_resume).resolve() if isinstance(_resume, str) else _resume
@@ -90,6 +92,7 @@ class EngineConfig(BaseConfig):
         self.sbatch_time_factor: float = cfg["sbatch_time_factor"]
         self.slurm_log_dir: Optional[Path] = maybe_abspath(cfg["slurm_log_dir"])
         self.silent: bool = cfg.get("silent", False)
+        self.skip_finished: bool = cfg.get("skip_finished", True)
         self.test: bool = cfg.get("test", True)
         self.train: bool = cfg.get("train", True)
         self.validate: bool = cfg.get("validate", False)
@@ -131,11 +134,12 @@ class EvalConfig(BaseConfig):
             best_model = "results_best_model.json",
             last_model = "results_final_model.json",
             config = "config.yaml"
-        ))
+        ) | cfg.get("experiment_files", {}))
         self.output_types: list[str] = wrap_list(cfg["output_types"])
         experiment_dir = Path(config[engine_key]["output_dir"]).resolve()
         self.output_dir: Path = some(maybe_abspath(cfg["output_dir"]), default=experiment_dir / "plots")
         self.experiment_name: str = cfg["experiment_name"]
+        self.results_cache: bool = cfg.get("results_cache", True)
         self.verbose: bool = cfg.get("verbose", False)
         split = cfg.get("split_groups", False)
         self.split_groups: bool | list[str] = split if isinstance(split, bool) else wrap_list(split)
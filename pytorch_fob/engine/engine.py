@@ -1,16 +1,16 @@
-import json
 from copy import deepcopy
 from typing import Any, Callable, Iterable, Iterator, Literal, Optional
 from pathlib import Path
 from matplotlib.figure import Figure
-from pandas import DataFrame, concat, json_normalize
+from pandas import DataFrame
 from pytorch_fob.engine.configs import EvalConfig
-from pytorch_fob.engine.grid_search import grid_search
+from pytorch_fob.engine.grid_search import Grid, build_grid
 from pytorch_fob.engine.parser import YAMLParser
 from pytorch_fob.engine.run import Run
-from pytorch_fob.engine.run_schedulers import sequential, slurm_array, slurm_jobs
+from pytorch_fob.engine.run_schedulers import local_pool, sequential, slurm_array, slurm_jobs
 from pytorch_fob.engine.utils import log_debug, log_info, log_warn, some, sort_dict_recursively
 from pytorch_fob.evaluation import evaluation_path
+from pytorch_fob.evaluation.aggregate import RESULTS_CACHE_FILE, dataframe_from_results, read_runs
 from pytorch_fob.evaluation.plot import create_figure, get_output_file_path, save_files, set_plotstyle
 from pytorch_fob.optimizers import optimizer_path, optimizer_names
 from pytorch_fob.tasks import task_path, task_names
@@ -22,8 +22,8 @@ def engine_path() -> Path:
 
 class Engine():
     def __init__(self) -> None:
-        self._runs = []
-        self._defaults = []
+        self._grid: Grid = build_grid([])
+        self._eval_config = {}
         self._experiment = {}
         self._experiment_file = None
         self._block_plotting = False
@@ -36,23 +36,35 @@ class Engine():
         self.parser = YAMLParser()
 
     def run_experiment(self) -> Optional[list[int]]:
-        assert len(self._runs) > 0, "No runs in experiment, make sure to call 'parse_experiment' first."
-        scheduler = self._runs[0][self.engine_key]["run_scheduler"]
-        assert all(map(lambda x: x[self.engine_key]["run_scheduler"] == scheduler, self._runs)), \
-            "You cannot perform gridsearch on 'run_scheduler'."
-        if scheduler == "sequential":
-            sequential(self.runs(), len(self._runs), self._experiment)
-        elif scheduler.startswith("single"):
+        assert self.num_runs() > 0, "No runs in experiment, make sure to call 'parse_experiment' first."
+        scheduler = self._make_run(1).engine.run_scheduler
+        if scheduler.startswith("single"):
+            # only builds the requested run, the rest of the grid is never expanded
             n = int(scheduler.rsplit(":", 1)[-1])
-            log_info(f"Starting run {n}/{len(self._runs)}.")
             run = self._make_run(n)
+            if run.engine.skip_finished and run.is_finished():
+                log_info(f"Skipping run {n}/{self.num_runs()}, results already exist in '{run.run_dir}'.")
+                return
+            log_info(f"Starting run {n}/{self.num_runs()}.")
             run.start()
+            return
+        runs = list(self.numbered_runs(skip_finished=True))
+        assert all(map(lambda x: x[1].engine.run_scheduler == scheduler, runs)), \
+            "You cannot perform gridsearch on 'run_scheduler'."
+        if len(runs) == 0:
+            log_info("All runs of the experiment are already finished.")
+            return
+        if scheduler == "sequential":
+            sequential(runs, self.num_runs(), self._experiment)
+        elif scheduler.startswith("local_pool"):
+            n = int(scheduler.rsplit(":", 1)[-1])
+            local_pool(runs, n, self.num_runs(), self._experiment)
         elif scheduler == "slurm_array":
             self._block_plotting = True
-            slurm_array(list(self.runs()), self._experiment)
+            slurm_array(runs, self._experiment)
         elif scheduler == "slurm_jobs":
             self._block_plotting = True
-            return slurm_jobs(list(self.runs()), self._experiment)
+            return slurm_jobs(runs, self._experiment)
         else:
             raise ValueError(f"Unsupported run_scheduler: {scheduler=}.")
 
@@ -73,28 +85,42 @@ class Engine():
         self._experiment = deepcopy(searchspace)
         # exclude plotting from gridsearch
         if self.eval_key in searchspace:
-            eval_config = searchspace.pop(self.eval_key)
+            self._eval_config = searchspace.pop(self.eval_key)
         else:
-            eval_config = {}
+            self._eval_config = {}
         log_debug("Performing gridsearch...")
-        self._runs = grid_search(searchspace)
-        log_debug(f"Found {len(self._runs)} runs.")
-        for run in self._runs:
-            run[self.eval_key] = eval_config
-        self._fill_runs_from_default(self._runs)
-        self._fill_defaults()
-
-    def runs(self) -> Iterator[Run]:
+        # runs are only expanded on demand, see '_make_run'
+        self._grid = build_grid(searchspace)
+        log_debug(f"Found {self.num_runs()} runs.")
+
+    def num_runs(self) -> int:
+        return len(self._grid)
+
+    def runs(self, skip_finished: bool = False) -> Iterator[Run]:
         """
         Creates and initializes runs from parsed run config.
+        skip_finished: leave out runs which already have results, see `numbered_runs`
         """
-        for n, _ in enumerate(self._runs, start=1):
-            yield self._make_run(n)
+        for _, run in self.numbered_runs(skip_finished):
+            yield run
+
+    def numbered_runs(self, skip_finished: bool = False) -> Iterator[tuple[int, Run]]:
+        """
+        Creates and initializes runs together with their number (starting from 1).
+        skip_finished: leave out runs with 'engine.skip_finished=true' whose results already exist in their run_dir
+        """
+        for n in range(1, self.num_runs() + 1):
+            run = self._make_run(n)
+            if skip_finished and run.engine.skip_finished and run.is_finished():
+                log_info(f"Skipping run {n}/{self.num_runs()}, results already exist in '{run.run_dir}'.")
+                continue
+            yield n, run
 
     def prepare_data(self):
         prepared = set()
-        for n, t in enumerate(self._runs, start=1):
-            name = t["task"]["name"]
+        for n, t in enumerate(self._grid, start=1):
+            task = t[self.task_key]
+            name = task if isinstance(task, str) else task[self.identifier_key]
             if name not in prepared:
                 run = self._make_run(n)
                 log_info(f"Setting up data for {run.task_key} '{run.task.name}'...")
@@ -136,40 +162,47 @@ class Engine():
         save_files(fig, dfs, output_file_path, config)
 
     def dataframe_from_runs(self, mode: Literal["last", "best"]) -> DataFrame:
-        dfs: list[DataFrame] = []
-        for run in self.runs():
-            df = json_normalize(run.get_config())
-            if mode == "last":
-                result_file = run.run_dir / run.evaluation.experiment_files.last_model
-            elif mode == "best":
-                result_file = run.run_dir / run.evaluation.experiment_files.best_model
-            else:
-                raise ValueError(f"mode {mode} not supported")
-            if not result_file.is_file():
-                log_warn(f"result file {result_file} not found, skipping this hyperparameter setting")
+        runs = list(self.runs())
+        config = runs[0].evaluation
+        if mode == "last":
+            result_file = config.experiment_files.last_model
+        elif mode == "best":
+            result_file = config.experiment_files.best_model
+        else:
+            raise ValueError(f"mode {mode} not supported")
+        trials = read_runs(
+            [run.run_dir for run in runs],
+            config.experiment_files.config,
+            result_file,
+            read_configs=False,  # the config of each run is already known
+            cache_file=config.output_dir / RESULTS_CACHE_FILE if config.results_cache else None
+        )
+        configs, results, metrics = [], [], []
+        for run, trial in zip(runs, trials):
+            if trial is None:
+                log_warn(f"result file {run.run_dir / result_file} not found, skipping this hyperparameter setting")
                 continue
-            metric = run.evaluation.plot.metric
-            with open(result_file, "r", encoding="utf8") as f:
-                content = json.load(f)
-                if metric in content[0]:
-                    df.at[0, metric] = content[0][metric]
-                else:
-                    log_warn(f"could not find value for {metric} in json, skipping this hyperparameter setting")
-                    continue
-            dfs.append(df)
-        if len(dfs) == 0:
-            raise ValueError("no dataframes found, check your config")
-        return concat(dfs, sort=False)
+            configs.append(run.get_config())
+            results.append(trial[1])
+            metrics.append(run.evaluation.plot.metric)
+        return dataframe_from_results(configs, results, metrics)
 
     def _make_run(self, n: int) -> Run:
         """
         n: number of the run, starting from 1
         setup: download and prepare data
         """
-        i = n - 1
+        config = self._grid[n - 1]
+        config[self.eval_key] = self._eval_config
+        config = self._fill_run_from_default(config)
+        default_config = {
+            k: {self.identifier_key: config[k][self.identifier_key]}
+            for k in [self.task_key, self.optimizer_key]
+        }
+        default_config = self._fill_run_from_default(default_config)
         return Run(
-            self._runs[i],
-            self._defaults[i],
+            config,
+            default_config,
             self.task_key,
             self.optimizer_key,
             self.engine_key,
@@ -185,27 +218,17 @@ class Engine():
             if isinstance(searchspace[key], dict) and all(name in opts for name in searchspace[key]):
                 searchspace[key] = [cfg | {self.identifier_key: name} for name, cfg in searchspace[key].items()]
 
-    def _fill_defaults(self):
-        self._defaults = []
-        for run in self._runs:
-            default_cfg = {
-                k: {self.identifier_key: run[k][self.identifier_key]}
-                for k in [self.task_key, self.optimizer_key]
-            }
-            self._defaults.append(default_cfg)
-        self._fill_runs_from_default(self._defaults)
-
-    def _fill_runs_from_default(self, runs: list[dict[str, Any]]):
-        for i, _ in enumerate(runs):
-            # order from higher to lower in hierarchy
-            runs[i] = self._fill_named_from_default(runs[i], self.task_key, task_path)
-            runs[i] = self._fill_named_from_default(runs[i], self.optimizer_key, optimizer_path)
-            runs[i] = self._fill_unnamed_from_default(runs[i], engine_path)
-            runs[i] = self._fill_unnamed_from_default(runs[i], evaluation_path)
+    def _fill_run_from_default(self, run: dict[str, Any]) -> dict[str, Any]:
+        # order from higher to lower in hierarchy
+        run = self._fill_named_from_default(run, self.task_key, task_path)
+        run = self._fill_named_from_default(run, self.optimizer_key, optimizer_path)
+        run = self._fill_unnamed_from_default(run, engine_path)
+        run = self._fill_unnamed_from_default(run, evaluation_path)
+        return run
 
     def _fill_unnamed_from_default(self, experiment: dict[str, Any], unnamed_root: Callable) -> dict[str, Any]:
         default_path: Path = unnamed_root() / self.default_file_name
-        default_config = self.parser.parse_yaml(default_path)
+        default_config = self.parser.parse_yaml(default_path, cached=True)
         self.parser.merge_dicts_hierarchical(default_config, experiment)
         return default_config
 
@@ -217,7 +240,7 @@ class Engine():
         else:
             experiment[key] = {self.identifier_key: named}
         default_path: Path = named_root(named) / self.default_file_name
-        default_config = self.parser.parse_yaml(default_path)
+        default_config = self.parser.parse_yaml(default_path, cached=True)
         self.parser.merge_dicts_hierarchical(default_config, experiment)
         return default_config
 
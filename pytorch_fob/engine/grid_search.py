@@ -1,32 +1,180 @@
-from typing import Any
+from bisect import bisect_right
+from copy import deepcopy
+from itertools import accumulate
+from typing import Any, Hashable, Iterator
 
 
-def unique(xs: list) -> list:
-    """Returns deduplicated list"""
+def freeze(x: Any) -> Hashable:
+    """Converts (nested) dicts and lists into a hashable object with the same notion of equality"""
+    if isinstance(x, dict):
+        return frozenset((k, freeze(v)) for k, v in x.items())
+    if isinstance(x, list):
+        return ("__list__", tuple(freeze(v) for v in x))
+    return x
+
+
+def unique(xs: Iterator[Any] | list) -> list:
+    """Returns deduplicated list, keeps the first occurrence of each element"""
     res = []
+    seen = set()
     for x in xs:
-        if x not in res:
+        key = freeze(x)
+        if key not in seen:
+            seen.add(key)
             res.append(x)
     return res
 
 
-def grid_search(d: dict[str, Any]) -> list[dict[str, Any]]:
-    ret = []
+class Grid():
+    """
+    Lazy expansion of a searchspace.
+    Supports `len`, indexing and iteration without building the whole cartesian product.
+    """
+    def __init__(self, length: int) -> None:
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> Any:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"grid index {index} out of range for grid of size {len(self)}")
+        return self._get(index)
+
+    def __iter__(self) -> Iterator[Any]:
+        raise NotImplementedError
+
+    def _get(self, index: int) -> Any:
+        raise NotImplementedError
+
+    def is_unique(self) -> bool:
+        """whether the grid is guaranteed to contain no duplicates"""
+        return True
+
+
+class _Value(Grid):
+    def __init__(self, value: Any) -> None:
+        super().__init__(1)
+        self.value = value
+
+    def __iter__(self) -> Iterator[Any]:
+        yield self.value
+
+    def _get(self, index: int) -> Any:
+        return self.value
+
+
+class _Materialized(Grid):
+    def __init__(self, values: list[Any]) -> None:
+        super().__init__(len(values))
+        self.values = values
+
+    def __iter__(self) -> Iterator[Any]:
+        for v in self.values:
+            yield deepcopy(v)
+
+    def _get(self, index: int) -> Any:
+        return deepcopy(self.values[index])
+
+
+class _Product(Grid):
+    """all combinations of the values of a dict, the last key changes fastest"""
+    def __init__(self, children: list[tuple[str, Grid]]) -> None:
+        length = 1
+        for _, child in children:
+            length *= len(child)
+        super().__init__(length)
+        self.children = children
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        return self._iter(len(self.children))
+
+    def _iter(self, m: int) -> Iterator[dict[str, Any]]:
+        if m == 0:
+            yield {}
+            return
+        k, child = self.children[m - 1]
+        for rest in self._iter(m - 1):
+            for config in child:
+                yield rest | {k: config}
+
+    def _get(self, index: int) -> dict[str, Any]:
+        values = []
+        for k, child in reversed(self.children):
+            index, i = divmod(index, len(child))
+            values.append((k, child._get(i)))
+        return dict(reversed(values))
+
+
+class _Union(Grid):
+    """concatenation of the children"""
+    def __init__(self, children: list[Grid]) -> None:
+        self.offsets = list(accumulate((len(c) for c in children), initial=0))
+        super().__init__(self.offsets[-1])
+        self.children = children
+
+    def __iter__(self) -> Iterator[Any]:
+        for child in self.children:
+            yield from child
+
+    def _get(self, index: int) -> Any:
+        c = bisect_right(self.offsets, index) - 1
+        return self.children[c]._get(index - self.offsets[c])
+
+    def is_unique(self) -> bool:
+        if not all(c.is_unique() for c in self.children):
+            return False
+        if all(isinstance(c, _Value) for c in self.children):
+            return len(set(freeze(c.value) for c in self.children)) == len(self.children)
+        return all(
+            disjoint(a, b)
+            for i, a in enumerate(self.children)
+            for b in self.children[i + 1:]
+        )
+
+
+def disjoint(a: Grid, b: Grid) -> bool:
+    """
+    Conservative check whether two grids cannot contain equal elements.
+    Returns False if this cannot be decided cheaply.
+    """
+    if len(a) == 0 or len(b) == 0:
+        return True
+    if isinstance(a, _Union):
+        return all(disjoint(c, b) for c in a.children)
+    if isinstance(b, _Union):
+        return all(disjoint(a, c) for c in b.children)
+    if isinstance(a, _Value) and isinstance(b, _Value):
+        return freeze(a.value) != freeze(b.value)
+    if isinstance(a, _Product) and isinstance(b, _Product):
+        a_children = dict(a.children)
+        b_children = dict(b.children)
+        if a_children.keys() != b_children.keys():
+            return True
+        return any(disjoint(a_children[k], b_children[k]) for k in a_children)
+    if (isinstance(a, _Value) and isinstance(b, _Product)) or (isinstance(a, _Product) and isinstance(b, _Value)):
+        return True  # a dict never equals a value
+    return False
+
+
+def deduplicated(grid: Grid) -> Grid:
+    if grid.is_unique():
+        return grid
+    return _Materialized(unique(grid))
+
+
+def build_grid(d: Any) -> Grid:
+    """
+    Creates a lazy grid with the same elements (and order) as `grid_search(d)`.
+    """
     if isinstance(d, dict):
-        if len(d) == 0:
-            return [dict()]
-        copy = d.copy()
-        k, v = copy.popitem()
-        configs = unique(grid_search(v))
-        rest = grid_search(copy)
-        for r in rest:
-            for config in configs:
-                ret.append(r | {k: config})
-    elif isinstance(d, list):
-        for v in d:
-            configs = grid_search(v)
-            for config in configs:
-                ret.append(config)
-    else:
-        ret.append(d)
-    return ret
+        return _Product([(k, deduplicated(build_grid(v))) for k, v in d.items()])
+    if isinstance(d, list):
+        return _Union([build_grid(v) for v in d])
+    return _Value(d)
+
+
+def grid_search(d: dict[str, Any]) -> list[dict[str, Any]]:
+    return list(build_grid(d))
@@ -4,14 +4,46 @@ import re
 import yaml
 
 
+def copy_yaml_content(x: Any) -> Any:
+    """
+    Copies the (nested) dicts and lists of parsed YAML content.
+    Faster than `deepcopy` since all other values are immutable.
+    """
+    if isinstance(x, dict):
+        return {k: copy_yaml_content(v) for k, v in x.items()}
+    if isinstance(x, list):
+        return [copy_yaml_content(v) for v in x]
+    return x
+
+
 class YAMLParser():
+    # shared by all instances: path -> (mtime, size, parsed content)
+    _cache: dict[str, tuple[int, int, Any]] = {}
+
     def __init__(self) -> None:
         pass
 
-    def parse_yaml(self, file: Path) -> Any:
+    def parse_yaml(self, file: Path, cached: bool = False) -> Any:
         """
         Opens and parses a YAML file.
+        cached: reuse the content if the file was parsed before and did not change since then.
+        Each call returns a fresh copy, so the result can be modified safely.
         """
+        if not cached:
+            return self._load_yaml(file)
+        path = Path(file).resolve()
+        stat = path.stat()
+        mtime, size, content = YAMLParser._cache.get(str(path), (None, None, None))
+        if (mtime, size) != (stat.st_mtime_ns, stat.st_size):
+            content = self._load_yaml(path)
+            YAMLParser._cache[str(path)] = (stat.st_mtime_ns, stat.st_size, content)
+        return copy_yaml_content(content)
+
+    @classmethod
+    def clear_cache(cls):
+        cls._cache.clear()
+
+    def _load_yaml(self, file: Path) -> Any:
         with open(file, "r", encoding="utf8") as f:
             return yaml.safe_load(f)
 
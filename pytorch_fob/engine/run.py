@@ -1,4 +1,5 @@
 import hashlib
+import json
 from pathlib import Path
 import time
 from typing import Any, Optional
@@ -9,7 +10,7 @@ from lightning.pytorch.loggers import Logger, TensorBoardLogger, CSVLogger
 from lightning.pytorch.utilities.types import _EVALUATE_OUTPUT
 import torch
 import yaml
-from pytorch_fob.engine.callbacks import LogParamsAndGrads, PrintEpochWithTime, RestrictTrainEpochs
+from pytorch_fob.engine.callbacks import LogParamsAndGrads, PrintEpochWithTime, ProfileSteps, RestrictTrainEpochs, StepTimer
 from pytorch_fob.engine.configs import EngineConfig, EvalConfig, OptimizerConfig, TaskConfig
 from pytorch_fob.engine.utils import AttributeDict, EndlessList, calculate_steps, concatenate_dict_keys, convert_type_inside_dict, dict_differences, findfirst, path_to_str_inside_dict, precision_with_fallback, seconds_to_str, trainer_strategy, write_results, log_warn, log_info
 from pytorch_fob.optimizers.optimizers import Optimizer
@@ -77,6 +78,31 @@ class Run():
         write_results(scores, self.run_dir / "scores.json")
         return scores
 
+    def is_finished(self) -> bool:
+        """
+        Checks if the results this run would produce already exist in `self.run_dir`.
+        """
+        scores_file = self.run_dir / "scores.json"
+        if not scores_file.is_file():
+            return False
+        try:
+            with open(scores_file, "r", encoding="utf8") as f:
+                scores = json.load(f)
+        except json.JSONDecodeError:
+            return False
+        expected_scores = []
+        if self.engine.validate:
+            expected_scores.append("validation")
+        if self.engine.test:
+            expected_scores.append("test_final")
+        if not all(k in scores for k in expected_scores):
+            return False
+        if self.engine.test:
+            return (self.run_dir / self.evaluation.experiment_files.last_model).is_file()
+        if self.engine.train:
+            return (self.checkpoint_dir / "last.ckpt").is_file()
+        return True
+
     def _train(self, trainer: Trainer, model: LightningModule, data_module: LightningDataModule):
         start_time = time.time()
         if self.engine.accelerator == "gpu" and torch.cuda.is_available():
@@ -192,13 +218,19 @@ class Run():
         """
         if self.task.max_steps is None:
             max_steps = self._calc_max_steps()
-            self._config[self.task_key]["max_steps"] = max_steps
-            if self._default_config[self.task_key]["max_steps"] is None:
-                self._default_config[self.task_key]["max_steps"] = max_steps
-            self._generate_configs()
+            self.set_max_steps(max_steps)
             log_info(f"'max_steps' not set explicitly, using {max_steps=} (calculated from " +
             f"max_epochs={self.task.max_epochs}, batch_size={self.task.batch_size}, devices={self.engine.devices})")
 
+    def set_max_steps(self, max_steps: int):
+        """
+        Sets `self.task.max_steps` without changing the run dir.
+        """
+        self._config[self.task_key]["max_steps"] = max_steps
+        if self._default_config[self.task_key]["max_steps"] is None:
+            self._default_config[self.task_key]["max_steps"] = max_steps
+        self._generate_configs()
+
     def _ensure_resume_path(self):
         """
         Ensures that `self.engine.resume` is either a valid Path or None.
@@ -255,7 +287,16 @@ class Run():
         self._callbacks["print_epoch"] = PrintEpochWithTime(self.engine.silent)
         if self.engine.restrict_train_epochs is not None:
             self._callbacks["restrict_train_epochs"] = RestrictTrainEpochs(self.engine.restrict_train_epochs)
-        # TODO: callback for logging time per step
+        if self.engine.log_timing:
+            self._callbacks["step_timer"] = StepTimer(self.run_dir / "timing.json")
+        if self.engine.profile.get("enabled", False):
+            self._callbacks["profile"] = ProfileSteps(
+                self.run_dir / "profile",
+                skip=self.engine.profile.get("skip", 10),
+                warmup=self.engine.profile.get("warmup", 2),
+                active=self.engine.profile.get("active", 5),
+                module_depth=self.engine.profile.get("module_depth", 2)
+            )
 
     def outpath_exclude_keys(self) -> list[str]:
         return [
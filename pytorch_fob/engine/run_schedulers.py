@@ -1,7 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Any, Iterable, Optional, Sequence
+from typing import Any, Iterable, Iterator, Optional, Sequence
+import multiprocessing
+import os
+import sys
 import traceback
+import torch
 import yaml
 from pytorch_fob.engine.run import Run
 from pytorch_fob.engine.slurm import Slurm
@@ -123,14 +130,35 @@ def run_plotting_job(
     run_slurm("FOB-plot", command, args, log_dir, dependencies=dependencies, dependency_type="afterany")
 
 
-def slurm_array(runs: list[Run], experiment: dict[str, Any]) -> None:
+def array_indices(indices: Sequence[int]) -> str:
+    """
+    Compacts the run numbers into a SLURM array specification.
+    Example:
+    >>> array_indices([1, 2, 3, 5, 7, 8])
+    '1-3,5,7-8'
+    """
+    ranges: list[list[int]] = []
+    for i in sorted(indices):
+        if len(ranges) > 0 and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ",".join(str(lo) if lo == hi else f"{lo}-{hi}" for lo, hi in ranges)
+
+
+def slurm_array(numbered_runs: list[tuple[int, Run]], experiment: dict[str, Any]) -> None:
+    """
+    numbered_runs: the runs to schedule together with their number in the experiment (starting from 1)
+    """
+    runs = [run for _, run in numbered_runs]
     equal_req = ["devices", "workers", "sbatch_args", "slurm_log_dir", "sbatch_script_template", "run_scheduler"]
     argcheck_allequal_engine(runs, equal_req)
     run = runs[0]  # all runs have the same args
     args = run.engine.sbatch_args
     log_dir = some(run.engine.slurm_log_dir, default=run.engine.output_dir / "slurm_logs")
     if "array" not in args:
-        args["array"] = f"1-{len(runs)}"
+        # only covers the runs which are not finished yet
+        args["array"] = array_indices([i for i, _ in numbered_runs])
     process_args(args, run)
     experiment_file = [export_experiment(run, experiment).resolve() for run in runs][0]
     command = get_command(experiment_file, "$SLURM_ARRAY_TASK_ID", plot=False)
@@ -140,10 +168,14 @@ def slurm_array(runs: list[Run], experiment: dict[str, Any]) -> None:
         run_plotting_job(experiment_file, args, log_dir, [job_id], template=run.engine.sbatch_script_template)
 
 
-def slurm_jobs(runs: list[Run], experiment: dict[str, Any]) -> list[int]:
+def slurm_jobs(numbered_runs: list[tuple[int, Run]], experiment: dict[str, Any]) -> list[int]:
+    """
+    numbered_runs: the runs to schedule together with their number in the experiment (starting from 1)
+    """
+    runs = [run for _, run in numbered_runs]
     job_ids = []
     experiment_file = Path()
-    for i, run in enumerate(runs, start=1):
+    for i, run in numbered_runs:
         args = run.engine.sbatch_args
         process_args(args, run)
         log_dir = some(run.engine.slurm_log_dir, default=run.run_dir / "slurm_logs")
@@ -160,8 +192,12 @@ def slurm_jobs(runs: list[Run], experiment: dict[str, Any]) -> list[int]:
     return job_ids
 
 
-def sequential(runs: Iterable[Run], n_runs: int, experiment: dict[str, Any]):
-    for i, run in enumerate(runs, start=1):
+def sequential(numbered_runs: Iterable[tuple[int, Run]], n_runs: int, experiment: dict[str, Any]):
+    """
+    numbered_runs: the runs to perform together with their number in the experiment (starting from 1)
+    n_runs: total number of runs in the experiment
+    """
+    for i, run in numbered_runs:
         log_info(f"Starting run {i}/{n_runs}.")
         export_experiment(run, experiment)
         try:
@@ -169,3 +205,176 @@ def sequential(runs: Iterable[Run], n_runs: int, experiment: dict[str, Any]):
         except RuntimeError as _e:  # detect_anomaly raises RuntimeError
             t = traceback.format_exc()
             log_warn(f"Run {i}/{n_runs} failed with {t}.")
+
+
+@contextmanager
+def redirect_output(logfile: Path) -> Iterator[None]:
+    """
+    Redirects stdout and stderr (including output of subprocesses and C extensions) into `logfile`.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    with open(logfile, "a", encoding="utf8") as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+
+
+def split_evenly(xs: Sequence[Any], n: int) -> list[list[Any]]:
+    """
+    Example:
+    >>> split_evenly([0, 1, 2, 3, 4], 2)
+    [[0, 1, 2], [3, 4]]
+    """
+    k, m = divmod(len(xs), n)
+    return [list(xs[i * k + min(i, m):(i + 1) * k + min(i + 1, m)]) for i in range(n)]
+
+
+def available_gpus() -> list[str]:
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES", None)
+    if visible is not None:
+        return [d for d in visible.split(",") if d.strip() != ""]
+    return [str(i) for i in range(torch.cuda.device_count())]
+
+
+def available_cpus() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# flags of the runs that are currently running in a local_pool worker, set by the initializer
+_local_pool_running = None
+
+
+def _pin_local_pool_worker(slots, running, gpus: list[list[str]], cpus: list[list[int]]) -> None:
+    """
+    Initializer of each local_pool worker process: claims a slot and restricts
+    the process to the devices and cpus belonging to it.
+    """
+    global _local_pool_running  # pylint: disable=global-statement
+    _local_pool_running = running
+    slot = slots.get()
+    if len(gpus) > 0:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(gpus[slot])
+    if hasattr(os, "sched_setaffinity") and len(cpus[slot]) > 0:
+        os.sched_setaffinity(0, cpus[slot])
+
+
+def _local_pool_worker(k: int, run: Run, logfile_name: str) -> Optional[str]:
+    """
+    Returns the traceback if the run failed, None otherwise.
+    k: position of the run in the flags of the running runs
+    """
+    _local_pool_running[k] = 1
+    run.run_dir.mkdir(parents=True, exist_ok=True)
+    with redirect_output(run.run_dir / logfile_name):
+        try:
+            run.start()
+        except RuntimeError as _e:  # detect_anomaly raises RuntimeError
+            return traceback.format_exc()
+        finally:
+            _local_pool_running[k] = 0
+    return None
+
+
+def _local_pool_round(
+        remaining: dict[int, tuple[int, Run]],
+        n_workers: int,
+        n_runs: int,
+        gpus: list[list[str]],
+        cpus: list[list[int]],
+        logfile_name: str
+    ) -> tuple[bool, list[int]]:
+    """
+    Performs the `remaining` runs (number: (position, run)) in a process pool and removes the finished ones.
+    Returns whether a worker process died and, if so, the numbers of the runs that were running in the pool.
+    """
+    ctx = multiprocessing.get_context("spawn")  # cuda does not support fork
+    slots = ctx.Queue()
+    for slot in range(n_workers):
+        slots.put(slot)
+    running = ctx.Array("b", max(k for k, _ in remaining.values()) + 1, lock=False)
+    broken = False
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=ctx,
+        initializer=_pin_local_pool_worker,
+        initargs=(slots, running, gpus, cpus)
+    ) as pool:
+        futures = {pool.submit(_local_pool_worker, k, run, logfile_name): i for i, (k, run) in remaining.items()}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                t = future.result()
+            except BrokenProcessPool:
+                # a worker died (e.g. killed for lack of memory), all unfinished runs of the pool are lost
+                broken = True
+                continue
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                t = "".join(traceback.format_exception(e))
+            del remaining[i]
+            if t is None:
+                log_info(f"Finished run {i}/{n_runs}.")
+            else:
+                log_warn(f"Run {i}/{n_runs} failed with {t}.")
+    return broken, [i for i, (k, _) in remaining.items() if running[k] == 1]
+
+
+def local_pool(
+        numbered_runs: list[tuple[int, Run]],
+        n_workers: int,
+        n_runs: int,
+        experiment: dict[str, Any],
+        logfile_name: str = "output.log"
+    ):
+    """
+    Runs the experiment in `n_workers` processes on the local machine.
+    Each worker gets its own share of the gpus (`engine.devices` each) and cpus.
+    If a worker process dies, the runs it may have been running are repeated one at a time.
+    numbered_runs: the runs to perform together with their number in the experiment (starting from 1)
+    n_runs: total number of runs in the experiment
+    """
+    if n_workers < 1:
+        raise ValueError(f"'engine.run_scheduler=local_pool:N' requires N >= 1, got {n_workers}.")
+    runs = [run for _, run in numbered_runs]
+    n_workers = min(n_workers, len(runs))
+    gpus: list[list[str]] = []
+    if any(run.engine.accelerator == "gpu" for run in runs):
+        argcheck_allequal_engine(runs, ["devices"], reason="'engine.run_scheduler=local_pool'")
+        devices = runs[0].engine.devices
+        visible = available_gpus()
+        if len(visible) < n_workers * devices:
+            raise ValueError(
+                f"'engine.run_scheduler=local_pool:{n_workers}' with engine.devices={devices} requires " +
+                f"{n_workers * devices} gpus, but only {len(visible)} are available."
+            )
+        gpus = [visible[i * devices:(i + 1) * devices] for i in range(n_workers)]
+    cpus = split_evenly(available_cpus(), n_workers)
+    log_info(f"Starting {len(runs)} runs on {n_workers} local workers, logs are written to 'run_dir/{logfile_name}'.")
+    for run in runs:
+        export_experiment(run, experiment)
+    remaining = {i: (k, run) for k, (i, run) in enumerate(numbered_runs)}
+    while len(remaining) > 0:
+        broken, crashed = _local_pool_round(remaining, n_workers, n_runs, gpus, cpus, logfile_name)
+        if not broken:
+            break
+        if len(crashed) == 0:
+            for i in remaining:
+                log_warn(f"Run {i}/{n_runs} was skipped, a worker process died before it started.")
+            break
+        # the runs that were running when the pool broke are repeated alone, the others go back to the pool
+        log_warn(f"A worker process died during the runs {crashed}, repeating them one at a time.")
+        for i in crashed:
+            alone = {i: remaining.pop(i)}
+            if _local_pool_round(alone, 1, n_runs, gpus[:1], [sum(cpus, [])], logfile_name)[0]:
+                log_warn(f"Run {i}/{n_runs} failed, its worker process died.")
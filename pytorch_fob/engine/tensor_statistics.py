@@ -0,0 +1,161 @@
+from typing import Optional, Sequence
+import torch
+from torch import Tensor
+
+
+STATISTICS = ["mean", "std", "min", "max", "abs_mean", "abs_std", "l2m", "l2s", "nan", "inf"]
+MAX_QUANTILE_NUMEL = 10_000_000
+# elements flattened into one buffer at once on the device, bounds the temporary memory (~30 bytes per element)
+CHUNK_NUMEL = 2**22
+
+
+def _segment_sums(values: Tensor, segments: Tensor, n_segments: int) -> Tensor:
+    """
+    Sum, absolute sum, sum of squares, min, max and number of nan and inf values of each segment
+    with a few scatter kernels. The sums are accumulated in double precision.
+    """
+    device = values.device
+    sums = torch.zeros(n_segments, 3, dtype=torch.float64, device=device)
+    for i, x in enumerate([values, values.abs(), values.square()]):
+        sums[:, i].index_add_(0, segments, x.double())
+    minimum = torch.full((n_segments,), float("inf"), device=device).scatter_reduce_(0, segments, values, "amin")
+    maximum = torch.full((n_segments,), float("-inf"), device=device).scatter_reduce_(0, segments, values, "amax")
+    non_finite = torch.zeros(n_segments, 2, device=device).index_add_(
+        0, segments, torch.stack([values.isnan(), values.isinf()], dim=1).float())
+    return torch.cat([sums, torch.stack([minimum, maximum], dim=1).double(), non_finite.double()], dim=1)
+
+
+def _tensor_sums(tensors: Sequence[Tensor]) -> Tensor:
+    """same as `_segment_sums` with one reduction per tensor, faster on the cpu where scatter kernels are slow"""
+    rows = []
+    for t in tensors:
+        x = t.detach().float()
+        rows.append(torch.stack([
+            x.sum(dtype=torch.float64),
+            x.abs().sum(dtype=torch.float64),
+            x.square().sum(dtype=torch.float64),
+            x.min().double(),
+            x.max().double(),
+            x.isnan().sum().double(),
+            x.isinf().sum().double(),
+        ]))
+    return torch.stack(rows)
+
+
+def _segment_quantiles(values: Tensor, segments: Tensor, numels: list[int], q: Tensor) -> Tensor:
+    """linear interpolated quantiles of each segment, same as `torch.quantile` for each tensor"""
+    # a single sort by (segment, value): the float bits are mapped to integers with the same order
+    bits = values.view(torch.int32).long()
+    keys = torch.where(bits < 0, ~bits & 0xFFFFFFFF, bits | 0x80000000) | (segments << 32)
+    values = values[keys.argsort()]
+    starts = torch.tensor([0] + numels[:-1], device=values.device).cumsum(0)
+    last = torch.tensor(numels, device=values.device) - 1
+    ranks = q[None, :] * last[:, None]
+    ranks_below = ranks.long()
+    ranks_above = ranks.ceil().long()
+    values_below = values[starts[:, None] + ranks_below]
+    values_above = values[starts[:, None] + ranks_above]
+    return torch.lerp(values_below, values_above, ranks - ranks_below)
+
+
+def _flatten(tensors: Sequence[Tensor], device: torch.device) -> tuple[Tensor, Tensor]:
+    """all values in one float buffer and the index of the tensor each value belongs to"""
+    values = torch.cat([t.detach().reshape(-1).to(device=device, dtype=torch.float32) for t in tensors])
+    segments = torch.repeat_interleave(
+        torch.arange(len(tensors), device=device),
+        torch.tensor([t.numel() for t in tensors], device=device),
+        output_size=values.numel()
+    )
+    return values, segments
+
+
+def _chunks(numels: Sequence[int], chunk_numel: int = CHUNK_NUMEL) -> list[list[int]]:
+    """indices of consecutive tensors with up to `chunk_numel` elements in total, larger tensors are on their own"""
+    chunks: list[list[int]] = []
+    chunk: list[int] = []
+    total = 0
+    for i, numel in enumerate(numels):
+        if chunk and total + numel > chunk_numel:
+            chunks.append(chunk)
+            chunk, total = [], 0
+        chunk.append(i)
+        total += numel
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _device_sums(tensors: Sequence[Tensor], device: torch.device) -> Tensor:
+    """`_segment_sums` of chunks of tensors, tensors larger than a chunk are reduced on their own"""
+    rows = []
+    for chunk in _chunks([t.numel() for t in tensors]):
+        chunk_tensors = [tensors[i] for i in chunk]
+        if len(chunk) == 1 and chunk_tensors[0].numel() > CHUNK_NUMEL:
+            rows.append(_tensor_sums(chunk_tensors))
+        else:
+            rows.append(_segment_sums(*_flatten(chunk_tensors, device), len(chunk)))
+    return torch.cat(rows)
+
+
+def _device_quantiles(tensors: Sequence[Tensor], q: Tensor, device: torch.device) -> Tensor:
+    """`_segment_quantiles` of chunks of tensors, tensors larger than a chunk with `torch.quantile`"""
+    results = []
+    for chunk in _chunks([t.numel() for t in tensors]):
+        chunk_tensors = [tensors[i] for i in chunk]
+        if len(chunk) == 1 and chunk_tensors[0].numel() > CHUNK_NUMEL:
+            results.append(torch.quantile(chunk_tensors[0].detach().reshape(-1).float(), q)[None])
+        else:
+            values, segments = _flatten(chunk_tensors, device)
+            results.append(_segment_quantiles(values, segments, [t.numel() for t in chunk_tensors], q))
+    return torch.cat(results)
+
+
+def tensor_statistics(
+        tensors: Sequence[Tensor],
+        q: Optional[Tensor] = None,
+        max_quantile_numel: int = MAX_QUANTILE_NUMEL
+    ) -> Tensor:
+    """
+    Computes the `STATISTICS` (and the quantiles `q`) of many tensors without synchronizing with the host:
+    chunks of tensors are flattened into one buffer and reduced with a few segmented kernels, which bounds the
+    temporary memory to `CHUNK_NUMEL` elements besides the tensors reduced on their own that are larger than that
+    (on the cpu, where scatter kernels are slow and there is nothing to synchronize, one tensor at a time).
+    Returns a float tensor of shape `(len(tensors), len(STATISTICS) + len(q))` on the device of the tensors,
+    so that all values can be moved to the host at once.
+    Quantiles of tensors with `max_quantile_numel` or more elements are not computed and are nan.
+    """
+    n_quantiles = 0 if q is None else len(q)
+    if len(tensors) == 0:
+        return torch.empty(0, len(STATISTICS) + n_quantiles)
+    device = tensors[0].device
+    numels = [t.numel() for t in tensors]
+    n = len(tensors)
+    if device.type == "cpu":
+        sums = _tensor_sums(tensors)
+    else:
+        sums = _device_sums(tensors, device)
+    total, abs_total, l2s, minimum, maximum, nan, inf = sums.unbind(1)
+    count = torch.tensor(numels, dtype=torch.float64, device=device)
+    mean = total / count
+    abs_mean = abs_total / count
+    # unbiased like `torch.std`, the sums are accumulated in double precision
+    single = count < 2
+    std = ((l2s - total * mean) / (count - 1)).clamp_(min=0).sqrt().masked_fill_(single, float("nan"))
+    abs_std = ((l2s - abs_total * abs_mean) / (count - 1)).clamp_(min=0).sqrt().masked_fill_(single, float("nan"))
+    stats = torch.stack([mean, std, minimum, maximum, abs_mean, abs_std, l2s / count, l2s, nan, inf], dim=1).float()
+    if q is None:
+        return stats
+
+    quantiles = torch.full((n, n_quantiles), float("nan"), device=device)
+    selected = [i for i, numel in enumerate(numels) if 0 < numel < max_quantile_numel]
+    if len(selected) > 0:
+        q = q.to(device=device, dtype=torch.float32)
+        if device.type == "cpu":
+            q_result = torch.stack([torch.quantile(tensors[i].detach().reshape(-1).float(), q) for i in selected])
+        else:
+            q_result = _device_quantiles([tensors[i] for i in selected], q, device)
+        selected_idx = torch.tensor(selected, device=device)
+        # like `torch.quantile`, tensors containing nan have nan quantiles
+        has_nan = nan[selected_idx] > 0
+        quantiles[selected_idx] = torch.where(has_nan[:, None], float("nan"), q_result)
+    return torch.cat([stats, quantiles], dim=1)
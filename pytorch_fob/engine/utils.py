@@ -5,6 +5,7 @@ import json
 import math
 import signal
 import torch
+import torch.distributed as dist
 from lightning_utilities.core.rank_zero import rank_zero_only, rank_zero_info, rank_zero_debug, log
 
 
@@ -89,6 +90,22 @@ def trainer_strategy(devices: int | list[int] | str) -> str:
     return "ddp" if ndevices > 1 else "auto"
 
 
+def all_gather_cat(tensor: torch.Tensor) -> torch.Tensor:
+    """concatenates the tensors of all ranks (in rank order), which may differ in the first dimension"""
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return tensor
+    world_size = dist.get_world_size()
+    size = torch.tensor([len(tensor)], device=tensor.device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    dist.all_gather(sizes, size)
+    max_size = int(max(sizes))
+    padded = torch.zeros((max_size, *tensor.shape[1:]), dtype=tensor.dtype, device=tensor.device)
+    padded[:len(tensor)] = tensor
+    gathered = [torch.zeros_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+    return torch.cat([t[:int(s)] for t, s in zip(gathered, sizes)])
+
+
 def gpu_suited_for_compile():
     if torch.cuda.is_available():
         device_cap = torch.cuda.get_device_capability()
@@ -0,0 +1,148 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional, Sequence
+import pandas as pd
+import yaml
+from pytorch_fob.engine.utils import log_debug, log_warn
+
+
+RESULTS_CACHE_FILE = ".results_cache.parquet"
+
+
+class ResultCache():
+    """
+    Columnar (parquet) cache of the files read from each run directory.
+    Entries are keyed by run directory and result file name and are invalidated
+    when the modification time of the run directory or the files read from it changes.
+    """
+    columns = ["run_dir", "result_file", "mtime", "config", "results"]
+
+    def __init__(self, file: Optional[Path]) -> None:
+        self.file = file
+        self.entries: dict[tuple[str, str], dict[str, Any]] = {}
+        self.changed = False
+        if self.file is not None and self.file.is_file():
+            self._load()
+
+    def get(self, run_dir: Path, result_file: str, mtime: int, need_config: bool) -> Optional[dict[str, Any]]:
+        entry = self.entries.get((str(run_dir), result_file), None)
+        if entry is None or entry["mtime"] != mtime:
+            return None
+        if need_config and entry["config"] is None:
+            return None
+        return entry
+
+    def put(self, run_dir: Path, result_file: str, mtime: int, config: Optional[str], results: str):
+        self.entries[(str(run_dir), result_file)] = dict(
+            run_dir=str(run_dir),
+            result_file=result_file,
+            mtime=mtime,
+            config=config,
+            results=results
+        )
+        self.changed = True
+
+    def save(self):
+        if self.file is None or not self.changed:
+            return
+        df = pd.DataFrame.from_records(list(self.entries.values()), columns=self.columns)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.file.with_name(f"{self.file.name}.{os.getpid()}.tmp")
+        try:
+            df.to_parquet(tmp_file, index=False)
+            os.replace(tmp_file, self.file)  # atomic, concurrent plotting jobs do not corrupt the cache
+        except ImportError as e:
+            log_warn(f"could not write results cache, parquet support is missing: {e}")
+        self.changed = False
+
+    def _load(self):
+        try:
+            df = pd.read_parquet(self.file, columns=self.columns)
+        except (ImportError, OSError, ValueError) as e:
+            log_warn(f"could not read results cache {self.file}, reading all runs again: {e}")
+            return
+        for entry in df.to_dict("records"):
+            if pd.isna(entry["config"]):
+                entry["config"] = None
+            self.entries[(entry["run_dir"], entry["result_file"])] = entry
+        log_debug(f"loaded {len(self.entries)} entries from results cache {self.file}")
+
+
+def _mtime(*paths: Path) -> int:
+    return max(p.stat().st_mtime_ns for p in paths)
+
+
+def _read_run(
+        run_dir: Path,
+        config_file: str,
+        result_file: str,
+        read_config: bool,
+        cache: ResultCache
+    ) -> Optional[tuple[Optional[dict[str, Any]], Any]]:
+    config_path = run_dir / config_file
+    result_path = run_dir / result_file
+    required = [result_path, config_path] if read_config else [result_path]
+    if not all(p.is_file() for p in required):
+        return None
+    mtime = _mtime(run_dir, *required)
+    entry = cache.get(run_dir, result_file, mtime, need_config=read_config)
+    if entry is not None:
+        config = json.loads(entry["config"]) if read_config else None
+        return config, json.loads(entry["results"])
+    config = None
+    if read_config:
+        with open(config_path, "r", encoding="utf8") as f:
+            config = yaml.safe_load(f)
+    with open(result_path, "r", encoding="utf8") as f:
+        results = json.load(f)
+    cache.put(run_dir, result_file, mtime, json.dumps(config, default=str) if read_config else None, json.dumps(results))
+    return config, results
+
+
+def read_runs(
+        run_dirs: Sequence[Path],
+        config_file: str,
+        result_file: str,
+        read_configs: bool = True,
+        cache_file: Optional[Path] = None,
+        max_workers: Optional[int] = None
+    ) -> list[Optional[tuple[Optional[dict[str, Any]], Any]]]:
+    """
+    Reads the config and result file of each run directory using a thread pool.
+    Returns `(config, results)` for each run dir in the same order, or None if a file is missing.
+    If `cache_file` is given, only runs which changed since the last call are read from disk.
+    """
+    cache = ResultCache(cache_file)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        trials = list(pool.map(
+            lambda run_dir: _read_run(run_dir, config_file, result_file, read_configs, cache),
+            run_dirs
+        ))
+    cache.save()
+    return trials
+
+
+def dataframe_from_results(
+        configs: Sequence[dict[str, Any]],
+        results: Sequence[Any],
+        metrics: Sequence[str],
+        skip_missing_metric: bool = True
+    ) -> pd.DataFrame:
+    """
+    Creates one row per run from its (nested) config and the value of its metric.
+    All rows are normalized at once instead of concatenating single row dataframes.
+    """
+    records = []
+    for config, content, metric in zip(configs, results, metrics):
+        if metric in content[0]:
+            records.append(config | {metric: content[0][metric]})
+        elif skip_missing_metric:
+            log_warn(f"could not find value for {metric} in json, skipping this hyperparameter setting")
+        else:
+            log_warn(f"could not find value for {metric} in json")
+            records.append(config)
+    if len(records) == 0:
+        raise ValueError("no dataframes found, check your config")
+    return pd.json_normalize(records)
@@ -1,4 +1,3 @@
-import json
 from pathlib import Path
 from os import PathLike
 from typing import List, Literal
@@ -8,8 +7,9 @@ from matplotlib.figure import Figure
 import seaborn as sns
 import pandas as pd
 from pytorch_fob.engine.parser import YAMLParser
-from pytorch_fob.engine.utils import AttributeDict, convert_type_inside_dict, log_warn, log_info, log_debug
+from pytorch_fob.engine.utils import AttributeDict, log_warn, log_info, log_debug
 from pytorch_fob.evaluation import evaluation_path
+from pytorch_fob.evaluation.aggregate import RESULTS_CACHE_FILE, dataframe_from_results, read_runs
 
 
 def get_available_trials(dirname: Path, config: AttributeDict, depth: int = 1):
@@ -47,53 +47,39 @@ def get_available_trials(dirname: Path, config: AttributeDict, depth: int = 1):
 def dataframe_from_trials(trial_dir_paths: List[Path], config: AttributeDict) -> pd.DataFrame:
     """takes result from get_available_trials and packs them in a dataframe,
     does not filter duplicate hyperparameter settings."""
-    dfs: List[pd.DataFrame] = []
-
-    for path in trial_dir_paths:
-
-        config_file = path / config.experiment_files.config
-        if config.last_instead_of_best:
-            result_file = path / config.experiment_files.last_model
-        else:
-            result_file = path / config.experiment_files.best_model
-        all_files_exist = all([
-            config_file.is_file(),
-            result_file.is_file()
-        ])
-        if not all_files_exist:
+    if config.last_instead_of_best:
+        result_file_name = config.experiment_files.last_model
+    else:
+        result_file_name = config.experiment_files.best_model
+
+    # use user given value
+    metric_of_value_to_plot = config.plot.metric
+
+    # compute it if user has not given a value
+    if not metric_of_value_to_plot:
+        raise ValueError("evaluation.plot.metric is not set")
+
+    use_cache = config.get("results_cache", True) and config.output_dir
+    trials = read_runs(
+        trial_dir_paths,
+        config.experiment_files.config,
+        result_file_name,
+        cache_file=Path(config.output_dir) / RESULTS_CACHE_FILE if use_cache else None
+    )
+    configs, results = [], []
+    for path, trial in zip(trial_dir_paths, trials):
+        if trial is None:
+            config_file = path / config.experiment_files.config
+            result_file = path / result_file_name
             log_warn(f"WARNING: one or more files are missing in {path}. Skipping this hyperparameter setting." +
                            f"  <{config_file}>: {config_file.is_file()} and\n  <{result_file}>: {result_file.is_file()})")
             continue
+        configs.append(trial[0])
+        results.append(trial[1])
 
-        yaml_parser = YAMLParser()
-        yaml_content = yaml_parser.parse_yaml(config_file)
-        # convert the sub dicts first, then the dict itself
-        yaml_content = convert_type_inside_dict(yaml_content, src=dict, tgt=AttributeDict)
-        yaml_content = AttributeDict(yaml_content)
-
-        # use user given value
-        metric_of_value_to_plot = config.plot.metric
-
-        # compute it if user has not given a value
-        if not metric_of_value_to_plot:
-            raise ValueError("evaluation.plot.metric is not set")
-
-        data = pd.json_normalize(yaml_content)
-
-        with open(result_file, "r", encoding="utf8") as f:
-            content = json.load(f)
-            if metric_of_value_to_plot in content[0]:
-                data.at[0, metric_of_value_to_plot] = content[0][metric_of_value_to_plot]
-            else:
-                log_warn(f"could not find value for {metric_of_value_to_plot} in json")
-
-        dfs.append(data)
-
-    if len(dfs) == 0:
-        raise ValueError("no dataframes found, check your config")
-    df = pd.concat(dfs, sort=False)
-
-    return df
+    return dataframe_from_results(
+        configs, results, [metric_of_value_to_plot] * len(configs), skip_missing_metric=False
+    )
 
 
 def create_matrix_plot(dataframe: pd.DataFrame, config: AttributeDict, cols: str, idx: str, ax=None,
@@ -468,7 +454,7 @@ def pretty_name(name: str, pretty_names: dict | str = {}) -> str:  # type: ignor
 
     if pretty_names == {} or isinstance(pretty_names, str):
         yaml_parser = YAMLParser()
-        yaml_content = yaml_parser.parse_yaml(label_file)
+        yaml_content = yaml_parser.parse_yaml(label_file, cached=True)
         pretty_names: dict[str, str] = yaml_content["names"]
 
     # applying pretty names
@@ -41,6 +41,9 @@ class Adafactor(Optimizer):
             instead of external learning rate (default: True)
         warmup_init: time-dependent learning rate computation depends on
             whether warm-up initialization is being used (default: False)
+        foreach: if true, the update is computed with multi-tensor (foreach)
+            operations for all parameters of a group at once and without
+            host-device synchronization (default: False)
 
     Example:
         >>> import torch_optimizer as optim
@@ -67,6 +70,7 @@ class Adafactor(Optimizer):
         scale_parameter: bool = True,
         relative_step: bool = True,
         warmup_init: bool = False,
+        foreach: bool = False,
     ):
         if lr is not None and lr <= 0.0:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -85,18 +89,26 @@ class Adafactor(Optimizer):
             scale_parameter=scale_parameter,
             relative_step=relative_step,
             warmup_init=warmup_init,
+            foreach=foreach,
         )
         super(Adafactor, self).__init__(params, defaults)
+        # square roots of the parameter sizes for the RMS in `_foreach_step`, by device and sizes
+        self._numels_sqrt: dict[tuple[torch.device, tuple[int, ...]], torch.Tensor] = {}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        super().__setstate__(state)
+        self._numels_sqrt = {}
+        for group in self.param_groups:
+            group.setdefault("foreach", False)
+
+    def _get_relative_step_size(self, param_group: ParamGroup, step: int) -> float:
+        if not param_group["relative_step"]:
+            return param_group["lr"]
+        min_step = 1e-6 * step if param_group["warmup_init"] else 1e-2
+        return min(min_step, 1.0 / math.sqrt(step))
 
     def _get_lr(self, param_group: ParamGroup, param_state) -> float:
-        rel_step_sz = param_group["lr"]
-        if param_group["relative_step"]:
-            min_step = (
-                1e-6 * param_state["step"]
-                if param_group["warmup_init"]
-                else 1e-2
-            )
-            rel_step_sz = min(min_step, 1.0 / math.sqrt(param_state["step"]))
+        rel_step_sz = self._get_relative_step_size(param_group, param_state["step"])
         param_scale = 1.0
         if param_group["scale_parameter"]:
             param_scale = max(param_group["eps2"][1], param_state["RMS"])
@@ -137,6 +149,9 @@ class Adafactor(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            if group["foreach"]:
+                self._foreach_step(group)
+                continue
             for p in group["params"]:
                 if p.grad is None:
                     continue
@@ -223,6 +238,108 @@ class Adafactor(Optimizer):
 
         return loss
 
+    def _init_state(self, group: ParamGroup, p: torch.Tensor) -> None:
+        state = self.state[p]
+        factored, use_first_moment = self._get_options(group, p.shape)
+        state["step"] = 0
+        if use_first_moment:
+            state["exp_avg"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+        if factored:
+            state["exp_avg_sq_row"] = torch.zeros(p.shape[:-1]).type_as(p)
+            state["exp_avg_sq_col"] = torch.zeros(p.shape[:-2] + p.shape[-1:]).type_as(p)
+        else:
+            state["exp_avg_sq"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+        state["RMS"] = 0
+
+    @torch.no_grad()
+    def _foreach_step(self, group: ParamGroup) -> None:
+        """
+        Same update as `_single_tensor_step`, but the elementwise operations are batched over all parameters
+        of the group and the RMS values, learning rates and clipping factors stay on the device.
+        """
+        params = []
+        grads = []
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError("Adafactor does not support sparse gradients.")
+            if len(self.state[p]) == 0:
+                self._init_state(group, p)
+            params.append(p)
+            grads.append(p.grad)
+        if len(params) == 0:
+            return
+        states = [self.state[p] for p in params]
+        for state in states:
+            state["step"] += 1
+        beta2ts = [1.0 - math.pow(state["step"], group["decay_rate"]) for state in states]
+        key = (params[0].device, tuple(p.numel() for p in params))
+        if key not in self._numels_sqrt:
+            self._numels_sqrt[key] = torch.tensor([n ** 0.5 for n in key[1]], device=key[0])
+        numels_sqrt = self._numels_sqrt[key]
+
+        rms = torch.stack(torch._foreach_norm(params)).div_(numels_sqrt)
+        for state, r in zip(states, rms.unbind()):
+            state["RMS"] = r
+        # python scalars, multiplied onto the device tensors without a copy to the device
+        lrs = [self._get_relative_step_size(group, state["step"]) for state in states]
+        if group["scale_parameter"]:
+            lrs = torch._foreach_mul(rms.clamp(min=group["eps2"][1]).unbind(), lrs)
+
+        updates = list(torch._foreach_mul(grads, grads))
+        torch._foreach_add_(updates, group["eps2"][0])
+        factored = [i for i, p in enumerate(params) if self._get_options(group, p.shape)[0]]
+        unfactored = [i for i, p in enumerate(params) if not self._get_options(group, p.shape)[0]]
+        if len(factored) > 0:
+            rows = [states[i]["exp_avg_sq_row"] for i in factored]
+            cols = [states[i]["exp_avg_sq_col"] for i in factored]
+            row_means = [updates[i].mean(dim=-1) for i in factored]
+            col_means = [updates[i].mean(dim=-2) for i in factored]
+            factored_beta2ts = [beta2ts[i] for i in factored]
+            one_minus_beta2ts = [1.0 - b for b in factored_beta2ts]
+            torch._foreach_mul_(rows, factored_beta2ts)
+            torch._foreach_mul_(row_means, one_minus_beta2ts)
+            torch._foreach_add_(rows, row_means)
+            torch._foreach_mul_(cols, factored_beta2ts)
+            torch._foreach_mul_(col_means, one_minus_beta2ts)
+            torch._foreach_add_(cols, col_means)
+            for i, row, col in zip(factored, rows, cols):
+                self._approx_sq_grad(row, col, updates[i])
+        if len(unfactored) > 0:
+            exp_avg_sqs = [states[i]["exp_avg_sq"] for i in unfactored]
+            unfactored_beta2ts = [beta2ts[i] for i in unfactored]
+            torch._foreach_mul_(exp_avg_sqs, unfactored_beta2ts)
+            scaled = torch._foreach_mul([updates[i] for i in unfactored], [1.0 - b for b in unfactored_beta2ts])
+            torch._foreach_add_(exp_avg_sqs, scaled)
+            rsqrts = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_reciprocal_(rsqrts)
+            for i, rsqrt in zip(unfactored, rsqrts):
+                updates[i] = rsqrt
+        torch._foreach_mul_(updates, grads)
+
+        update_rms = torch.stack(torch._foreach_norm(updates)).div_(numels_sqrt)
+        clip = update_rms.div_(group["clip_threshold"]).clamp_(min=1.0)
+        torch._foreach_div_(updates, clip.unbind())
+        torch._foreach_mul_(updates, lrs)
+
+        if group["beta1"] is not None:
+            exp_avgs = [state["exp_avg"] for state in states]
+            torch._foreach_mul_(exp_avgs, group["beta1"])
+            torch._foreach_add_(exp_avgs, updates, alpha=1 - group["beta1"])
+            updates = exp_avgs
+
+        if group["weight_decay"] != 0:
+            if group["scale_parameter"]:
+                decays = torch._foreach_mul(lrs, -group["weight_decay"])
+                torch._foreach_add_(decays, 1.0)
+            else:
+                decays = [1.0 - group["weight_decay"] * lr for lr in lrs]
+            torch._foreach_mul_(params, decays)
+
+        torch._foreach_sub_(params, updates)
+
+
 def warmup_split(max_steps: int, warmup_factor: float) -> tuple[int, int]:
     warmup_steps = int(math.ceil(max_steps * warmup_factor))
     return warmup_steps, max(max_steps - warmup_steps, 1)
@@ -262,7 +379,8 @@ def configure_optimizers(model: GroupedModel, config: OptimizerConfig) -> Optimi
         weight_decay=weight_decay,
         scale_parameter=True,
         relative_step=False,
-        warmup_init=False
+        warmup_init=False,
+        foreach=config.foreach
     )
     warmup_steps, scheduler_steps = warmup_split(config.max_steps, config.warmup_factor)
     if config.lr_scheduler == "cosine":
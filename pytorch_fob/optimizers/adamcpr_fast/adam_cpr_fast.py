@@ -113,7 +113,8 @@ class AdamCPRfast(Optimizer):
                  foreach: Optional[bool] = None,
                  maximize: bool = False,
                  capturable: bool = False,
-                 differentiable: bool = False):
+                 differentiable: bool = False,
+                 batched_cpr: bool = False):
         if not 0.0 <= lr:
             raise ValueError(f"Invalid learning rate: {lr}")
         if isinstance(lr, Tensor) and foreach and not capturable:
@@ -134,6 +135,8 @@ class AdamCPRfast(Optimizer):
 
         if self.kappa_init_method not in ['warm_start', 'uniform', 'dependent', 'inflection_point']:
             raise ValueError(f"Invalid kappa_init_method: {kappa_init_method}")
+        if batched_cpr and self.kappa_init_method == 'inflection_point':
+            raise ValueError("kappa_init_method 'inflection_point' is not supported with batched_cpr=True")
         if self.kappa_init_method == "warm_start":
             self.warm_start = kappa_init_param
         elif self.kappa_init_method == 'inflection_point':
@@ -148,7 +151,7 @@ class AdamCPRfast(Optimizer):
                         weight_decay=weight_decay, kappa_update=kappa_update,
                         amsgrad=amsgrad,
                         maximize=maximize, foreach=foreach, capturable=capturable,
-                        differentiable=differentiable)
+                        differentiable=differentiable, batched_cpr=batched_cpr)
         super().__init__(params, defaults)
 
 
@@ -160,6 +163,7 @@ class AdamCPRfast(Optimizer):
             group.setdefault('foreach', None)
             group.setdefault('capturable', False)
             group.setdefault('differentiable', False)
+            group.setdefault('batched_cpr', False)
             state_values = list(self.state.values())
             step_is_tensor = (len(state_values) != 0) and torch.is_tensor(state_values[0]['step'])
             if not step_is_tensor:
@@ -224,15 +228,16 @@ class AdamCPRfast(Optimizer):
                     elif self.kappa_init_method == 'dependent':
                         if self.reg_function == 'std':
                             state["kappa"] = self.kappa_init_param * torch.std(p).detach()
+                        # multiplied in double precision like the python float, but without `.item()`
                         elif self.reg_function == 'l2':
-                            kappa = self.kappa_init_param * p.square().mean().detach().item()
-                            state["kappa"] = torch.tensor([kappa], dtype=torch.float, device=p.device)
+                            kappa = self.kappa_init_param * p.square().mean().detach().double()
+                            state["kappa"] = kappa.float().reshape(1)
                         elif self.reg_function == 'l1':
-                            kappa = self.kappa_init_param * p.abs().mean().detach().item()
-                            state["kappa"] = torch.tensor([kappa], dtype=torch.float, device=p.device)
+                            kappa = self.kappa_init_param * p.abs().mean().detach().double()
+                            state["kappa"] = kappa.float().reshape(1)
                         elif self.reg_function == 'huber':
-                            kappa = self.kappa_init_param * torch.where(p.abs() < 1, 0.5 * p.square(), p.abs() - 0.5).mean().detach().item()
-                            state["kappa"] = torch.tensor([kappa], dtype=torch.float, device=p.device)
+                            kappa = self.kappa_init_param * torch.where(p.abs() < 1, 0.5 * p.square(), p.abs() - 0.5).mean().detach().double()
+                            state["kappa"] = kappa.float().reshape(1)
 
 
                 exp_avgs.append(state['exp_avg'])
@@ -322,6 +327,7 @@ class AdamCPRfast(Optimizer):
                 foreach=group['foreach'],
                 capturable=group['capturable'],
                 differentiable=group['differentiable'],
+                batched_cpr=group['batched_cpr'],
                 grad_scale=getattr(self, "grad_scale", None),
                 found_inf=getattr(self, "found_inf", None),
             )
@@ -344,6 +350,7 @@ def adam_cpr(params: List[Tensor],
          foreach: Optional[bool] = None,
          capturable: bool = False,
          differentiable: bool = False,
+         batched_cpr: bool = False,
          grad_scale: Optional[Tensor] = None,
          found_inf: Optional[Tensor] = None,
          *,
@@ -395,7 +402,8 @@ def adam_cpr(params: List[Tensor],
          beta1=beta1,
          beta2=beta2,
          lr=lr,
-         weight_decay=weight_decay,
+         # with batched_cpr the regularization of all tensors is done at once after the adam update
+         weight_decay=0.0 if batched_cpr else weight_decay,
          warm_start=warm_start,
          reg_function=reg_function,
          kappa_init_method=kappa_init_method,
@@ -406,6 +414,16 @@ def adam_cpr(params: List[Tensor],
          grad_scale=grad_scale,
          found_inf=found_inf)
 
+    if batched_cpr and weight_decay == 1.0:
+        _batched_cpr(params,
+                     lagmuls,
+                     kappas,
+                     kappa_updates,
+                     state_steps,
+                     warm_start=warm_start,
+                     reg_function=reg_function,
+                     kappa_init_method=kappa_init_method)
+
 
 @torch.jit.script
 def l2_update(param, lagmul, kappa, kappa_update):
@@ -474,6 +492,95 @@ def huber_update(param, lagmul, kappa, kappa_update):
     param.addcmul_(grad_huber, lagmul, value=-1)
 
 
+def _std_grad(param: Tensor, std_dev: Tensor) -> Tensor:
+    """gradient of the standard deviation as computed in `std_update`"""
+    n = param.numel()
+    norm_param = param.sub(param.mean())
+    grad_std_dev = norm_param.mul_(2).sub_(2 * norm_param.mean()).div_(n - 1)
+    return grad_std_dev.div_(std_dev * 2)
+
+
+def _batched_cpr(params: List[Tensor],
+                 lagmuls: List[Tensor],
+                 kappas: List[Tensor],
+                 kappa_updates: List[Tensor],
+                 state_steps: List[Tensor],
+                 *,
+                 warm_start: int,
+                 reg_function: str,
+                 kappa_init_method: str):
+    """
+    Constrained parameter regularization of all tensors at once, after the adam update.
+    Constraint values, lagrange multiplier updates and the warm start of kappa are computed with foreach ops
+    over the tensor list. Instead of branching on the step on the host, the steps are turned into masks,
+    so the update needs no `.item()` and can be captured by CUDA graphs (`capturable=True`) or `torch.compile`.
+    Gives the same results as the per tensor updates of `_single_tensor_adam`.
+    """
+    if len(params) == 0:
+        return
+
+    if kappa_init_method == 'inflection_point':
+        raise ValueError("kappa_init_method 'inflection_point' is not supported with batched_cpr=True")
+
+    grouped_tensors = Optimizer._group_tensors_by_device_and_dtype(
+        [params, lagmuls, kappas, kappa_updates, state_steps])
+    for ((
+        device_params,
+        device_lagmuls,
+        device_kappas,
+        device_kappa_updates,
+        device_state_steps,
+    ), _) in grouped_tensors.values():
+
+        device_params = [torch.view_as_real(x) if torch.is_complex(x) else x for x in device_params]
+        device = device_params[0].device
+
+        # regularization of each tensor (summed over its elements) and the gradient to scale with the lagmul
+        ns = [device_param.numel() for device_param in device_params]
+        if reg_function == 'l2':
+            regs = [square_param.sum() for square_param in torch._foreach_mul(device_params, device_params)]
+            reg_grads, reg_grad_value = device_params, -2.
+        elif reg_function == 'l1':
+            regs = [abs_param.sum() for abs_param in torch._foreach_abs(device_params)]
+            reg_grads, reg_grad_value = torch._foreach_sign(device_params), -1.
+        elif reg_function == 'huber':
+            abs_params = torch._foreach_abs(device_params)
+            huber_idxs = [abs_param < 1 for abs_param in abs_params]
+            regs = [torch.where(huber_idx, 0.5 * device_param.square(), abs_param - 0.5).sum()
+                    for device_param, abs_param, huber_idx in zip(device_params, abs_params, huber_idxs)]
+            reg_grads = [torch.where(huber_idx, device_param, device_param.sign())
+                         for device_param, huber_idx in zip(device_params, huber_idxs)]
+            reg_grad_value = -1.
+        elif reg_function == 'std':
+            # the constraint is on the standard deviation itself, not scaled by the number of elements
+            regs = [device_param.std() for device_param in device_params]
+            reg_grads = [_std_grad(device_param, std_dev) for device_param, std_dev in zip(device_params, regs)]
+            reg_grad_value = -1.
+            ns = [1] * len(device_params)
+        else:
+            raise ValueError(f"Unsupported regularization function: {reg_function}")
+
+        # tensors past the warm start are regularized, kappa is initialized at the warm start
+        steps = torch.stack(device_state_steps).to(device, non_blocking=True)
+        regularize = steps.gt(warm_start).unbind()
+
+        constraints = torch._foreach_sub([reg.unsqueeze(0) for reg in regs], torch._foreach_mul(device_kappas, ns))
+        torch._foreach_mul_(constraints, torch._foreach_div(device_kappa_updates, ns))
+        # selected instead of multiplied with the mask, in the warm start the constraint and the gradient
+        # can be nan (e.g. the std of a constant tensor or of a single element) and must not change anything
+        constraints = [torch.where(mask, constraint, 0.) for mask, constraint in zip(regularize, constraints)]
+        torch._foreach_add_(device_lagmuls, constraints)
+        torch._foreach_clamp_min_(device_lagmuls, 0.)
+        reg_grads = [torch.where(mask, reg_grad, 0.) for mask, reg_grad in zip(regularize, reg_grads)]
+        torch._foreach_addcmul_(device_params, reg_grads, device_lagmuls, reg_grad_value)
+
+        if kappa_init_method == 'warm_start':
+            initialize = steps.eq(warm_start).unbind()
+            mean_regs = torch._foreach_div(regs, ns)
+            mean_regs = [torch.where(mask, mean_reg, 0.) for mask, mean_reg in zip(initialize, mean_regs)]
+            torch._foreach_add_(device_kappas, mean_regs)
+
+
 def _single_tensor_adam(params: List[Tensor],
                         grads: List[Tensor],
                         exp_avgs: List[Tensor],
@@ -61,7 +61,8 @@ def configure_optimizers(model: GroupedModel, config: OptimizerConfig) -> Optimi
         kappa_init_param=kappa_init_param,
         kappa_init_method=kappa_init_method,
         reg_function=config.reg_function,
-        kappa_update=config.kappa_update
+        kappa_update=config.kappa_update,
+        batched_cpr=config.batched_cpr
     )
     scheduler = cosine_warmup(step_hint, lr_warmup_steps, config.eta_min_factor * lr, optimizer)
     return {
@@ -1 +1 @@
-from .tasks import task_names, task_path, import_task, TaskModel, TaskDataModule
+from .tasks import task_names, task_path, import_task, TaskModel, TaskDataModule, TensorBatchLoader, EpochBatchSampler
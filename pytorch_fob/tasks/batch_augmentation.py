@@ -0,0 +1,297 @@
+import math
+from typing import Any, Optional, Sequence
+import torch
+import torch.nn.functional as F
+from torchvision.transforms.v2 import functional as TF
+
+
+TRIVIAL_AUGMENT_OPS = [
+    "Identity", "ShearX", "ShearY", "TranslateX", "TranslateY", "Rotate", "Brightness",
+    "Color", "Contrast", "Sharpness", "Posterize", "Solarize", "AutoContrast", "Equalize"
+]
+TRIVIAL_AUGMENT_BINS = 31
+
+
+def _reflect_index(index: torch.Tensor, size: int, padding_mode: str) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Maps indices into an image padded on both sides to indices into the unpadded image.
+    Returns the indices and a mask of the positions which lie inside the image (only used by 'constant' padding).
+    """
+    inside = (index >= 0) & (index < size)
+    if padding_mode == "constant":
+        return index.clamp(0, size - 1), inside
+    if padding_mode == "edge":
+        return index.clamp(0, size - 1), torch.ones_like(inside)
+    if padding_mode == "reflect":
+        index = index.abs()
+        return torch.where(index > size - 1, 2 * (size - 1) - index, index), torch.ones_like(inside)
+    if padding_mode == "symmetric":
+        index = torch.where(index < 0, -index - 1, index)
+        return torch.where(index > size - 1, 2 * size - 1 - index, index), torch.ones_like(inside)
+    raise ValueError(f"unknown padding_mode '{padding_mode}'")
+
+
+def random_crop_and_flip(
+        images: torch.Tensor,
+        size: Optional[int | Sequence[int]],
+        padding: int = 0,
+        padding_mode: str = "constant",
+        flip_p: float = 0.0
+    ) -> torch.Tensor:
+    """
+    Pads, crops and horizontally flips each image of a NCHW batch with its own random parameters,
+    all in a single gather without materializing the padded batch.
+    """
+    n, _, h, w = images.shape
+    if size is None:
+        size_h, size_w = h, w
+    else:
+        size_h, size_w = (size, size) if isinstance(size, int) else size
+    device = images.device
+    top = torch.randint(0, h + 2 * padding - size_h + 1, (n, 1), device=device)
+    left = torch.randint(0, w + 2 * padding - size_w + 1, (n, 1), device=device)
+    cols = torch.arange(size_w, device=device).expand(n, size_w)
+    flip = torch.rand(n, 1, device=device) < flip_p
+    cols = torch.where(flip, size_w - 1 - cols, cols)
+    rows, rows_inside = _reflect_index(top + torch.arange(size_h, device=device) - padding, h, padding_mode)
+    cols, cols_inside = _reflect_index(left + cols - padding, w, padding_mode)
+    batch = torch.arange(n, device=device)[:, None, None]
+    crops = images.permute(0, 2, 3, 1)[batch, rows[:, :, None], cols[:, None, :]]
+    if padding_mode == "constant":
+        crops = crops * (rows_inside[:, :, None] & cols_inside[:, None, :])[..., None].to(crops.dtype)
+    return crops.permute(0, 3, 1, 2).contiguous()
+
+
+def _random_resized_crop_boxes(
+        n: int,
+        height: int,
+        width: int,
+        scale: Sequence[float],
+        ratio: Sequence[float],
+        device: torch.device,
+        attempts: int = 10
+    ) -> torch.Tensor:
+    """
+    Per sample (top, left, height, width) of `torchvision.transforms.v2.RandomResizedCrop`:
+    the first of `attempts` random boxes which fits into the image, else the central crop.
+    """
+    area = height * width
+    target_area = area * torch.empty(n, attempts, device=device).uniform_(scale[0], scale[1])
+    log_ratio = torch.empty(n, attempts, device=device).uniform_(math.log(ratio[0]), math.log(ratio[1]))
+    aspect_ratio = torch.exp(log_ratio)
+    w = torch.sqrt(target_area * aspect_ratio).round().long()
+    h = torch.sqrt(target_area / aspect_ratio).round().long()
+    fits = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+    first = fits.int().argmax(dim=1, keepdim=True)
+    w = w.gather(1, first).squeeze(1)
+    h = h.gather(1, first).squeeze(1)
+    top = (torch.rand(n, device=device) * (height - h + 1)).long()
+    left = (torch.rand(n, device=device) * (width - w + 1)).long()
+    # fallback to the central crop with the aspect ratio clamped to `ratio`
+    in_ratio = width / height
+    if in_ratio < min(ratio):
+        fallback_w, fallback_h = width, int(round(width / min(ratio)))
+    elif in_ratio > max(ratio):
+        fallback_w, fallback_h = int(round(height * max(ratio))), height
+    else:
+        fallback_w, fallback_h = width, height
+    fallback = ~fits.any(dim=1)
+    boxes = torch.stack([top, left, h, w], dim=1)
+    boxes[fallback] = torch.tensor(
+        [(height - fallback_h) // 2, (width - fallback_w) // 2, fallback_h, fallback_w], device=device
+    )
+    return boxes
+
+
+def random_resized_crop_and_flip(
+        images: torch.Tensor,
+        size: int | Sequence[int],
+        scale: Sequence[float] = (0.08, 1.0),
+        ratio: Sequence[float] = (3 / 4, 4 / 3),
+        flip_p: float = 0.0,
+        labels: Optional[torch.Tensor] = None
+    ) -> tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    Batched `RandomResizedCrop` (bilinear) and `RandomHorizontalFlip` of a uint8 NCHW batch
+    with per sample random parameters, each image is resampled once.
+    The NHW `labels` (e.g. segmentation maps) get the same crop and flip with nearest interpolation.
+    """
+    n, _, h, w = images.shape
+    size_h, size_w = (size, size) if isinstance(size, int) else size
+    device = images.device
+    top, left, crop_h, crop_w = _random_resized_crop_boxes(n, h, w, scale, ratio, device).float().unbind(1)
+    flip = torch.where(torch.rand(n, device=device) < flip_p, -1.0, 1.0)
+    # maps the normalized output coordinates into the box, see align_corners=False
+    theta = torch.zeros(n, 2, 3, device=device)
+    theta[:, 0, 0] = flip * crop_w / w
+    theta[:, 0, 2] = (2 * left + crop_w) / w - 1
+    theta[:, 1, 1] = crop_h / h
+    theta[:, 1, 2] = (2 * top + crop_h) / h - 1
+    grid = F.affine_grid(theta, [n, 1, size_h, size_w], align_corners=False)
+    # only sample from inside the box like resizing the cropped image, i.e. between its first and last pixel centers
+    low = torch.stack([(2 * left + 1) / w - 1, (2 * top + 1) / h - 1], dim=1)[:, None, None, :]
+    high = torch.stack([(2 * (left + crop_w) - 1) / w - 1, (2 * (top + crop_h) - 1) / h - 1], dim=1)[:, None, None, :]
+    grid = torch.maximum(torch.minimum(grid, high), low)
+    crops = F.grid_sample(images.float(), grid, mode="bilinear", padding_mode="border", align_corners=False)
+    crops = crops.round_().clamp_(0, 255).to(images.dtype)
+    if labels is None:
+        return crops, None
+    label_crops = F.grid_sample(labels[:, None].float(), grid, mode="nearest", padding_mode="border",
+                                align_corners=False)
+    return crops, label_crops[:, 0].to(labels.dtype)
+
+
+def _affine(images: torch.Tensor, theta: torch.Tensor) -> torch.Tensor:
+    """bilinear affine warp of uint8 images, `theta` maps normalized output to input coordinates"""
+    grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+    warped = F.grid_sample(images.float(), grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+    return warped.round_().clamp_(0, 255).to(torch.uint8)
+
+
+def _blend(images: torch.Tensor, degenerate: torch.Tensor, factor: torch.Tensor) -> torch.Tensor:
+    """per sample version of the blend used by the torchvision color ops"""
+    factor = factor.view(-1, 1, 1, 1)
+    return (images.float() * factor + degenerate.float() * (1.0 - factor)).clamp_(0, 255).to(torch.uint8)
+
+
+def _geometric_theta(op: str, magnitude: torch.Tensor, h: int, w: int) -> torch.Tensor:
+    """
+    Inverse affine matrices (in normalized coordinates) of the geometric ops of TrivialAugmentWide.
+    Shears are about the top left corner and rotations about the center as in torchvision.
+    """
+    theta = torch.zeros(len(magnitude), 2, 3, device=magnitude.device)
+    theta[:, 0, 0] = 1.0
+    theta[:, 1, 1] = 1.0
+    if op == "ShearX":
+        theta[:, 0, 1] = magnitude * h / w
+        theta[:, 0, 2] = magnitude * h / w
+    elif op == "ShearY":
+        theta[:, 1, 0] = magnitude * w / h
+        theta[:, 1, 2] = magnitude * w / h
+    elif op == "TranslateX":
+        theta[:, 0, 2] = -2.0 * magnitude.trunc() / w
+    elif op == "TranslateY":
+        theta[:, 1, 2] = -2.0 * magnitude.trunc() / h
+    elif op == "Rotate":
+        angle = torch.deg2rad(magnitude)
+        theta[:, 0, 0] = torch.cos(angle)
+        theta[:, 0, 1] = -torch.sin(angle) * h / w
+        theta[:, 1, 0] = torch.sin(angle) * w / h
+        theta[:, 1, 1] = torch.cos(angle)
+    return theta
+
+
+def _apply_op(images: torch.Tensor, op: str, magnitude: torch.Tensor) -> torch.Tensor:
+    h, w = images.shape[-2:]
+    if op in ["ShearX", "ShearY", "TranslateX", "TranslateY", "Rotate"]:
+        return _affine(images, _geometric_theta(op, magnitude, h, w))
+    if op == "Brightness":
+        return _blend(images, torch.zeros_like(images), 1.0 + magnitude)
+    if op == "Color":
+        return _blend(images, TF.rgb_to_grayscale(images, num_output_channels=3), 1.0 + magnitude)
+    if op == "Contrast":
+        mean = TF.rgb_to_grayscale(images).float().mean(dim=(-3, -2, -1), keepdim=True)
+        return _blend(images, mean, 1.0 + magnitude)
+    if op == "Sharpness":
+        return _blend(images, TF.adjust_sharpness(images, 0.0), 1.0 + magnitude)
+    if op == "Posterize":
+        bits = magnitude.to(torch.int64).view(-1, 1, 1, 1)
+        mask = (((1 << bits) - 1) << (8 - bits)).to(torch.uint8)
+        return images & mask
+    if op == "Solarize":
+        return torch.where(images >= magnitude.view(-1, 1, 1, 1), 255 - images, images)
+    if op == "AutoContrast":
+        return TF.autocontrast(images)
+    if op == "Equalize":
+        return TF.equalize(images)
+    return images
+
+
+def trivial_augment_wide(images: torch.Tensor) -> torch.Tensor:
+    """
+    Batched version of `torchvision.transforms.v2.TrivialAugmentWide` (bilinear interpolation) for uint8 NCHW images.
+    Each image gets its own random op, magnitude and sign; all images with the same op are processed together.
+    """
+    n = images.shape[0]
+    device = images.device
+    ops = torch.randint(len(TRIVIAL_AUGMENT_OPS), (n,), device=device)
+    bins = torch.randint(TRIVIAL_AUGMENT_BINS, (n,), device=device)
+    signs = torch.where(torch.rand(n, device=device) < 0.5, 1.0, -1.0)
+    unit = torch.linspace(0.0, 1.0, TRIVIAL_AUGMENT_BINS, device=device)[bins]
+    magnitudes = {
+        "ShearX": 0.99 * unit * signs,
+        "ShearY": 0.99 * unit * signs,
+        "TranslateX": 32.0 * unit * signs,
+        "TranslateY": 32.0 * unit * signs,
+        "Rotate": 135.0 * unit * signs,
+        "Brightness": 0.99 * unit * signs,
+        "Color": 0.99 * unit * signs,
+        "Contrast": 0.99 * unit * signs,
+        "Sharpness": 0.99 * unit * signs,
+        "Posterize": 8 - (bins / ((TRIVIAL_AUGMENT_BINS - 1) / 6)).round(),
+        "Solarize": 255.0 * (1.0 - unit),
+    }
+    out = images.clone()
+    for i, op in enumerate(TRIVIAL_AUGMENT_OPS):
+        if op == "Identity":
+            continue
+        idx = (ops == i).nonzero().squeeze(1)
+        if idx.numel() == 0:
+            continue
+        magnitude = magnitudes[op][idx] if op in magnitudes else torch.zeros(len(idx), device=device)
+        out[idx] = _apply_op(images[idx], op, magnitude)
+    return out
+
+
+class BatchAugmentation():
+    """
+    Applies the training augmentations of the image classification tasks to whole uint8 batches
+    with per sample random parameters, on whatever device the batch is on (e.g. in `on_after_batch_transfer`).
+    Returns normalized float images like the per sample torchvision pipeline.
+    """
+    def __init__(
+            self,
+            mean: Sequence[float],
+            std: Sequence[float],
+            crop_size: Optional[int | Sequence[int]] = None,
+            crop_padding: int = 0,
+            crop_padding_mode: str = "constant",
+            flip_p: float = 0.0,
+            trivial_augment: bool = False
+            ) -> None:
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.crop_size = crop_size
+        self.crop_padding = crop_padding
+        self.crop_padding_mode = crop_padding_mode
+        self.flip_p = flip_p
+        self.trivial_augment = trivial_augment
+
+    @classmethod
+    def from_config(cls, train_transforms: dict[str, Any], mean: Sequence[float], std: Sequence[float]):
+        random_crop = train_transforms["random_crop"]
+        horizontal_flip = train_transforms["horizontal_flip"]
+        return cls(
+            mean,
+            std,
+            crop_size=random_crop["size"] if random_crop["use"] else None,
+            crop_padding=random_crop["padding"] if random_crop["use"] else 0,
+            crop_padding_mode=random_crop["padding_mode"],
+            flip_p=horizontal_flip["p"] if horizontal_flip["use"] else 0.0,
+            trivial_augment=train_transforms["trivial_augment"]["use"]
+        )
+
+    @torch.no_grad()
+    def train(self, images: torch.Tensor) -> torch.Tensor:
+        if self.crop_size is not None or self.flip_p > 0:
+            images = random_crop_and_flip(images, self.crop_size, self.crop_padding, self.crop_padding_mode, self.flip_p)
+        if self.trivial_augment:
+            images = trivial_augment_wide(images)
+        return self.normalize(images)
+
+    @torch.no_grad()
+    def normalize(self, images: torch.Tensor) -> torch.Tensor:
+        mean = self.mean.to(images.device)
+        std = self.std.to(images.device)
+        return (images.float() / 255.0 - mean) / std
+
@@ -1,26 +1,81 @@
-from typing import Any
+import json
+from functools import partial
+from pathlib import Path
+from typing import Any, Optional
 import numpy as np
-import tensorflow_datasets as tfds
 import torch
 from torch.utils.data import Dataset
 from torchvision.transforms import v2
 from transformers.utils import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from pytorch_fob.tasks import TaskDataModule
+from pytorch_fob.tasks.batch_augmentation import BatchAugmentation
+from pytorch_fob.tasks.synthetic import SyntheticDataset, classification_sample
 from pytorch_fob.engine.configs import TaskConfig
+from pytorch_fob.engine.utils import log_info
+
+
+TFDS_NAME = "imagenet_resized/64x64"
+SPLITS = ["train", "validation"]
+IMAGE_SHAPE = (64, 64, 3)
+NUM_CLASSES = 1000
+SPLIT_SIZES = {"train": 1_281_167, "validation": 50_000}
+
+
+def pack_split(data_dir: Path, cache_dir: Path, split: str, chunk_size: int = 10_000):
+    """
+    Decodes all images of a split once and writes them into a single uint8 array of shape N x 64 x 64 x 3
+    (`<split>_images.npy`) and the labels into `<split>_labels.npy`.
+    """
+    import tensorflow_datasets as tfds  # only needed to build the cache
+    ds = tfds.data_source(TFDS_NAME, split=split, data_dir=data_dir, download=False)
+    n = len(ds)
+    tmp_images = cache_dir / f"{split}_images.npy.tmp"
+    images = np.lib.format.open_memmap(tmp_images, mode="w+", dtype=np.uint8, shape=(n, *IMAGE_SHAPE))
+    labels = np.empty(n, dtype=np.int64)
+    for start in range(0, n, chunk_size):
+        log_info(f"packing {split} images {start}/{n}...")
+        records = ds.__getitems__(range(start, min(start + chunk_size, n)))
+        for i, record in enumerate(records, start=start):
+            images[i] = record["image"]
+            labels[i] = record["label"]
+    images.flush()
+    del images
+    np.save(cache_dir / f"{split}_labels.npy", labels)
+    tmp_images.rename(cache_dir / f"{split}_images.npy")
+
+
+def synthetic_sample(generator, index: int, transforms) -> dict[str, Any]:
+    image, label = classification_sample(generator, index, IMAGE_SHAPE, NUM_CLASSES, transforms)
+    return {"image": image, "label": label}
 
 
 class Imagenet64Dataset(Dataset):
-    def __init__(self, data_source) -> None:
+    """
+    Serves images from the packed uint8 array without decoding or copying them.
+    The array is mapped copy-on-write, so the transforms get a writable view of the file.
+    """
+    def __init__(self, cache_dir: Path, split: str) -> None:
         super().__init__()
-        self.data = data_source
+        self.images_file = cache_dir / f"{split}_images.npy"
+        self.labels = np.load(cache_dir / f"{split}_labels.npy")
+        self._images: Optional[np.ndarray] = None
         self.transforms: Any
 
     def __len__(self) -> int:
-        return len(self.data)
+        return len(self.labels)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # each dataloader worker maps the file on its own
+        return self.__dict__ | {"_images": None}
+
+    @property
+    def images(self) -> np.ndarray:
+        if self._images is None:
+            self._images = np.load(self.images_file, mmap_mode="c")
+        return self._images
 
     def __getitem__(self, index):
-        img = np.array(self.data[index]["image"])  # need to make copy because original is not writable
-        return {"image": self.transforms(img), "label": self.data[index]["label"]}
+        return {"image": self.transforms(self.images[index]), "label": int(self.labels[index])}
 
     def set_transform(self, transforms):
         self.transforms = transforms
@@ -29,6 +84,7 @@ class Imagenet64Dataset(Dataset):
 class ImagenetDataModule(TaskDataModule):
     def __init__(self, config: TaskConfig):
         super().__init__(config)
+        self.cache_dir = self.data_dir / "imagenet_resized_64x64_uint8"
 
         self.train_transforms = self._get_train_transforms(config)
 
@@ -38,6 +94,21 @@ class ImagenetDataModule(TaskDataModule):
             v2.Normalize(IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD),
             v2.ToPureTensor()
         ])
+        self.batch_augmentation = None
+        if config.get("batch_augmentation", False):
+            # the dataloader only converts to uint8 tensors, see on_after_batch_transfer
+            self.batch_augmentation = BatchAugmentation.from_config(
+                config.train_transforms, IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+            )
+            self.train_transforms = v2.Compose([v2.ToImage(), v2.ToPureTensor()])
+            self.val_transforms = self.train_transforms
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.batch_augmentation is None:
+            return batch
+        if self.trainer is not None and self.trainer.training:
+            return batch | {"image": self.batch_augmentation.train(batch["image"])}
+        return batch | {"image": self.batch_augmentation.normalize(batch["image"])}
 
     def _get_train_transforms(self, config: TaskConfig):
         # reading setting
@@ -71,13 +142,26 @@ class ImagenetDataModule(TaskDataModule):
         return transforms
 
     def prepare_data(self):
-        # download
-        # TODO: find a solution to remove tensorflow from requirements as it is only needed for the download
-        tfds.data_source("imagenet_resized/64x64", data_dir=self.data_dir, download=True)
+        if self.synthetic or (self.cache_dir / "info.json").exists():
+            return
+        # tensorflow is only needed once to download the dataset and build the cache
+        import tensorflow_datasets as tfds
+        tfds.data_source(TFDS_NAME, data_dir=self.data_dir, download=True)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        info = {}
+        for split in SPLITS:
+            pack_split(self.data_dir, self.cache_dir, split)
+            info[f"{split}_data_len"] = len(np.load(self.cache_dir / f"{split}_labels.npy", mmap_mode="r"))
+        with open(self.cache_dir / "info.json", "w", encoding="utf8") as f:
+            json.dump(info, f, indent=4)
+        log_info("imagenet64 cache written")
 
     def setup(self, stage: str):
         """setup is called from every process across all the nodes. Setting state here is recommended.
         """
+        if self.synthetic:
+            self.setup_synthetic(stage)
+            return
         if stage == "fit":
             self.data_train = self._load_dataset("train")
             self.data_val = self._load_dataset("validation")
@@ -94,11 +178,10 @@ class ImagenetDataModule(TaskDataModule):
             self.data_predict.set_transform(self.val_transforms)
 
     def _load_dataset(self, split: str) -> Imagenet64Dataset:
-        ds = tfds.data_source(
-            "imagenet_resized/64x64",
-            split=split,
-            data_dir=self.data_dir,
-            download=False
-        )
-        rds = Imagenet64Dataset(ds)
-        return rds
+        return Imagenet64Dataset(self.cache_dir, split)
+
+    def synthetic_dataset(self, split: str):
+        # like the real data, the test set is the validation split
+        split = "train" if split == "train" else "validation"
+        transforms = self.train_transforms if split == "train" else self.val_transforms
+        return SyntheticDataset(SPLIT_SIZES[split], partial(synthetic_sample, transforms=transforms), split)
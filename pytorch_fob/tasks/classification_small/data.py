@@ -1,7 +1,10 @@
+from functools import partial
 import torch
 from torchvision.datasets import CIFAR100
 from torchvision.transforms import v2
 from pytorch_fob.tasks import TaskDataModule
+from pytorch_fob.tasks.batch_augmentation import BatchAugmentation
+from pytorch_fob.tasks.synthetic import SyntheticDataset, classification_sample
 from pytorch_fob.engine.configs import TaskConfig
 
 
@@ -39,8 +42,29 @@ class CIFAR100DataModule(TaskDataModule):
             v2.Normalize(cifar100_mean, cifar100_stddev),
             v2.ToPureTensor()
         ])
+        self.batch_augmentation = None
+        if config.get("batch_augmentation", False):
+            # the dataloader only converts to uint8 tensors, see on_after_batch_transfer
+            self.batch_augmentation = BatchAugmentation.from_config(
+                config.train_transforms, cifar100_mean, cifar100_stddev
+            )
+            self.train_transforms = v2.Compose([v2.ToImage(), v2.ToPureTensor()])
+            self.val_transforms = self.train_transforms
+        elif self.tensor_loader is not None:
+            raise ValueError("tensor_loader keeps the transformed images in memory, "
+                             "it requires batch_augmentation for the random train transforms")
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.batch_augmentation is None:
+            return batch
+        imgs, labels = batch
+        if self.trainer is not None and self.trainer.training:
+            return self.batch_augmentation.train(imgs), labels
+        return self.batch_augmentation.normalize(imgs), labels
 
     def prepare_data(self):
+        if self.synthetic:
+            return
         # download
         CIFAR100(str(self.data_dir), train=True, download=True)
         CIFAR100(str(self.data_dir), train=False, download=True)
@@ -48,6 +72,10 @@ class CIFAR100DataModule(TaskDataModule):
     def setup(self, stage: str):
         """setup is called from every process across all the nodes. Setting state here is recommended.
         """
+        if self.synthetic:
+            self.setup_synthetic(stage)
+            return
+
         if stage == "fit":
             self.data_train = self._get_dataset(train=True)
             self.data_val = self._get_dataset(train=False)
@@ -66,3 +94,12 @@ class CIFAR100DataModule(TaskDataModule):
             return CIFAR100(str(self.data_dir), train=True, transform=self.train_transforms)
         else:
             return CIFAR100(str(self.data_dir), train=False, transform=self.val_transforms)
+
+    def synthetic_dataset(self, split: str):
+        train = split == "train"
+        return SyntheticDataset(
+            50000 if train else 10000,
+            partial(classification_sample, shape=(32, 32, 3), num_classes=100,
+                    transform=self.train_transforms if train else self.val_transforms),
+            split
+        )
@@ -1,227 +1,307 @@
 """
-COCO evaluator from https://github.com/pytorch/vision/tree/main/references/detection
+COCO bounding box evaluation computing the same values as `COCOeval` of pycocotools
+(see also https://github.com/pytorch/vision/tree/main/references/detection),
+with the matching and accumulation vectorized over all images, categories, area ranges and IoU thresholds.
 """
 
-import copy
-import io
-from contextlib import redirect_stdout
-
 import numpy as np
-import pycocotools.mask as mask_util
 from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
 import torch
-import torch.distributed as dist
-from pytorch_fob.engine.utils import log_info
-
-
-class CocoEvaluator:
-    def __init__(self, coco_gt, iou_types):
-        if not isinstance(iou_types, (list, tuple)):
-            raise TypeError(f"This constructor expects iou_types of type list or tuple, instead  got {type(iou_types)}")
-        coco_gt = copy.deepcopy(coco_gt)
-        self.coco_gt = coco_gt
-
-        self.iou_types = iou_types
-        self.coco_eval = {}
-        for iou_type in iou_types:
-            self.coco_eval[iou_type] = COCOeval(coco_gt, iouType=iou_type)
+from torch import Tensor
+from pytorch_fob.engine.utils import all_gather_cat, log_info
 
-        self.img_ids = []
-        self.eval_imgs = {k: [] for k in iou_types}
 
-    def update(self, predictions):
-        img_ids = list(np.unique(list(predictions.keys())))
-        self.img_ids.extend(img_ids)
+# parameters of COCOeval for iouType="bbox"
+IOU_THRS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+REC_THRS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+MAX_DETS = [1, 10, 100]
+AREA_RNGS = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
+AREA_LBLS = ["all", "small", "medium", "large"]
+# bounds the size of the padded (groups x detections x ground truths) IoU matrices evaluated at once
+CHUNK_ELEMENTS = 2 ** 22
 
-        for iou_type in self.iou_types:
-            results = self.prepare(predictions, iou_type)
-            with redirect_stdout(io.StringIO()):
-                coco_dt = COCO.loadRes(self.coco_gt, results) if results else COCO()
-            coco_eval = self.coco_eval[iou_type]
 
-            coco_eval.cocoDt = coco_dt
-            coco_eval.params.imgIds = list(img_ids)
-            img_ids, eval_imgs = evaluate(coco_eval)
-
-            self.eval_imgs[iou_type].append(eval_imgs)
-
-    def synchronize_between_processes(self):
-        for iou_type in self.iou_types:
-            self.eval_imgs[iou_type] = np.concatenate(self.eval_imgs[iou_type], 2)
-            create_common_coco_eval(self.coco_eval[iou_type], self.img_ids, self.eval_imgs[iou_type])
+class CocoEvaluator:
+    """
+    Buffers the predictions of an epoch as tensors on the device and evaluates them at once.
+    The predictions are gathered from all processes, images seen by more than one process
+    (e.g. padding of the `DistributedSampler`) are only counted once.
+    Every process computes the same `stats` (like `COCOeval.stats`).
+    """
+    def __init__(self, coco_gt: COCO):
+        self.cat_ids = sorted(coco_gt.getCatIds())
+        anns = list(coco_gt.anns.values())
+        self.gt_image_ids = torch.tensor([a["image_id"] for a in anns], dtype=torch.long)
+        self.gt_cat_ids = torch.tensor([a["category_id"] for a in anns], dtype=torch.long)
+        self.gt_boxes = torch.tensor([a["bbox"] for a in anns], dtype=torch.float64).view(-1, 4)
+        self.gt_areas = torch.tensor([a["area"] for a in anns], dtype=torch.float64)
+        self.gt_crowd = torch.tensor([bool(a.get("iscrowd", 0)) for a in anns], dtype=torch.bool)
+        self.stats = np.full(12, -1.0)
+        self.reset()
+
+    def reset(self):
+        self._image_ids: list[Tensor] = []
+        self._num_dets: list[Tensor] = []
+        self._boxes: list[Tensor] = []
+        self._scores: list[Tensor] = []
+        self._labels: list[Tensor] = []
+        self.precision = None
+        self.recall = None
+
+    def update(self, predictions: dict[int, dict[str, Tensor]]):
+        """buffers the XYXY `boxes`, `scores` and `labels` predicted for each image id"""
+        if not predictions:
+            return
+        preds = list(predictions.values())
+        device = preds[0]["boxes"].device
+        self._image_ids.append(torch.tensor(list(predictions.keys()), dtype=torch.long, device=device))
+        self._num_dets.append(torch.tensor([len(p["scores"]) for p in preds], dtype=torch.long, device=device))
+        self._boxes.append(torch.cat([p["boxes"].detach() for p in preds]))
+        self._scores.append(torch.cat([p["scores"].detach() for p in preds]))
+        self._labels.append(torch.cat([p["labels"] for p in preds]))
+
+    def synchronize_between_processes(self, device: torch.device | str = "cpu"):
+        """gathers the buffered predictions of all processes on `device`"""
+        if not self._image_ids:
+            self._image_ids.append(torch.zeros(0, dtype=torch.long))
+            self._num_dets.append(torch.zeros(0, dtype=torch.long))
+            self._boxes.append(torch.zeros(0, 4))
+            self._scores.append(torch.zeros(0))
+            self._labels.append(torch.zeros(0, dtype=torch.long))
+        image_ids, num_dets, boxes, scores, labels = (
+            all_gather_cat(torch.cat(t).to(device))
+            for t in (self._image_ids, self._num_dets, self._boxes, self._scores, self._labels)
+        )
+        # keep the first occurrence of each image
+        first = first_occurrence(image_ids)
+        keep = torch.repeat_interleave(first, num_dets)
+        self._image_ids = [image_ids[first]]
+        self._num_dets = [num_dets[first]]
+        self._boxes = [boxes[keep]]
+        self._scores = [scores[keep]]
+        self._labels = [labels[keep]]
 
     def accumulate(self):
-        for coco_eval in self.coco_eval.values():
-            coco_eval.accumulate()
+        """
+        Like `COCOeval.evaluate` followed by `COCOeval.accumulate` on the synchronized predictions,
+        restricted to the evaluated images.
+        """
+        image_ids = torch.cat(self._image_ids)
+        device = image_ids.device
+        num_dets = torch.cat(self._num_dets)
+        # as in COCO.loadRes: XYWH boxes from the float32 predictions, areas of the boxes
+        boxes = torch.cat(self._boxes).float()
+        boxes = torch.cat([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], dim=1).double()
+        scores = torch.cat(self._scores).double()
+        labels = torch.cat(self._labels).long()
+        images = torch.unique(image_ids)
+        cat_ids = torch.tensor(self.cat_ids, dtype=torch.long, device=device)
+        num_images, num_cats = len(images), len(cat_ids)
+        num_areas, num_thrs, num_max_dets = len(AREA_RNGS), len(IOU_THRS), len(MAX_DETS)
+        self.precision = -np.ones((num_thrs, len(REC_THRS), num_cats, num_areas, num_max_dets))
+        self.recall = -np.ones((num_thrs, num_cats, num_areas, num_max_dets))
+
+        # detections of the evaluated categories, grouped by (image, category), sorted by score within a group
+        det_images = torch.repeat_interleave(image_ids, num_dets)
+        valid = torch.isin(labels, cat_ids)
+        det_group = (
+            torch.searchsorted(images, det_images[valid]) * num_cats
+            + torch.searchsorted(cat_ids, labels[valid])
+        )
+        det_boxes, det_scores = boxes[valid], scores[valid]
+        order = torch.sort(det_scores, descending=True, stable=True).indices
+        order = order[torch.sort(det_group[order], stable=True).indices]
+        det_group, det_boxes, det_scores = det_group[order], det_boxes[order], det_scores[order]
+        det_rank = group_ranks(det_group)
+        top = det_rank < MAX_DETS[-1]
+        det_group, det_boxes, det_scores, det_rank = det_group[top], det_boxes[top], det_scores[top], det_rank[top]
+        det_areas = det_boxes[:, 2] * det_boxes[:, 3]
+
+        # ground truths of the evaluated images and categories, in annotation order within a group
+        gt_image_ids = self.gt_image_ids.to(device)
+        gt_cat_ids = self.gt_cat_ids.to(device)
+        gt_sel = torch.isin(gt_image_ids, images) & torch.isin(gt_cat_ids, cat_ids)
+        gt_group = (
+            torch.searchsorted(images, gt_image_ids[gt_sel]) * num_cats
+            + torch.searchsorted(cat_ids, gt_cat_ids[gt_sel])
+        )
+        order = torch.sort(gt_group, stable=True).indices
+        gt_group = gt_group[order]
+        gt_boxes = self.gt_boxes.to(device)[gt_sel][order]
+        gt_areas = self.gt_areas.to(device)[gt_sel][order]
+        gt_crowd = self.gt_crowd.to(device)[gt_sel][order]
+
+        area_rngs = torch.tensor(AREA_RNGS, dtype=torch.float64, device=device)
+        gt_ignore = gt_crowd | (gt_areas < area_rngs[:, :1]) | (gt_areas > area_rngs[:, 1:])  # areas x gts
+        det_out_of_range = (det_areas < area_rngs[:, :1]) | (det_areas > area_rngs[:, 1:])  # areas x dets
+        matched, matched_ignored = match_detections(
+            det_group, det_boxes, gt_group, gt_boxes, gt_crowd, gt_ignore, num_images * num_cats
+        )
+        det_ignore = matched_ignored | (~matched & det_out_of_range[:, None])
+
+        det_cat = det_group % num_cats
+        gt_cat = gt_group % num_cats
+        # within a category: by score, then by image and rank like the concatenation of COCOeval
+        order = torch.sort(det_scores, descending=True, stable=True).indices
+        order = order[torch.sort(det_cat[order], stable=True).indices]
+        det_cat, det_rank = det_cat[order], det_rank[order]
+        matched, det_ignore = matched[..., order], det_ignore[..., order]
+        cat_starts = torch.searchsorted(det_cat, torch.arange(num_cats + 1, device=device)).tolist()
+        max_dets = torch.tensor(MAX_DETS, device=device)
+        rec_thrs = torch.from_numpy(REC_THRS).to(device)
+        num_gt = torch.stack([torch.bincount(gt_cat[~ig], minlength=num_cats) for ig in gt_ignore]).tolist()
+        for k in range(num_cats):
+            start, stop = cat_starts[k], cat_starts[k + 1]
+            # detections beyond the maximum number of an image are neutral, they change neither recall nor precision
+            in_max_dets = det_rank[start:stop] < max_dets[:, None, None]  # max_dets x 1 x dets
+            for a in range(num_areas):
+                npig = num_gt[a][k]
+                if npig == 0:
+                    continue
+                counted = ~det_ignore[a, :, start:stop] & in_max_dets  # max_dets x thrs x dets
+                tps = counted & matched[a, :, start:stop]
+                fps = counted & ~matched[a, :, start:stop]
+                tp_sum = torch.cumsum(tps, dim=-1, dtype=torch.float64)
+                fp_sum = torch.cumsum(fps, dim=-1, dtype=torch.float64)
+                nd = stop - start
+                rc = tp_sum / npig
+                pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                if nd:
+                    self.recall[:, k, a, :] = rc[..., -1].T.cpu().numpy()
+                else:
+                    self.recall[:, k, a, :] = 0
+                    self.precision[:, :, k, a, :] = 0
+                    continue
+                # interpolated precision: maximum precision at any higher recall
+                pr = torch.flip(torch.cummax(torch.flip(pr, [-1]), dim=-1).values, [-1])
+                inds = torch.searchsorted(rc.contiguous(), rec_thrs.expand(*rc.shape[:-1], -1).contiguous(), side="left")
+                q = torch.where(inds < nd, torch.gather(pr, -1, inds.clamp(max=nd - 1)), 0.0)
+                self.precision[:, :, k, a, :] = q.permute(1, 2, 0).cpu().numpy()
 
     def summarize(self):
-        for iou_type, coco_eval in self.coco_eval.items():
-            log_info(f"IoU metric: {iou_type}")
-            coco_eval.summarize()
-
-    def prepare(self, predictions, iou_type):
-        if iou_type == "bbox":
-            return self.prepare_for_coco_detection(predictions)
-        if iou_type == "segm":
-            return self.prepare_for_coco_segmentation(predictions)
-        if iou_type == "keypoints":
-            return self.prepare_for_coco_keypoint(predictions)
-        raise ValueError(f"Unknown iou type {iou_type}")
-
-    def prepare_for_coco_detection(self, predictions):
-        coco_results = []
-        for original_id, prediction in predictions.items():
-            if len(prediction) == 0:
-                continue
-
-            boxes = prediction["boxes"]
-            boxes = convert_to_xywh(boxes).tolist()
-            scores = prediction["scores"].tolist()
-            labels = prediction["labels"].tolist()
-
-            coco_results.extend(
-                [
-                    {
-                        "image_id": original_id,
-                        "category_id": labels[k],
-                        "bbox": box,
-                        "score": scores[k],
-                    }
-                    for k, box in enumerate(boxes)
-                ]
-            )
-        return coco_results
-
-    def prepare_for_coco_segmentation(self, predictions):
-        coco_results = []
-        for original_id, prediction in predictions.items():
-            if len(prediction) == 0:
-                continue
-
-            scores = prediction["scores"]
-            labels = prediction["labels"]
-            masks = prediction["masks"]
-
-            masks = masks > 0.5
-
-            scores = prediction["scores"].tolist()
-            labels = prediction["labels"].tolist()
-
-            rles = [
-                mask_util.encode(np.array(mask[0, :, :, np.newaxis], dtype=np.uint8, order="F"))[0] for mask in masks
-            ]
-            for rle in rles:
-                rle["counts"] = rle["counts"].decode("utf-8")
-
-            coco_results.extend(
-                [
-                    {
-                        "image_id": original_id,
-                        "category_id": labels[k],
-                        "segmentation": rle,
-                        "score": scores[k],
-                    }
-                    for k, rle in enumerate(rles)
-                ]
-            )
-        return coco_results
-
-    def prepare_for_coco_keypoint(self, predictions):
-        coco_results = []
-        for original_id, prediction in predictions.items():
-            if len(prediction) == 0:
-                continue
-
-            boxes = prediction["boxes"]
-            boxes = convert_to_xywh(boxes).tolist()
-            scores = prediction["scores"].tolist()
-            labels = prediction["labels"].tolist()
-            keypoints = prediction["keypoints"]
-            keypoints = keypoints.flatten(start_dim=1).tolist()
-
-            coco_results.extend(
-                [
-                    {
-                        "image_id": original_id,
-                        "category_id": labels[k],
-                        "keypoints": keypoint,
-                        "score": scores[k],
-                    }
-                    for k, keypoint in enumerate(keypoints)
-                ]
-            )
-        return coco_results
-
-
-def convert_to_xywh(boxes):
-    xmin, ymin, xmax, ymax = boxes.unbind(1)
-    return torch.stack((xmin, ymin, xmax - xmin, ymax - ymin), dim=1)
-
-
-def is_dist_avail_and_initialized():
-    if not dist.is_available():
-        return False
-    if not dist.is_initialized():
-        return False
-    return True
-
-
-def get_world_size():
-    if not is_dist_avail_and_initialized():
-        return 1
-    return dist.get_world_size()
-
-
-def all_gather(data):
+        """computes and logs the 12 values of `COCOeval.summarize`"""
+        def _summarize(ap: bool, iou_thr=None, area_rng="all", max_dets=100) -> float:
+            assert self.precision is not None and self.recall is not None
+            aind = AREA_LBLS.index(area_rng)
+            mind = MAX_DETS.index(max_dets)
+            s = self.precision[..., aind, mind] if ap else self.recall[..., aind, mind]
+            if iou_thr is not None:
+                s = s[np.where(iou_thr == IOU_THRS)[0]]
+            mean_s = -1 if len(s[s > -1]) == 0 else np.mean(s[s > -1])
+            title = "Average Precision" if ap else "Average Recall"
+            type_str = "(AP)" if ap else "(AR)"
+            iou_str = f"{IOU_THRS[0]:0.2f}:{IOU_THRS[-1]:0.2f}" if iou_thr is None else f"{iou_thr:0.2f}"
+            log_info(f" {title:<18} {type_str} @[ IoU={iou_str:<9} | area={area_rng:>6s} "
+                     f"| maxDets={max_dets:>3d} ] = {mean_s:0.3f}")
+            return mean_s
+
+        log_info("IoU metric: bbox")
+        self.stats = np.array([
+            _summarize(True),
+            _summarize(True, iou_thr=.5),
+            _summarize(True, iou_thr=.75),
+            _summarize(True, area_rng="small"),
+            _summarize(True, area_rng="medium"),
+            _summarize(True, area_rng="large"),
+            _summarize(False, max_dets=MAX_DETS[0]),
+            _summarize(False, max_dets=MAX_DETS[1]),
+            _summarize(False, max_dets=MAX_DETS[2]),
+            _summarize(False, area_rng="small"),
+            _summarize(False, area_rng="medium"),
+            _summarize(False, area_rng="large"),
+        ])
+
+
+def group_ranks(groups: Tensor) -> Tensor:
+    """position of each element within its group, for sorted group ids"""
+    positions = torch.arange(len(groups), device=groups.device)
+    starts = torch.searchsorted(groups, groups)
+    return positions - starts
+
+
+def first_occurrence(ids: Tensor) -> Tensor:
+    """mask of the first occurrence of each id"""
+    _, inverse = torch.unique(ids, return_inverse=True)
+    positions = torch.arange(len(ids), device=ids.device)
+    first = torch.full_like(positions, len(ids)).scatter_reduce(0, inverse, positions, reduce="amin")
+    return positions == first[inverse]
+
+
+def box_iou(dt: Tensor, gt: Tensor, crowd: Tensor) -> Tensor:
     """
-    Run all_gather on arbitrary picklable data (not necessarily tensors)
-    Args:
-        data: any picklable object
-    Returns:
-        list[data]: list of data gathered from each rank
+    IoU of XYWH boxes like `bbIou` of pycocotools, for crowd boxes the intersection is divided by the detection area.
+    dt: ... x D x 4, gt: ... x M x 4, crowd: ... x M, returns ... x D x M
     """
-    world_size = get_world_size()
-    if world_size == 1:
-        return [data]
-    data_list = [None] * world_size
-    dist.all_gather_object(data_list, data)
-    return data_list
-
-
-def merge(img_ids, eval_imgs):
-    all_img_ids = all_gather(img_ids)
-    all_eval_imgs = all_gather(eval_imgs)
-
-    merged_img_ids = []
-    for p in all_img_ids:
-        merged_img_ids.extend(p)
-
-    merged_eval_imgs = []
-    for p in all_eval_imgs:
-        merged_eval_imgs.append(p)
-
-    merged_img_ids = np.array(merged_img_ids)
-    merged_eval_imgs = np.concatenate(merged_eval_imgs, 2)
-
-    # keep only unique (and in sorted order) images
-    merged_img_ids, idx = np.unique(merged_img_ids, return_index=True)
-    merged_eval_imgs = merged_eval_imgs[..., idx]
-
-    return merged_img_ids, merged_eval_imgs
-
-
-def create_common_coco_eval(coco_eval, img_ids, eval_imgs):
-    img_ids, eval_imgs = merge(img_ids, eval_imgs)
-    img_ids = list(img_ids)
-    eval_imgs = list(eval_imgs.flatten())
-
-    coco_eval.evalImgs = eval_imgs
-    coco_eval.params.imgIds = img_ids
-    coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
-
-
-def evaluate(imgs):
-    with redirect_stdout(io.StringIO()):
-        imgs.evaluate()
-    return imgs.params.imgIds, np.asarray(imgs.evalImgs).reshape(-1, len(imgs.params.areaRng), len(imgs.params.imgIds))
+    d, g = dt.unsqueeze(-2), gt.unsqueeze(-3)
+    w = torch.minimum(d[..., 2] + d[..., 0], g[..., 2] + g[..., 0]) - torch.maximum(d[..., 0], g[..., 0])
+    h = torch.minimum(d[..., 3] + d[..., 1], g[..., 3] + g[..., 1]) - torch.maximum(d[..., 1], g[..., 1])
+    overlap = (w > 0) & (h > 0)
+    inter = w * h
+    da, ga = d[..., 2] * d[..., 3], g[..., 2] * g[..., 3]
+    union = torch.where(crowd.unsqueeze(-2), da, da + ga - inter)
+    return torch.where(overlap, inter / torch.where(overlap, union, 1.0), 0.0)
+
+
+def match_detections(
+        det_group: Tensor,
+        det_boxes: Tensor,
+        gt_group: Tensor,
+        gt_boxes: Tensor,
+        gt_crowd: Tensor,
+        gt_ignore: Tensor,
+        num_groups: int
+        ) -> tuple[Tensor, Tensor]:
+    """
+    Greedy matching of `COCOeval.evaluateImg` for all groups (image, category) at once:
+    in the order of their scores, detections are matched to the unmatched (or crowd) ground truth with the
+    highest IoU above the threshold, preferring ground truths which are not ignored in the area range.
+    Detections and ground truths are sorted by group, `gt_ignore` is given per area range (areas x gts).
+    Returns whether each detection is matched and whether it is matched to an ignored ground truth,
+    both of shape areas x thresholds x detections.
+    """
+    device = det_boxes.device
+    num_areas = len(gt_ignore)
+    thrs = torch.from_numpy(IOU_THRS).to(device).clamp(max=1 - 1e-10)
+    matched = torch.zeros(num_areas, len(thrs), len(det_group), dtype=torch.bool, device=device)
+    matched_ignored = torch.zeros_like(matched)
+    num_dets = torch.bincount(det_group, minlength=num_groups)
+    num_gts = torch.bincount(gt_group, minlength=num_groups)
+    det_starts = torch.cumsum(num_dets, 0) - num_dets
+    gt_starts = torch.cumsum(num_gts, 0) - num_gts
+    groups = torch.nonzero((num_dets > 0) & (num_gts > 0)).flatten()
+    # chunks of groups with the same number of ground truths
+    groups = groups[torch.sort(num_gts[groups], stable=True).indices]
+    sizes, counts = torch.unique_consecutive(num_gts[groups], return_counts=True)
+    chunks = []
+    for size, chunk in zip(sizes.tolist(), torch.split(groups, counts.tolist())):
+        chunks.extend(torch.split(chunk, max(1, CHUNK_ELEMENTS // (size * 100))))
+    for chunk in chunks:
+        max_d = int(num_dets[chunk].max())
+        size = int(num_gts[chunk[0]])
+        d_range = torch.arange(max_d, device=device)
+        det_valid = d_range < num_dets[chunk, None]  # G x D
+        det_index = torch.where(det_valid, det_starts[chunk, None] + d_range, 0)
+        gt_index = gt_starts[chunk, None] + torch.arange(size, device=device)  # G x M
+        crowd = gt_crowd[gt_index]
+        ignore = gt_ignore[:, gt_index].unsqueeze(1)  # A x 1 x G x M
+        ious = box_iou(det_boxes[det_index], gt_boxes[gt_index], crowd)  # G x D x M
+        gt_matched = torch.zeros(num_areas, len(thrs), len(chunk), size, dtype=torch.bool, device=device)
+        chunk_matched = torch.zeros(num_areas, len(thrs), len(chunk), max_d, dtype=torch.bool, device=device)
+        chunk_ignored = torch.zeros_like(chunk_matched)
+        for d in range(max_d):
+            iou = ious[:, d]
+            candidates = (iou >= thrs[:, None, None]) & (~gt_matched | crowd)  # A x T x G x M
+            preferred = candidates & ~ignore
+            has_preferred = preferred.any(-1)
+            candidates = torch.where(has_preferred.unsqueeze(-1), preferred, candidates)
+            has_match = candidates.any(-1) & det_valid[:, d]
+            # the last of equally good ground truths
+            best = size - 1 - torch.where(candidates, iou, -1.0).flip(-1).argmax(-1)
+            gt_matched.scatter_(
+                -1, best.unsqueeze(-1), gt_matched.gather(-1, best.unsqueeze(-1)) | has_match.unsqueeze(-1)
+            )
+            chunk_matched[..., d] = has_match
+            chunk_ignored[..., d] = has_match & ~has_preferred
+        matched[..., det_index[det_valid]] = chunk_matched[..., det_valid]
+        matched_ignored[..., det_index[det_valid]] = chunk_ignored[..., det_valid]
+    return matched, matched_ignored
@@ -1,3 +1,4 @@
+from functools import partial
 from pathlib import Path
 import zipfile
 import wget
@@ -9,10 +10,48 @@ from torchvision import datasets, tv_tensors
 from pycocotools.coco import COCO
 from tqdm import tqdm
 from pytorch_fob.tasks import TaskDataModule
+from pytorch_fob.tasks.synthetic import SPLIT_SEEDS, SyntheticDataset, random_image, random_int, sample_generator
 from pytorch_fob.engine.configs import TaskConfig
 from pytorch_fob.engine.utils import log_info
 
 
+# train2017 without the images without annotations and val2017
+SPLIT_SIZES = {"train": 117266, "validation": 5000}
+NUM_CATEGORIES = 90
+MAX_OBJECTS = 15  # 7.3 objects per image on average
+LONG_SIDE = 640
+MIN_SHORT_SIDE = 360
+
+
+def synthetic_annotations(generator: torch.Generator) -> tuple[int, int, torch.Tensor, torch.Tensor]:
+    """height, width, XYXY boxes (at least 2 pixels wide and high) and category ids of a random image"""
+    short_side = random_int(generator, MIN_SHORT_SIDE, LONG_SIDE + 1)
+    if random_int(generator, 0, 2) == 0:
+        height, width = short_side, LONG_SIDE
+    else:
+        height, width = LONG_SIDE, short_side
+    n = random_int(generator, 1, MAX_OBJECTS + 1)
+    size = torch.tensor([width, height], dtype=torch.float)
+    top_left = torch.rand(n, 2, generator=generator) * (size - 2)
+    bottom_right = top_left + 2 + torch.rand(n, 2, generator=generator) * (size - 2 - top_left)
+    boxes = torch.cat([top_left, bottom_right], dim=1)
+    labels = torch.randint(1, NUM_CATEGORIES + 1, (n,), generator=generator)
+    return height, width, boxes, labels
+
+
+def synthetic_sample(generator: torch.Generator, index: int, transforms: v2.Compose):
+    """image and target like `wrap_dataset_for_transforms_v2(CocoDetection)` with the image index as image_id"""
+    height, width, boxes, labels = synthetic_annotations(generator)
+    # an explicit image, otherwise the transforms would take the labels for it
+    image = tv_tensors.Image(torch.from_numpy(random_image(generator, height, width)).permute(2, 0, 1))
+    target = {
+        "boxes": tv_tensors.BoundingBoxes(boxes, format=tv_tensors.BoundingBoxFormat.XYXY, canvas_size=(height, width)),
+        "labels": labels,
+        "image_id": index
+    }
+    return transforms(image, target)
+
+
 class COCODataModule(TaskDataModule):
     """
     DataModule for COCO object detection task.
@@ -21,6 +60,7 @@ class COCODataModule(TaskDataModule):
     """
     def __init__(self, config: TaskConfig):
         super().__init__(config)
+        self.eval_batch_size: int = config.get("eval_batch_size", 1)
 
         if config.train_transforms.horizontal_flip.use:
             horizontal_flip = v2.RandomHorizontalFlip(p=config.train_transforms.horizontal_flip.p)
@@ -47,6 +87,8 @@ class COCODataModule(TaskDataModule):
         self.collate_fn = lambda batch: tuple(zip(*batch))
 
     def prepare_data(self):
+        if self.synthetic:
+            return
         self.data_dir.mkdir(exist_ok=True)
         # download images
         annot = self._download(self._coco_annot_link(), "annotations")
@@ -99,6 +141,9 @@ class COCODataModule(TaskDataModule):
     def setup(self, stage: str):
         """setup is called from every process across all the nodes. Setting state here is recommended.
         """
+        if self.synthetic:
+            self.setup_synthetic(stage)
+            return
         train_path = self.data_dir / "train2017"
         val_path = self.data_dir / "val2017"
         annot_path = self.data_dir / "annotations"
@@ -127,10 +172,10 @@ class COCODataModule(TaskDataModule):
         return self._dataloader_from_dataset(self.data_train, shuffle=True)
 
     def val_dataloader(self) -> DataLoader:
-        return self._dataloader_from_dataset(self.data_val, batch_size=1)
+        return self._dataloader_from_dataset(self.data_val, batch_size=self.eval_batch_size)
 
     def test_dataloader(self) -> DataLoader:
-        return self._dataloader_from_dataset(self.data_test, batch_size=1)
+        return self._dataloader_from_dataset(self.data_test, batch_size=self.eval_batch_size)
 
     def predict_dataloader(self) -> DataLoader:
         return self._dataloader_from_dataset(self.data_predict)
@@ -152,12 +197,46 @@ class COCODataModule(TaskDataModule):
             shuffle=shuffle
         )
 
+    def synthetic_dataset(self, split: str):
+        # like the real data, test and predict use the validation split
+        split = "train" if split == "train" else "validation"
+        transforms = self.train_transforms if split == "train" else self.val_transforms
+        return SyntheticDataset(SPLIT_SIZES[split], partial(synthetic_sample, transforms=transforms), split)
+
     def eval_gt_data(self) -> COCO:
+        if self.synthetic:
+            return self._synthetic_gt_data()
         val_path = self.data_dir / "val2017"
         annot_path = self.data_dir / "annotations" / "instances_val2017.json"
         ds = self._wrapped_coco_dataset(val_path, annot_path, transforms=self.val_transforms)
         return ds.coco
 
+    def _synthetic_gt_data(self) -> COCO:
+        """the annotations of the synthetic validation split, without generating the images"""
+        images, annotations = [], []
+        for index in range(SPLIT_SIZES["validation"]):
+            generator = sample_generator(SPLIT_SEEDS["validation"], index)
+            height, width, boxes, labels = synthetic_annotations(generator)
+            images.append({"id": index, "height": height, "width": width})
+            for box, label in zip(boxes.tolist(), labels.tolist()):
+                x0, y0, x1, y1 = box
+                annotations.append({
+                    "id": len(annotations) + 1,
+                    "image_id": index,
+                    "category_id": label,
+                    "bbox": [x0, y0, x1 - x0, y1 - y0],
+                    "area": (x1 - x0) * (y1 - y0),
+                    "iscrowd": 0
+                })
+        coco = COCO()
+        coco.dataset = {
+            "images": images,
+            "annotations": annotations,
+            "categories": [{"id": i, "name": str(i)} for i in range(1, NUM_CATEGORIES + 1)]
+        }
+        coco.createIndex()
+        return coco
+
     def _wrapped_coco_dataset(self, imgs: Path, annot: Path, transforms: v2.Compose) -> CocoDetection:
         ds = CocoDetection(str(imgs), str(annot), transforms=transforms)
         return datasets.wrap_dataset_for_transforms_v2(ds, target_keys=["boxes", "labels", "image_id"])
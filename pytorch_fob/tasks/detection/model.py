@@ -20,8 +20,7 @@ class COCODetectionModel(TaskModel):
             weights_backbone=weights
         )
         super().__init__(model, optimizer, config)
-        self.eval_gts = eval_gts
-        self.reset_coco_eval()
+        self.coco_eval = CocoEvaluator(eval_gts)
 
     def forward(self, x):
         imgs, targets = x
@@ -40,7 +39,7 @@ class COCODetectionModel(TaskModel):
         self._update_coco_eval(batch)
 
     def reset_coco_eval(self):
-        self.coco_eval = CocoEvaluator(self.eval_gts, ["bbox"])
+        self.coco_eval.reset()
 
     def _update_coco_eval(self, batch):
         imgs, targets = batch
@@ -49,7 +48,7 @@ class COCODetectionModel(TaskModel):
         self.coco_eval.update(res)
 
     def get_eval_stats(self) -> list[float]:
-        return self.coco_eval.coco_eval["bbox"].stats
+        return self.coco_eval.stats
 
     def log_losses(self, losses: dict, stage: str):
         for loss, val in losses.items():
@@ -69,7 +68,7 @@ class COCODetectionModel(TaskModel):
         self.log("test_AP", self.get_eval_stats()[0], sync_dist=True)
 
     def _summarize_eval(self):
-        self.coco_eval.synchronize_between_processes()
+        self.coco_eval.synchronize_between_processes(self.device)
         self.coco_eval.accumulate()
         self.coco_eval.summarize()
 
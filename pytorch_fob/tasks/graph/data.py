@@ -1,31 +1,109 @@
 # https://github.com/Diego999/pyGAT/blob/master/utils.py
 
+from functools import partial
+from typing import Optional
+import torch
 from ogb.graphproppred import PygGraphPropPredDataset
+from torch.utils.data import DataLoader, SequentialSampler
+from torch_geometric.data import Data
 from torch_geometric.loader import DataLoader as GeomDataLoader
 from pytorch_fob.engine.configs import TaskConfig
-from pytorch_fob.engine.utils import log_debug
+from pytorch_fob.engine.utils import log_debug, log_info
 from pytorch_fob.tasks import TaskDataModule
+from pytorch_fob.tasks.graph.packed_graphs import GraphBudgetBatchSampler, PackedGraphDataset, collate_batch, \
+    packed_graphs_exist, write_packed_graphs
+from pytorch_fob.tasks.synthetic import SyntheticDataset, random_int
+
+
+# number of values of each feature, see ogb.utils.features
+ATOM_FEATURE_DIMS = [119, 5, 12, 12, 10, 6, 6, 2, 2]
+BOND_FEATURE_DIMS = [5, 6, 2]
+# binary classification tasks, metric, scaffold split and rate of positive labels of the datasets
+DATASETS = {
+    "ogbg-molhiv": {
+        "num_tasks": 1,
+        "metric": "rocauc",
+        "split_sizes": {"train": 32901, "validation": 4113, "test": 4113},
+        "positive_rate": 0.035
+    },
+    "ogbg-molpcba": {
+        "num_tasks": 128,
+        "metric": "ap",
+        "split_sizes": {"train": 350343, "validation": 43793, "test": 43793},
+        "positive_rate": 0.014
+    },
+}
+MIN_ATOMS, MAX_ATOMS = 6, 45  # 25.5 atoms per molecule on average
+
+
+def synthetic_molecule(
+        generator: torch.Generator,
+        index: int,
+        num_tasks: int = 1,
+        positive_rate: float = DATASETS["ogbg-molhiv"]["positive_rate"]
+        ) -> Data:
+    """
+    Random molecule graph with the features of the ogbg-mol datasets: a random tree of bonds with a few rings,
+    each bond is stored in both directions. All labels are present.
+    """
+    num_nodes = random_int(generator, MIN_ATOMS, MAX_ATOMS + 1)
+    x = torch.stack([torch.randint(0, d, (num_nodes,), generator=generator) for d in ATOM_FEATURE_DIMS], dim=1)
+    children = torch.arange(1, num_nodes)
+    parents = (torch.rand(num_nodes - 1, generator=generator) * children).long()
+    rings = torch.randint(0, num_nodes, (2, num_nodes // 6), generator=generator)
+    rings = rings[:, rings[0] != rings[1]]
+    bonds = torch.cat([torch.stack([parents, children]), rings], dim=1)
+    bond_attr = torch.stack(
+        [torch.randint(0, d, (bonds.shape[1],), generator=generator) for d in BOND_FEATURE_DIMS], dim=1
+    )
+    edge_index = torch.stack([bonds, bonds.flip(0)], dim=2).reshape(2, -1)
+    edge_attr = bond_attr.repeat_interleave(2, dim=0)
+    y = (torch.rand(1, num_tasks, generator=generator) < positive_rate).long()
+    return Data(x=x, edge_index=edge_index, edge_attr=edge_attr, y=y, num_nodes=num_nodes)
 
 
 class OGBGDataModule(TaskDataModule):
-    """ogbg-molhiv https://ogb.stanford.edu/docs/graphprop/#ogbg-mol
+    """ogbg-molhiv and ogbg-molpcba https://ogb.stanford.edu/docs/graphprop/#ogbg-mol
     graph: molecule, nodes: atoms, edges: chemical bonds
     features can be found here https://github.com/snap-stanford/ogb/blob/master/ogb/utils/features.py
     """
     def __init__(self, config: TaskConfig):
         super().__init__(config)
-        # ogbg-molhiv is small (41,127 graphs)
-        self.dataset_name = "ogbg-molhiv"
-        # ogbg-molpcba is medium size (437,929 graphs)
-        # self.dataset_name = "ogbg-molpcba"
+        # ogbg-molhiv is small (41,127 graphs), ogbg-molpcba is medium size (437,929 graphs)
+        self.dataset_name: str = config.get("dataset", "ogbg-molhiv")
+        if self.dataset_name not in DATASETS:
+            raise ValueError(f"unknown dataset '{self.dataset_name}', use one of {', '.join(DATASETS)}")
+        self.num_tasks: int = DATASETS[self.dataset_name]["num_tasks"]
+        self.metric: str = DATASETS[self.dataset_name]["metric"]
+        self.packed_graphs: bool = config.get("packed_graphs", False)
+        self.max_nodes_per_batch: Optional[int] = config.get("max_nodes_per_batch", None)
+        self.max_edges_per_batch: Optional[int] = config.get("max_edges_per_batch", None)
+        self.packed_dir = self.data_dir / f"{self.dataset_name.replace('-', '_')}_packed"
+        self.use_budget = self.max_nodes_per_batch is not None or self.max_edges_per_batch is not None
+        if self.use_budget and (not self.packed_graphs or self.synthetic):
+            raise ValueError("max_nodes_per_batch and max_edges_per_batch require packed_graphs (with the real data)!")
 
     def prepare_data(self):
+        if self.synthetic:
+            return
+        if self.packed_graphs and packed_graphs_exist(self.packed_dir):
+            return
         dataset = PygGraphPropPredDataset(root=str(self.data_dir), name=self.dataset_name)
         log_debug(f"{dataset.num_node_features=}")
         log_debug(f"{dataset.num_classes=}")
         log_debug(f"{dataset.num_features=}")
+        if self.packed_graphs:
+            log_info(f"packing {self.dataset_name}...")
+            write_packed_graphs(dataset, self.packed_dir, dataset.get_idx_split())
+
+    def synthetic_dataset(self, split: str):
+        info = DATASETS[self.dataset_name]
+        make_sample = partial(synthetic_molecule, num_tasks=info["num_tasks"], positive_rate=info["positive_rate"])
+        return SyntheticDataset(info["split_sizes"][split], make_sample, split)
 
     def get_dataloader(self, dataset, shuffle: bool = False):
+        if self.packed_graphs and not self.synthetic:
+            return self._packed_dataloader(dataset, shuffle)
         return GeomDataLoader(
             dataset,
             batch_size=self.batch_size,
@@ -34,6 +112,30 @@ class OGBGDataModule(TaskDataModule):
             shuffle=shuffle
         )
 
+    def _packed_dataloader(self, dataset: PackedGraphDataset, shuffle: bool):
+        if self.use_budget:
+            # lightning replaces the sampler with a DistributedSampler in ddp, the batches are built by the batch sampler
+            batch_sampler = GraphBudgetBatchSampler(SequentialSampler(dataset),
+                                                    dataset.num_nodes(),
+                                                    dataset.num_edges(),
+                                                    self.max_nodes_per_batch,
+                                                    self.max_edges_per_batch,
+                                                    shuffle=shuffle,
+                                                    seed=torch.initial_seed())
+            return DataLoader(
+                dataset,
+                batch_sampler=batch_sampler,
+                num_workers=self.workers,
+                collate_fn=collate_batch
+            )
+        return DataLoader(
+            dataset,
+            batch_size=self.batch_size,
+            num_workers=self.workers,
+            collate_fn=collate_batch,
+            shuffle=shuffle
+        )
+
     def train_dataloader(self):
         self.check_dataset(self.data_train)
         return self.get_dataloader(self.data_train, shuffle=True)
@@ -53,6 +155,12 @@ class OGBGDataModule(TaskDataModule):
     def setup(self, stage: str):
         """setup is called from every process across all the nodes. Setting state here is recommended.
         """
+        if self.synthetic:
+            self.setup_synthetic(stage)
+            return
+        if self.packed_graphs:
+            self._setup_packed(stage)
+            return
         dataset = PygGraphPropPredDataset(root=str(self.data_dir), name=self.dataset_name)
         split_idx = dataset.get_idx_split()
         if stage == "fit":
@@ -64,3 +172,14 @@ class OGBGDataModule(TaskDataModule):
             self.data_test = dataset[split_idx["test"]]
         if stage == "predict":
             raise NotImplementedError()
+
+    def _setup_packed(self, stage: str):
+        if stage == "fit":
+            self.data_train = PackedGraphDataset(self.packed_dir, "train")
+            self.data_val = PackedGraphDataset(self.packed_dir, "valid")
+        if stage == "validate":
+            self.data_val = PackedGraphDataset(self.packed_dir, "valid")
+        if stage == "test":
+            self.data_test = PackedGraphDataset(self.packed_dir, "test")
+        if stage == "predict":
+            raise NotImplementedError()
@@ -0,0 +1,111 @@
+from typing import Optional
+import torch
+import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
+from torch_geometric.utils import degree
+from ogb.graphproppred.mol_encoder import BondEncoder
+
+
+# messages computed at once, bounds the temporary memory of the message passing
+CHUNK_ELEMENTS = 2**22
+
+
+def edge_chunks(num_edges: int, channels: int) -> list[slice]:
+    size = max(1, CHUNK_ELEMENTS // max(1, channels))
+    return [slice(start, start + size) for start in range(0, num_edges, size)]
+
+
+class GatherAddReluScatter(torch.autograd.Function):
+    """
+    out[dst[e]] += weight[e] * relu(x[src[e]] + table[edge_type[e]]) for each edge e, in chunks of edges.
+    No tensor of size edges x channels is kept: the backward pass recomputes the messages of each chunk
+    from the node embeddings and the (small) table of edge embeddings.
+    """
+    @staticmethod
+    def forward(ctx, x, table, src, dst, edge_type, weight):  # pylint: disable=arguments-differ
+        ctx.save_for_backward(x, table, src, dst, edge_type, weight)
+        out = torch.zeros_like(x)
+        for chunk in edge_chunks(len(src), x.shape[1]):
+            message = F.relu(x[src[chunk]] + table[edge_type[chunk]])
+            if weight is not None:
+                message.mul_(weight[chunk, None])
+            out.index_add_(0, dst[chunk], message)
+        return out
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_out):  # pylint: disable=arguments-differ
+        x, table, src, dst, edge_type, weight = ctx.saved_tensors
+        grad_x = torch.zeros_like(x) if ctx.needs_input_grad[0] else None
+        grad_table = torch.zeros_like(table) if ctx.needs_input_grad[1] else None
+        for chunk in edge_chunks(len(src), x.shape[1]):
+            grad = grad_out[dst[chunk]]
+            grad.masked_fill_(x[src[chunk]] + table[edge_type[chunk]] <= 0, 0)
+            if weight is not None:
+                grad.mul_(weight[chunk, None])
+            if grad_x is not None:
+                grad_x.index_add_(0, src[chunk], grad)
+            if grad_table is not None:
+                grad_table.index_add_(0, edge_type[chunk], grad)
+        return grad_x, grad_table, None, None, None, None
+
+
+def gather_add_relu_scatter(
+        x: torch.Tensor,
+        table: torch.Tensor,
+        edge_index: torch.Tensor,
+        edge_type: torch.Tensor,
+        weight: Optional[torch.Tensor] = None
+        ) -> torch.Tensor:
+    """sum of the messages relu(x_j + edge embedding), optionally weighted, from the sources to the targets"""
+    return GatherAddReluScatter.apply(x, table.to(x.dtype), edge_index[0], edge_index[1], edge_type, weight)
+
+
+def bond_type_table(bond_encoder: BondEncoder, edge_attr: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    The embeddings of all combinations of bond features (5 x 6 x 2 for the OGB features)
+    and the index of the combination of each edge, instead of an embedding for each edge.
+    """
+    dims = [embedding.num_embeddings for embedding in bond_encoder.bond_embedding_list]
+    features = [torch.arange(dim, device=edge_attr.device) for dim in dims]
+    combinations = torch.stack(torch.meshgrid(*features, indexing="ij"), dim=-1).view(-1, len(dims))
+    strides = torch.tensor(dims[1:] + [1], device=edge_attr.device).flip(0).cumprod(0).flip(0)
+    return bond_encoder(combinations), (edge_attr * strides).sum(dim=1)
+
+
+class FusedGINConv(torch.nn.Module):
+    """`GINConv` with the gather, add, relu and scatter of the messages fused, the parameters are the same"""
+    def __init__(self, emb_dim: int):
+        super().__init__()
+        self.mlp = torch.nn.Sequential(
+            torch.nn.Linear(emb_dim, 2*emb_dim),
+            torch.nn.BatchNorm1d(2*emb_dim),
+            torch.nn.ReLU(),
+            torch.nn.Linear(2*emb_dim, emb_dim)
+        )
+        self.eps = torch.nn.Parameter(torch.Tensor([0]))
+        self.bond_encoder = BondEncoder(emb_dim=emb_dim)
+
+    def forward(self, x, edge_index, edge_attr):
+        table, edge_type = bond_type_table(self.bond_encoder, edge_attr)
+        return self.mlp((1 + self.eps) * x + gather_add_relu_scatter(x, table, edge_index, edge_type))
+
+
+class FusedGCNConv(torch.nn.Module):
+    """`GCNConv` with the gather, add, relu and scatter of the messages fused, the parameters are the same"""
+    def __init__(self, emb_dim: int):
+        super().__init__()
+        self.linear = torch.nn.Linear(emb_dim, emb_dim)
+        self.root_emb = torch.nn.Embedding(1, emb_dim)
+        self.bond_encoder = BondEncoder(emb_dim=emb_dim)
+
+    def forward(self, x, edge_index, edge_attr):
+        x = self.linear(x)
+        table, edge_type = bond_type_table(self.bond_encoder, edge_attr)
+        row, col = edge_index
+        # with the self loop every degree is at least 1
+        deg = degree(row, x.size(0), dtype=x.dtype) + 1
+        deg_inv_sqrt = deg.pow(-0.5)
+        norm = deg_inv_sqrt[row] * deg_inv_sqrt[col]
+        return gather_add_relu_scatter(x, table, edge_index, edge_type, norm) \
+            + F.relu(x + self.root_emb.weight) / deg.view(-1, 1)
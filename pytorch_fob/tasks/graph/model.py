@@ -1,49 +1,182 @@
+from typing import Optional
 import torch
-from ogb.graphproppred import Evaluator
 
 from pytorch_fob.tasks import TaskModel
+from pytorch_fob.tasks.graph.data import DATASETS
 from pytorch_fob.tasks.graph.snap.gnn import GNN
 from pytorch_fob.engine.configs import TaskConfig
-from pytorch_fob.engine.utils import log_warn
+from pytorch_fob.engine.utils import all_gather_cat, log_warn
 from pytorch_fob.optimizers import Optimizer
 
 
+def rocauc_from_counts(pos: torch.Tensor, neg: torch.Tensor, task: torch.Tensor, num_tasks: int) -> torch.Tensor:
+    """
+    ROC-AUC of each task from the number of positives and negatives of each group of equal scores.
+    The groups are sorted by task and ascending score, ties count half like in `sklearn.metrics.roc_auc_score`.
+    Tasks without positives or negatives are NaN.
+    """
+    pos, neg = pos.double(), neg.double()
+    num_pos = torch.zeros(num_tasks, dtype=torch.float64, device=pos.device).index_add_(0, task, pos)
+    num_neg = torch.zeros_like(num_pos).index_add_(0, task, neg)
+    # negatives with a lower score within the same task
+    neg_below = torch.cumsum(neg, 0) - neg - (torch.cumsum(num_neg, 0) - num_neg)[task]
+    correct = torch.zeros_like(num_pos).index_add_(0, task, pos * (neg_below + 0.5 * neg))
+    return torch.where((num_pos > 0) & (num_neg > 0), correct / (num_pos * num_neg), torch.nan)
+
+
+def average_precision_from_counts(
+        pos: torch.Tensor,
+        neg: torch.Tensor,
+        task: torch.Tensor,
+        num_tasks: int
+        ) -> torch.Tensor:
+    """
+    Average precision of each task like `sklearn.metrics.average_precision_score`, from the same counts
+    as `rocauc_from_counts`: the precision at each score threshold weighted by the positives at the threshold.
+    Tasks without positives or negatives are NaN.
+    """
+    pos, neg = pos.double(), neg.double()
+    num_pos = torch.zeros(num_tasks, dtype=torch.float64, device=pos.device).index_add_(0, task, pos)
+    num_neg = torch.zeros_like(num_pos).index_add_(0, task, neg)
+    # positives and negatives with the same or a higher score within the same task
+    tp = num_pos[task] - (torch.cumsum(pos, 0) - pos - (torch.cumsum(num_pos, 0) - num_pos)[task])
+    fp = num_neg[task] - (torch.cumsum(neg, 0) - neg - (torch.cumsum(num_neg, 0) - num_neg)[task])
+    # empty bins have no precision
+    precision = torch.where(pos > 0, tp / (tp + fp).clamp(min=1), 0.0)
+    weighted = torch.zeros_like(num_pos).index_add_(0, task, pos * precision)
+    return torch.where((num_pos > 0) & (num_neg > 0), weighted / num_pos, torch.nan)
+
+
+METRICS = {"rocauc": rocauc_from_counts, "ap": average_precision_from_counts}
+
+
+class MultiTaskMetric():
+    """
+    ROC-AUC or average precision of each task (column) like the OGB `Evaluator`, averaged over the tasks with
+    positive and negative labels, unlabeled (NaN) targets are ignored.
+    Without `num_bins` the predictions are kept on the device and gathered from all processes at the end (exact).
+    With `num_bins` only the number of positives and negatives in each bin of predicted probability is kept,
+    which needs constant memory and a single all-reduce (approximate: ties within a bin count half).
+    """
+    def __init__(self, metric: str = "rocauc", num_tasks: int = 1, num_bins: Optional[int] = None) -> None:
+        self.from_counts = METRICS[metric]
+        self.num_tasks = num_tasks
+        self.num_bins = num_bins
+        self.preds: list[torch.Tensor] = []
+        self.labels: list[torch.Tensor] = []
+        # negatives and positives x tasks x bins
+        self.histogram = torch.zeros(2, num_tasks, num_bins or 0, dtype=torch.long)
+        self.num_nan = torch.zeros((), dtype=torch.long)
+
+    def update(self, preds: torch.Tensor, labels: torch.Tensor):
+        preds = preds.detach().float()
+        labels = labels.float()
+        if self.num_nan.device != preds.device:
+            self.num_nan = self.num_nan.to(preds.device)
+            self.histogram = self.histogram.to(preds.device)
+        labeled = ~labels.isnan()
+        self.num_nan += (preds.isnan() & labeled).sum()
+        if self.num_bins is None:
+            self.preds.append(preds)
+            self.labels.append(labels)
+            return
+        valid = labeled & ~preds.isnan()
+        bins = (torch.sigmoid(preds[valid]) * self.num_bins).long().clamp(max=self.num_bins - 1)
+        tasks = torch.arange(self.num_tasks, device=preds.device).expand_as(preds)[valid]
+        index = (labels[valid].long() * self.num_tasks + tasks) * self.num_bins + bins
+        self.histogram += torch.bincount(index, minlength=self.histogram.numel()).view_as(self.histogram)
+
+    def compute(self, device: torch.device) -> Optional[float]:
+        """
+        mean metric over all processes (which need to call this together),
+        None if no task has both positive and negative labels, NaN if there are NaN predictions
+        """
+        num_nan = self.num_nan.to(device)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(num_nan)
+        if self.num_bins is None:
+            rocauc = self._exact(device)
+        else:
+            rocauc = self._binned(device)
+        if num_nan > 0:
+            return float("nan")
+        valid = ~rocauc.isnan()
+        if not valid.any():
+            return None
+        return rocauc[valid].mean().item()
+
+    def _exact(self, device: torch.device) -> torch.Tensor:
+        empty = torch.zeros(0, self.num_tasks, device=device)
+        preds = all_gather_cat(torch.cat(self.preds).to(device) if self.preds else empty)
+        labels = all_gather_cat(torch.cat(self.labels).to(device) if self.labels else empty)
+        tasks = torch.arange(self.num_tasks, device=device).expand_as(preds)
+        valid = ~labels.isnan() & ~preds.isnan()
+        preds, labels, tasks = preds[valid], labels[valid], tasks[valid]
+        # sort by task, then by score
+        order = torch.sort(preds, stable=True).indices
+        order = order[torch.sort(tasks[order], stable=True).indices]
+        preds, labels, tasks = preds[order], labels[order], tasks[order]
+        # groups of equal scores
+        new_group = torch.ones_like(tasks, dtype=torch.bool)
+        new_group[1:] = (tasks[1:] != tasks[:-1]) | (preds[1:] != preds[:-1])
+        group = torch.cumsum(new_group, 0) - 1
+        num_groups = int(group[-1]) + 1 if len(group) > 0 else 0
+        pos = torch.zeros(num_groups, dtype=torch.long, device=device).index_add_(0, group, labels.long())
+        count = torch.bincount(group, minlength=num_groups)
+        return self.from_counts(pos, count - pos, tasks[new_group], self.num_tasks)
+
+    def _binned(self, device: torch.device) -> torch.Tensor:
+        histogram = self.histogram.to(device)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(histogram)
+        neg, pos = histogram
+        tasks = torch.arange(self.num_tasks, device=device).repeat_interleave(pos.shape[1])
+        return self.from_counts(pos.flatten(), neg.flatten(), tasks, self.num_tasks)
+
+    def reset(self):
+        self.preds.clear()
+        self.labels.clear()
+        self.histogram.zero_()
+        self.num_nan.zero_()
+
+
 class OGBGModel(TaskModel):
     """GIN from pytorch geometric"""
     def __init__(
             self,
             optimizer: Optimizer,
             config: TaskConfig,
-            dataset_name: str = "ogbg-molhiv",
-            num_classes: int = 2
+            dataset_name: str = "ogbg-molhiv"
     ):
         # https://github.com/pyg-team/pytorch_geometric/blob/master/examples/pytorch_lightning/gin.py
-        self.batch_size = config.batch_size
+        self.num_tasks: int = DATASETS[dataset_name]["num_tasks"]
+        self.metric_name: str = DATASETS[dataset_name]["metric"]
 
         gin_params = config.model
         model = GNN(
-            num_tasks=num_classes,
+            # the single task of ogbg-molhiv uses the logit of class 1 of two outputs
+            num_tasks=2 if self.num_tasks == 1 else self.num_tasks,
             num_layer=gin_params.num_layers,
             emb_dim=gin_params.hidden_channels,
             drop_ratio=gin_params.dropout,
             jumping_knowledge=gin_params.jumping_knowledge,
             virtual_node=gin_params.virtual_node,
-            graph_pooling=gin_params.graph_pooling
+            graph_pooling=gin_params.graph_pooling,
+            gnn_type=gin_params.get("gnn_type", "gin"),
+            fused=gin_params.get("fused_message_passing", False)
         )
         super().__init__(model, optimizer, config)
-        self.metric_preds: list[torch.Tensor] = []  # probabilities for class 1
-        self.metric_trues: list[torch.Tensor] = []  # labels for classes
-
-        # https://ogb.stanford.edu/docs/home/
-        # You can learn the input and output format specification of the evaluator as follows.
-        # print(self.evaluator.expected_input_format)
-        self.evaluator = Evaluator(name=dataset_name)
+        self.metric = MultiTaskMetric(self.metric_name, self.num_tasks, config.get("metric_bins", None))
 
         self.loss_fn = torch.nn.BCEWithLogitsLoss()
 
     def forward(self, data) -> torch.Tensor:
         return self.model.forward(data)
 
+    def task_logits(self, preds: torch.Tensor) -> torch.Tensor:
+        """graphs x tasks"""
+        return preds[:, 1:] if self.num_tasks == 1 else preds
+
     def training_step(self, data, batch_idx):
         y_hat = self.forward(data)
         return self.compute_and_log_loss(y_hat, data.y, "train_loss")
@@ -58,39 +191,40 @@ class OGBGModel(TaskModel):
         self._collect_data_for_metric(y_hat, data.y)
 
     def compute_and_log_loss(self, preds, labels, log_label: str):
-        labels = labels.to(torch.float32).squeeze(dim=-1)  # floats for BCE but int for rocauc
-        loss = self.loss_fn(preds[:, 1], labels)
-        self.log(log_label, loss, batch_size=self.batch_size)
+        labels = labels.to(torch.float32)  # floats for BCE, missing labels are NaN
+        labeled = ~labels.isnan()
+        loss = self.loss_fn(self.task_logits(preds)[labeled], labels[labeled])
+        self.log(log_label, loss, batch_size=len(labels))
         return loss
 
     def _collect_data_for_metric(self, preds, labels):
-        self.metric_preds.append(preds[:, 1].unsqueeze(dim=-1))
-        self.metric_trues.append(labels)
+        self.metric.update(self.task_logits(preds), labels)
+
+    def on_validation_start(self) -> None:
+        self.metric.reset()
+
+    def on_test_start(self) -> None:
+        self.metric.reset()
 
     def on_validation_epoch_end(self):
-        self.compute_and_log_metric("val_rocauc")
+        self.compute_and_log_metric(f"val_{self.metric_name}")
 
     def on_test_epoch_end(self) -> None:
-        self.compute_and_log_metric("test_rocauc")
+        self.compute_and_log_metric(f"test_{self.metric_name}")
 
     def compute_and_log_metric(self, log_label: str):
         """
         https://lightning.ai/docs/pytorch/stable/common/lightning_module.html#validation-epoch-level-metrics
         """
-        all_trues = torch.cat(self.metric_trues).float()
-        all_preds = torch.cat(self.metric_preds).float()
-
-        validation_dict = {"y_true": all_trues, "y_pred": all_preds}
-        try:
-            ogb_score = self.evaluator.eval(validation_dict)
-        except ValueError:
+        value = self.metric.compute(self.device)
+        if value is None:
+            log_warn(f"Error: Cannot compute {self.metric_name}.")
+            value = 0
+        elif value != value:
             log_warn("Error: Input contains NaN.")
-            ogb_score = {"rocauc": 0}
-        except RuntimeError:
-            log_warn("Error: Cannot compute ROCAUC.")
-            ogb_score = {"rocauc": 0}
-        self.log(log_label, ogb_score["rocauc"])  # type: ignore
+            value = 0
+        # the same value on all processes
+        self.log(log_label, value, sync_dist=True)
 
         # free memory
-        self.metric_trues.clear()
-        self.metric_preds.clear()
+        self.metric.reset()
@@ -0,0 +1,173 @@
+import json
+from pathlib import Path
+from typing import Any, Optional, Sequence
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+from torch_geometric.data import Batch, InMemoryDataset
+from pytorch_fob.engine.utils import log_info
+from pytorch_fob.tasks import EpochBatchSampler
+
+
+PACKED_INFO_FILE = "info.json"
+GRAPH_ARRAYS = ["x", "edge_index", "edge_attr", "y"]
+
+
+def packed_graphs_exist(packed_dir: Path) -> bool:
+    return (packed_dir / PACKED_INFO_FILE).is_file()
+
+
+def write_packed_graphs(dataset: InMemoryDataset, packed_dir: Path, split_idx: dict[str, torch.Tensor]):
+    """
+    Writes the collated storage of a PyG `InMemoryDataset` of molecules into flat arrays:
+    the (integer) node and edge features, the edge indices (local to their graph) and the labels of all graphs,
+    missing labels (NaN) stored as -1, the offsets of the nodes and edges of each graph and the indices of each split.
+    The info file is written last and marks the cache as complete.
+    """
+    packed_dir.mkdir(parents=True, exist_ok=True)
+    data, slices = dataset._data, dataset.slices  # pylint: disable=protected-access
+    assert data.x.max() <= np.iinfo(np.uint8).max and data.edge_attr.max() <= np.iinfo(np.uint8).max
+    y = data.y.float()
+    arrays = {
+        "x": data.x.numpy().astype(np.uint8),
+        "edge_index": data.edge_index.t().numpy().astype(np.int32),
+        "edge_attr": data.edge_attr.numpy().astype(np.uint8),
+        "y": torch.where(y.isnan(), -1, y).numpy().astype(np.int8),
+        "node_offsets": slices["x"].numpy().astype(np.int64),
+        "edge_offsets": slices["edge_index"].numpy().astype(np.int64),
+    }
+    for name, array in arrays.items():
+        np.save(packed_dir / f"{name}.npy", array)
+    for split, indices in split_idx.items():
+        np.save(packed_dir / f"{split}_indices.npy", indices.numpy().astype(np.int64))
+    info = {"num_graphs": len(arrays["y"]), "num_tasks": arrays["y"].shape[1], "splits": list(split_idx.keys())}
+    with open(packed_dir / PACKED_INFO_FILE, "w", encoding="utf8") as f:
+        json.dump(info, f, indent=4)
+    log_info(f"packed {info['num_graphs']} graphs into {packed_dir}")
+
+
+def concatenated_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """the indices start, ..., start + length - 1 of all ranges, concatenated"""
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) > 0 else 0)
+
+
+class PackedGraphDataset(Dataset):
+    """
+    Graphs of one split read from the packed arrays, which are memory-mapped in each dataloader worker.
+    Fetching a whole batch at once (`__getitems__`) builds the PyG `Batch` with a few vectorized numpy operations
+    instead of separating each graph from the collated storage and collating them again.
+    """
+    def __init__(self, packed_dir: Path, split: str) -> None:
+        super().__init__()
+        self.packed_dir = packed_dir
+        self.graphs = np.load(packed_dir / f"{split}_indices.npy")
+        self.node_offsets = np.load(packed_dir / "node_offsets.npy")
+        self.edge_offsets = np.load(packed_dir / "edge_offsets.npy")
+        self._arrays: Optional[dict[str, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self.graphs)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # each dataloader worker maps the files on its own
+        return self.__dict__ | {"_arrays": None}
+
+    @property
+    def arrays(self) -> dict[str, np.ndarray]:
+        if self._arrays is None:
+            self._arrays = {name: np.load(self.packed_dir / f"{name}.npy", mmap_mode="r") for name in GRAPH_ARRAYS}
+        return self._arrays
+
+    def num_nodes(self) -> np.ndarray:
+        return np.diff(self.node_offsets)[self.graphs]
+
+    def num_edges(self) -> np.ndarray:
+        return np.diff(self.edge_offsets)[self.graphs]
+
+    def __getitem__(self, index: int) -> Batch:
+        return self.__getitems__([index])
+
+    def __getitems__(self, indices: list[int]) -> Batch:
+        graphs = self.graphs[np.asarray(indices, dtype=np.int64)]
+        node_starts = self.node_offsets[graphs]
+        num_nodes = self.node_offsets[graphs + 1] - node_starts
+        edge_starts = self.edge_offsets[graphs]
+        num_edges = self.edge_offsets[graphs + 1] - edge_starts
+        ptr = np.zeros(len(graphs) + 1, dtype=np.int64)
+        np.cumsum(num_nodes, out=ptr[1:])
+        edges = concatenated_ranges(edge_starts, num_edges)
+        # edge indices are local to their graph, shift them to the nodes of the graph in the batch
+        edge_index = self.arrays["edge_index"][edges].astype(np.int64) + np.repeat(ptr[:-1], num_edges)[:, None]
+        y = self.arrays["y"][graphs].astype(np.float32)
+        y[y < 0] = np.nan
+        return Batch(
+            x=torch.from_numpy(self.arrays["x"][concatenated_ranges(node_starts, num_nodes)].astype(np.int64)),
+            edge_index=torch.from_numpy(edge_index.T.copy()),
+            edge_attr=torch.from_numpy(self.arrays["edge_attr"][edges].astype(np.int64)),
+            y=torch.from_numpy(y),
+            batch=torch.repeat_interleave(torch.arange(len(graphs)), torch.from_numpy(num_nodes)),
+            ptr=torch.from_numpy(ptr)
+        )
+
+
+def collate_batch(batch: Batch) -> Batch:
+    """batches are already built by `PackedGraphDataset.__getitems__`"""
+    return batch
+
+
+class GraphBudgetBatchSampler(EpochBatchSampler):
+    """
+    Packs graphs (in random order) into batches of up to `max_nodes` nodes and `max_edges` edges,
+    a graph exceeding a budget on its own forms a batch by itself.
+    Graph batches are not padded, so this bounds the memory and the work of every step
+    while the number of graphs per batch varies.
+    """
+    def __init__(
+            self,
+            sampler: Sampler | Sequence[int],
+            num_nodes: np.ndarray,
+            num_edges: np.ndarray,
+            max_nodes: Optional[int] = None,
+            max_edges: Optional[int] = None,
+            shuffle: bool = True,
+            seed: int = 0,
+            drop_last: bool = False
+            ) -> None:
+        super().__init__(sampler, drop_last)
+        self.num_nodes = num_nodes
+        self.num_edges = num_edges
+        self.max_nodes = max_nodes if max_nodes is not None else np.iinfo(np.int64).max
+        self.max_edges = max_edges if max_edges is not None else np.iinfo(np.int64).max
+        self.shuffle = shuffle
+        self.seed = seed
+
+    def _pack(self, epoch: int) -> list[list[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        n = len(self.num_nodes)
+        order = torch.randperm(n, generator=generator).tolist() if self.shuffle else list(range(n))
+        nodes = self.num_nodes.tolist()
+        edges = self.num_edges.tolist()
+        batches: list[list[int]] = []
+        batch: list[int] = []
+        batch_nodes = batch_edges = 0
+        for i in order:
+            if batch and (batch_nodes + nodes[i] > self.max_nodes or batch_edges + edges[i] > self.max_edges):
+                batches.append(batch)
+                batch, batch_nodes, batch_edges = [], 0, 0
+            batch.append(i)
+            batch_nodes += nodes[i]
+            batch_edges += edges[i]
+        if batch and not self.drop_last:
+            batches.append(batch)
+        return batches
+
+    def _batch_stats(self, batch: list[int]) -> Sequence[float]:
+        return self.num_nodes[batch].sum(), self.num_edges[batch].sum()
+
+    def _add_sample(self, stats: np.ndarray, sample: int) -> np.ndarray:
+        return stats + np.array([self.num_nodes[sample], self.num_edges[sample]], dtype=stats.dtype)
+
+    def _batch_loads(self, stats: np.ndarray) -> np.ndarray:
+        return np.maximum(stats[:, 0] / self.max_nodes, stats[:, 1] / self.max_edges)
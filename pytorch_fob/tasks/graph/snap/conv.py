@@ -6,6 +6,7 @@ from torch_geometric.nn import MessagePassing
 from torch_geometric.nn import global_add_pool
 from torch_geometric.utils import degree
 from ogb.graphproppred.mol_encoder import AtomEncoder,BondEncoder
+from pytorch_fob.tasks.graph.fused_conv import FusedGINConv, FusedGCNConv
 
 ### GIN convolution along the graph structure
 class GINConv(MessagePassing):
@@ -78,11 +79,13 @@ class GNNNode(torch.nn.Module):
             drop_ratio = 0.5,
             jumping_knowledge = "last",
             residual = False,
-            gnn_type = 'gin'
+            gnn_type = 'gin',
+            fused = False
         ):
         '''
             emb_dim (int): node embedding dimensionality
             num_layer (int): number of GNN message passing layers
+            fused (bool): whether to fuse the message passing (less memory, see fused_conv.py)
 
         '''
 
@@ -104,9 +107,9 @@ class GNNNode(torch.nn.Module):
 
         for _ in range(num_layer):
             if gnn_type == 'gin':
-                self.convs.append(GINConv(emb_dim))
+                self.convs.append(FusedGINConv(emb_dim) if fused else GINConv(emb_dim))
             elif gnn_type == 'gcn':
-                self.convs.append(GCNConv(emb_dim))
+                self.convs.append(FusedGCNConv(emb_dim) if fused else GCNConv(emb_dim))
             else:
                 raise ValueError(f'Undefined GNN type called {gnn_type}')
 
@@ -158,10 +161,12 @@ class GNNNodeVirtualnode(torch.nn.Module):
         drop_ratio = 0.5,
         jumping_knowledge = "last",
         residual = False,
-        gnn_type = 'gin'
+        gnn_type = 'gin',
+        fused = False
     ):
         '''
             emb_dim (int): node embedding dimensionality
+            fused (bool): whether to fuse the message passing (less memory, see fused_conv.py)
         '''
 
         super(GNNNodeVirtualnode, self).__init__()
@@ -190,9 +195,9 @@ class GNNNodeVirtualnode(torch.nn.Module):
 
         for _ in range(num_layer):
             if gnn_type == 'gin':
-                self.convs.append(GINConv(emb_dim))
+                self.convs.append(FusedGINConv(emb_dim) if fused else GINConv(emb_dim))
             elif gnn_type == 'gcn':
-                self.convs.append(GCNConv(emb_dim))
+                self.convs.append(FusedGCNConv(emb_dim) if fused else GCNConv(emb_dim))
             else:
                 raise ValueError(f'Undefined GNN type called {gnn_type}')
 
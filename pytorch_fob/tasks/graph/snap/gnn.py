@@ -17,11 +17,13 @@ class GNN(torch.nn.Module):
             residual = False,
             drop_ratio = 0.5,
             jumping_knowledge = "last",
-            graph_pooling = "mean"
+            graph_pooling = "mean",
+            fused = False
         ):
         '''
             num_tasks (int): number of labels to be predicted
             virtual_node (bool): whether to add virtual node or not
+            fused (bool): whether to fuse the message passing of the convolutions
         '''
 
         super(GNN, self).__init__()
@@ -44,7 +46,8 @@ class GNN(torch.nn.Module):
                 jumping_knowledge = jumping_knowledge,
                 drop_ratio = drop_ratio,
                 residual = residual,
-                gnn_type = gnn_type
+                gnn_type = gnn_type,
+                fused = fused
             )
         else:
             self.gnn_node = GNNNode(
@@ -53,7 +56,8 @@ class GNN(torch.nn.Module):
                 jumping_knowledge = jumping_knowledge,
                 drop_ratio = drop_ratio,
                 residual = residual,
-                gnn_type = gnn_type
+                gnn_type = gnn_type,
+                fused = fused
             )
 
 
@@ -10,5 +10,5 @@ def get_datamodule(config: TaskConfig) -> TaskDataModule:
 
 def get_task(optimizer: Optimizer, config: TaskConfig) -> tuple[TaskModel, TaskDataModule]:
     datamodule = data.OGBGDataModule(config)
-    ogbg_model = model.OGBGModel(optimizer, config)
+    ogbg_model = model.OGBGModel(optimizer, config, datamodule.dataset_name)
     return ogbg_model, datamodule
@@ -1,8 +1,71 @@
+from functools import partial
+import torch
+from torch.utils.data import DataLoader
 import torch_geometric.loader as geom_loader
+from torch_geometric.data import Data
 from torch_geometric.datasets import Planetoid
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
 from torch_geometric.transforms import NormalizeFeatures
 from pytorch_fob.tasks import TaskDataModule
+from pytorch_fob.tasks.synthetic import SyntheticDataset
 from pytorch_fob.engine.configs import TaskConfig
+from pytorch_fob.engine.utils import log_info
+
+
+NUM_NODES = 2708
+NUM_FEATURES = 1433
+NUM_CLASSES = 7
+NUM_EDGES = 5278  # undirected
+WORDS_PER_NODE = 18  # on average
+TRAIN_PER_CLASS = 20
+NUM_VAL = 500
+NUM_TEST = 1000
+
+
+def synthetic_graph(generator: torch.Generator, index: int, split: str) -> Data:
+    """
+    Random graph with the sizes of cora: normalized bag of words features, undirected edges
+    and the masks of the `split` ('public' and 'random' have the same sizes).
+    """
+    words = torch.rand(NUM_NODES, NUM_FEATURES, generator=generator) < WORDS_PER_NODE / NUM_FEATURES
+    x = words.float()
+    x = x / x.sum(dim=-1, keepdim=True).clamp(min=1)
+    edges = torch.randint(0, NUM_NODES, (2, NUM_EDGES), generator=generator)
+    edge_index = torch.cat([edges, edges.flip(0)], dim=1)
+    y = torch.randint(0, NUM_CLASSES, (NUM_NODES,), generator=generator)
+    train_mask = torch.zeros(NUM_NODES, dtype=torch.bool)
+    val_mask = torch.zeros(NUM_NODES, dtype=torch.bool)
+    test_mask = torch.zeros(NUM_NODES, dtype=torch.bool)
+    val_mask[NUM_CLASSES * TRAIN_PER_CLASS:NUM_CLASSES * TRAIN_PER_CLASS + NUM_VAL] = True
+    test_mask[-NUM_TEST:] = True
+    if split == "full":
+        train_mask = ~(val_mask | test_mask)
+    else:
+        train_mask[:NUM_CLASSES * TRAIN_PER_CLASS] = True
+    return Data(x=x, edge_index=edge_index, y=y, train_mask=train_mask, val_mask=val_mask, test_mask=test_mask)
+
+
+def adjacency_matrix(edge_index: torch.Tensor, num_nodes: int, normalize: bool = True) -> torch.Tensor:
+    """
+    The transposed adjacency (targets x sources) as sparse CSR tensor, as `GCNConv` applies it:
+    with self loops and symmetrically normalized like `gcn_norm` if `normalize`, else the plain adjacency.
+    """
+    if normalize:
+        edge_index, edge_weight = gcn_norm(edge_index, num_nodes=num_nodes, add_self_loops=True)
+    else:
+        edge_weight = torch.ones(edge_index.size(1))
+    row, col = edge_index
+    adj_t = torch.sparse_coo_tensor(torch.stack([col, row]), edge_weight, (num_nodes, num_nodes))
+    return adj_t.coalesce().to_sparse_csr()
+
+
+def precompute_graph(graph: Data, normalize: bool = True, propagation_steps: int = 0) -> dict[str, torch.Tensor]:
+    """the adjacency matrix and the (normalized) features, propagated `propagation_steps` times like in SGC"""
+    adj_t = adjacency_matrix(graph.edge_index, graph.num_nodes, normalize)
+    x = graph.x
+    for _ in range(propagation_steps):
+        x = adj_t @ x
+    return {"x": x, "adj_t": adj_t}
 
 
 class CoraDataModule(TaskDataModule):
@@ -14,9 +77,19 @@ class CoraDataModule(TaskDataModule):
         self.batch_size = 1  # As we have a single graph, we use a batch size of 1
         self.data_dir = self.data_dir / "Planetoid"
         self.split = config.dataset_split
+        self.normalize: bool = config.model.normalize
+        self.precompute: bool = config.get("precompute_graph", False)
+        self.propagation_steps: int = config.get("sgc_propagation_steps", 0)
+        if self.propagation_steps > 0 and not self.precompute:
+            raise ValueError("sgc_propagation_steps requires precompute_graph!")
+        # only the graph is cached, the masks of the 'random' split depend on the seed
+        adjacency = "gcn_norm" if self.normalize else "adjacency"
+        self.precomputed_file = self.data_dir / "Cora" / f"precomputed_{adjacency}_k{self.propagation_steps}.pt"
 
     def prepare_data(self):
         """Load citation network dataset (cora)"""
+        if self.synthetic:
+            return
         self.data_dir.mkdir(exist_ok=True, parents=True)
 
         # dataset split:
@@ -34,14 +107,25 @@ class CoraDataModule(TaskDataModule):
         #   train, validation, and test sets will be randomly generated,
         #   according to num_train_per_class, num_val and num_test. (default: "public")
 
-        Planetoid(root=str(self.data_dir), name='Cora', split=self.split, transform=NormalizeFeatures())
+        dataset = Planetoid(root=str(self.data_dir), name='Cora', split=self.split, transform=NormalizeFeatures())
+        if self.precompute and not self.precomputed_file.is_file():
+            log_info(f"precomputing {self.precomputed_file.name}...")
+            self.precomputed_file.parent.mkdir(exist_ok=True, parents=True)
+            tmp_file = self.precomputed_file.with_suffix(".pt.tmp")
+            torch.save(precompute_graph(dataset[0], self.normalize, self.propagation_steps), tmp_file)
+            tmp_file.rename(self.precomputed_file)
 
     def setup(self, stage: str):
         """setup is called from every process across all the nodes. Setting state here is recommended.
         for this task the forward pass will use masks and
         only calculate the loss on the nodes corresponding to the mask
         """
-        dataset = Planetoid(root=str(self.data_dir), name='Cora', split=self.split, transform=NormalizeFeatures())
+        if self.synthetic:
+            dataset = self.synthetic_dataset("train")
+        else:
+            dataset = Planetoid(root=str(self.data_dir), name='Cora', split=self.split, transform=NormalizeFeatures())
+        if self.precompute:
+            dataset = [self._precomputed_graph(dataset[0])]
         if stage == "fit":
             self.data_train = dataset
             self.data_val = dataset
@@ -54,7 +138,23 @@ class CoraDataModule(TaskDataModule):
         else:
             raise NotImplementedError()
 
+    def synthetic_dataset(self, split: str):
+        # all stages use the same graph, the masks select the nodes of each split
+        return SyntheticDataset(1, partial(synthetic_graph, split=self.split))
+
+    def _precomputed_graph(self, graph: Data) -> Data:
+        """the graph with the precomputed features and adjacency (`adj_t`) instead of the edges"""
+        if self.synthetic:
+            precomputed = precompute_graph(graph, self.normalize, self.propagation_steps)
+        else:
+            precomputed = torch.load(self.precomputed_file)
+        masks = {k: graph[k] for k in ["train_mask", "val_mask", "test_mask"]}
+        return Data(x=precomputed["x"], adj_t=precomputed["adj_t"], y=graph.y, **masks)
+
     def get_dataloader(self, dataset):
+        if self.precompute:
+            # the graph is already complete, no collation and no workers which would copy it every epoch
+            return DataLoader(dataset, batch_size=None, num_workers=0)
         return geom_loader.DataLoader(dataset, batch_size=self.batch_size, num_workers=self.workers)
 
     def train_dataloader(self):
@@ -19,22 +19,33 @@ class CoraModel(TaskModel):
         normalize = config.model.normalize
         dropout = config.model.dropout
         reset_params = config.model.reset_params
-        model = GCN(
-            hidden_channels=hidden_channels,
-            num_layers=num_layers,
-            dropout=dropout,
-            cached=cached,
-            normalize=normalize,
-            reset_params=reset_params
-        )
+        # the datamodule provides the (normalized) adjacency `adj_t` instead of the edges
+        self.precompute: bool = config.get("precompute_graph", False)
+        self.log_all_masks: bool = config.get("log_all_masks", False)
+        self.sgc: bool = config.get("sgc_propagation_steps", 0) > 0
+        if self.sgc:
+            # the features are already propagated
+            model = SGC()
+        else:
+            model = GCN(
+                hidden_channels=hidden_channels,
+                num_layers=num_layers,
+                dropout=dropout,
+                cached=cached,
+                normalize=normalize and not self.precompute,
+                reset_params=reset_params
+            )
 
         super().__init__(model, optimizer, config)
         self.loss_fn = nn.CrossEntropyLoss()
 
-    def forward(self, data: geom_data.data.BaseData, mode="train") -> tuple[Tensor, Tensor]:
-        x, edge_index = data.x, data.edge_index
-        x = self.model(x, edge_index)
+    def forward(self, data: geom_data.data.BaseData) -> Tensor:
+        """log probabilities of all nodes, the masks select the nodes of each split"""
+        if self.sgc:
+            return self.model(data.x)
+        return self.model(data.x, data.adj_t if self.precompute else data.edge_index)
 
+    def masked_loss_and_acc(self, x: Tensor, data: geom_data.data.BaseData, mode: str) -> tuple[Tensor, Tensor]:
         # Only calculate the loss on the nodes corresponding to the mask
         if mode == "train":
             mask = data.train_mask
@@ -50,20 +61,39 @@ class CoraModel(TaskModel):
         return loss, acc
 
     def training_step(self, batch, batch_idx):
-        loss, acc = self.forward(batch, mode="train")
+        loss, acc = self.masked_loss_and_acc(self.forward(batch), batch, "train")
         self.log("train_loss", loss, on_epoch=True, batch_size=self.batch_size)
         self.log("train_acc", acc, on_epoch=True, batch_size=self.batch_size)
         return loss
 
     def validation_step(self, batch, batch_idx):
-        _, acc = self.forward(batch, mode="val")
+        x = self.forward(batch)
+        _, acc = self.masked_loss_and_acc(x, batch, "val")
         self.log("val_acc", acc, on_epoch=True, batch_size=self.batch_size)
+        if self.log_all_masks:
+            # the other splits from the same forward pass
+            for mode in ["train", "test"]:
+                _, acc = self.masked_loss_and_acc(x, batch, mode)
+                self.log(f"val_{mode}_acc", acc, on_epoch=True, batch_size=self.batch_size)
 
     def test_step(self, batch, batch_idx):
-        _, acc = self.forward(batch, mode="test")
+        _, acc = self.masked_loss_and_acc(self.forward(batch), batch, "test")
         self.log("test_acc", acc, on_epoch=True, batch_size=self.batch_size)
 
 
+class SGC(torch.nn.Module):
+    """
+    logistic regression on features propagated K times with the normalized adjacency,
+    from https://arxiv.org/abs/1902.07153 (Simplifying Graph Convolutional Networks)
+    """
+    def __init__(self, num_features=1433, num_classes=7):
+        super().__init__()
+        self.linear = nn.Linear(num_features, num_classes)
+
+    def forward(self, x):
+        return F.log_softmax(self.linear(x), dim=1)
+
+
 class GCN(torch.nn.Module):
     def __init__(
             self,
@@ -1,8 +1,10 @@
+from functools import partial
 from torch.utils.data import random_split
 from torchvision.datasets import MNIST
 from torchvision import transforms
 from pytorch_fob.engine.configs import TaskConfig
 from pytorch_fob.tasks import TaskDataModule
+from pytorch_fob.tasks.synthetic import SyntheticDataset, classification_sample
 
 
 class MNISTDataModule(TaskDataModule):
@@ -20,6 +22,8 @@ class MNISTDataModule(TaskDataModule):
                                              transforms.Normalize(mean, std)])
 
     def prepare_data(self):
+        if self.synthetic:
+            return
         # download
         MNIST(str(self.data_dir), train=True, download=True)
         MNIST(str(self.data_dir), train=False, download=True)
@@ -27,6 +31,10 @@ class MNISTDataModule(TaskDataModule):
     def setup(self, stage: str):
         """setup is called from every process across all the nodes. Setting state here is recommended.
         """
+        if self.synthetic:
+            self.setup_synthetic(stage)
+            return
+
         # Assign train/val datasets for use in dataloaders
         if stage == "fit":
             mnist_full = MNIST(str(self.data_dir), train=True, transform=self.transform)
@@ -39,3 +47,11 @@ class MNISTDataModule(TaskDataModule):
 
         if stage == "predict":
             self.data_predict = MNIST(str(self.data_dir), train=False, transform=self.transform)
+
+    def synthetic_dataset(self, split: str):
+        length = {"train": self.train_val_split[0], "validation": self.train_val_split[1], "test": 10000}[split]
+        return SyntheticDataset(
+            length,
+            partial(classification_sample, shape=(28, 28, 1), num_classes=10, transform=self.transform),
+            split
+        )
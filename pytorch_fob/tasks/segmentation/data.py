@@ -1,11 +1,118 @@
 import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
 import numpy as np
-from datasets import load_dataset, Dataset
+import torch
+from datasets import load_dataset, Dataset as HFDataset
 from huggingface_hub import hf_hub_download
-from transformers import SegformerImageProcessor
-from torchvision.transforms import v2
+from PIL import Image
+from torch.utils.data import Dataset
+from transformers.utils import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from pytorch_fob.engine.configs import TaskConfig
+from pytorch_fob.engine.utils import log_info
 from pytorch_fob.tasks import TaskDataModule
+from pytorch_fob.tasks.batch_augmentation import random_resized_crop_and_flip
+from pytorch_fob.tasks.synthetic import SyntheticDataset
+
+
+# scene_parse_150 with the image size of the mit-b0 image processor
+SPLITS = ["train", "validation"]
+SPLIT_SIZES = {"train": 20210, "validation": 2000}
+NUM_LABELS = 150
+IGNORE_INDEX = 255
+IMAGE_SIZE = 512
+SHARD_SIZE = 1000
+CROP_SCALE = (0.5, 2.0)  # as stated in paper
+SEGMENT_SIZE = 32
+IGNORE_RATE = 0.1
+
+
+def synthetic_sample(generator: torch.Generator, index: int) -> dict[str, torch.Tensor]:
+    """like a sample of `SegmentationShards`: a uint8 image and reduced labels made of square segments"""
+    pixel_values = torch.randint(0, 256, (3, IMAGE_SIZE, IMAGE_SIZE), generator=generator, dtype=torch.uint8)
+    n = IMAGE_SIZE // SEGMENT_SIZE
+    segments = torch.randint(0, NUM_LABELS, (n, n), generator=generator, dtype=torch.uint8)
+    segments[torch.rand(n, n, generator=generator) < IGNORE_RATE] = IGNORE_INDEX
+    labels = segments.repeat_interleave(SEGMENT_SIZE, dim=0).repeat_interleave(SEGMENT_SIZE, dim=1)
+    return {"pixel_values": pixel_values, "labels": labels}
+
+
+def shard_files(cache_dir: Path, split: str, shard: int) -> tuple[Path, Path]:
+    return cache_dir / f"{split}_{shard:03d}_images.npy", cache_dir / f"{split}_{shard:03d}_labels.npy"
+
+
+def reduce_labels(annotation: np.ndarray) -> np.ndarray:
+    """like `do_reduce_labels` of the image processor: 0 (other) is ignored, all other labels are shifted by 1"""
+    return np.where(annotation == 0, IGNORE_INDEX, annotation.astype(np.int16) - 1).astype(np.uint8)
+
+
+def pack_shard(ds: HFDataset, cache_dir: Path, split: str, shard: int) -> list[int]:
+    """
+    Decodes the images of one shard, resizes them (bilinear) and their reduced labels (nearest) to
+    IMAGE_SIZE x IMAGE_SIZE like the image processor and writes them into uint8 arrays of shape
+    N x 3 x IMAGE_SIZE x IMAGE_SIZE and N x IMAGE_SIZE x IMAGE_SIZE.
+    Returns the indices of the invalid (grayscale) images, which are left empty.
+    """
+    images_file, labels_file = shard_files(cache_dir, split, shard)
+    start = shard * SHARD_SIZE
+    stop = min(start + SHARD_SIZE, len(ds))
+    tmp_images = images_file.with_suffix(".npy.tmp")
+    tmp_labels = labels_file.with_suffix(".npy.tmp")
+    images = np.lib.format.open_memmap(tmp_images, mode="w+", dtype=np.uint8,
+                                       shape=(stop - start, 3, IMAGE_SIZE, IMAGE_SIZE))
+    labels = np.lib.format.open_memmap(tmp_labels, mode="w+", dtype=np.uint8,
+                                       shape=(stop - start, IMAGE_SIZE, IMAGE_SIZE))
+    invalid = []
+    for i in range(start, stop):
+        sample = ds[i]
+        image: Image.Image = sample["image"]
+        if np.asarray(image).ndim < 3:
+            invalid.append(i)
+            continue
+        image = image.convert("RGB").resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR)
+        annotation = sample["annotation"].resize((IMAGE_SIZE, IMAGE_SIZE), Image.NEAREST)
+        images[i - start] = np.asarray(image).transpose(2, 0, 1)
+        labels[i - start] = reduce_labels(np.asarray(annotation))
+    images.flush()
+    labels.flush()
+    del images, labels
+    tmp_images.rename(images_file)
+    tmp_labels.rename(labels_file)
+    return invalid
+
+
+class SegmentationShards(Dataset):
+    """
+    Serves the packed images and reduced labels of a split without decoding them, skipping the invalid images.
+    The shards are mapped read-only in each dataloader worker on first access.
+    """
+    def __init__(self, cache_dir: Path, split: str) -> None:
+        super().__init__()
+        with open(cache_dir / "info.json", "r", encoding="utf8") as f:
+            split_info = json.load(f)["splits"][split]
+        self.cache_dir = cache_dir
+        self.split = split
+        self.indices = np.setdiff1d(np.arange(split_info["num_samples"]), split_info["invalid"])
+        self._shards: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # each dataloader worker maps the files on its own
+        return self.__dict__ | {"_shards": {}}
+
+    def _shard(self, shard: int) -> tuple[np.ndarray, np.ndarray]:
+        if shard not in self._shards:
+            images_file, labels_file = shard_files(self.cache_dir, self.split, shard)
+            self._shards[shard] = (np.load(images_file, mmap_mode="r"), np.load(labels_file, mmap_mode="r"))
+        return self._shards[shard]
+
+    def __getitem__(self, index) -> dict[str, torch.Tensor]:
+        shard, i = divmod(int(self.indices[index]), SHARD_SIZE)
+        images, labels = self._shard(shard)
+        return {"pixel_values": torch.from_numpy(np.array(images[i])), "labels": torch.from_numpy(np.array(labels[i]))}
 
 
 class SegmentationDataModule(TaskDataModule):
@@ -14,81 +121,83 @@ class SegmentationDataModule(TaskDataModule):
     Implementation inspired by 🤗 examples and tutorials:
     - https://github.com/huggingface/transformers/tree/main/examples/pytorch/semantic-segmentation
     - https://huggingface.co/blog/fine-tune-segformer
+    The images are decoded and resized once into shards of uint8 arrays (see `pack_shard`),
+    the random crop and flip and the normalization are applied to whole batches on the device.
     """
     def __init__(self, config: TaskConfig):
         super().__init__(config)
         self.revision = "ac1c0c0e23875e74cd77aca0fd725fd6a35c3667"
-        image_processor = SegformerImageProcessor.from_pretrained(
-            "nvidia/mit-b0",
-            cache_dir=self.data_dir
-        )
-        # image_processor = SegformerImageProcessor.from_pretrained(
-        #     "nvidia/segformer-b0-finetuned-ade-512-512",
-        #     cache_dir=self.data_dir
-        # )
-        tgt_size = (image_processor.size["width"], image_processor.size["height"])
-        tv_train_transforms = v2.Compose([
-            v2.RandomResizedCrop(
-                size=tgt_size,
-                scale=(0.5, 2.0)  # as stated in paper
-            ),
-            v2.RandomHorizontalFlip()
-        ])
-        tv_val_transforms = v2.Identity()
-
-        def trainval_transforms(tv_transforms):
-            def transforms_fn(batch):
-                images = []
-                targets = []
-                for image, target in zip(batch["image"], batch["annotation"]):
-                    img, tgt = tv_transforms(image, target)
-                    images.append(img)
-                    targets.append(tgt)
-                return image_processor(images, targets, do_reduce_labels=True)
-            return transforms_fn
-
-        self.train_transforms = trainval_transforms(tv_train_transforms)
-        self.val_transforms = trainval_transforms(tv_val_transforms)
-        id2label, label2id = self._get_label_dicts()
-        self.id2label = id2label
-        self.label2id = label2id
-        self.num_labels = len(id2label)
+        self.cache_dir = self.data_dir / f"scene_parse_150_{IMAGE_SIZE}x{IMAGE_SIZE}_uint8"
+        self.prepare_workers = max(1, self.workers)
+        self.mean = torch.tensor(IMAGENET_DEFAULT_MEAN).view(1, -1, 1, 1)
+        self.std = torch.tensor(IMAGENET_DEFAULT_STD).view(1, -1, 1, 1)
+        if self.synthetic:
+            # nothing needs to be downloaded
+            self.id2label = {i: str(i) for i in range(NUM_LABELS)}
+        else:
+            self.id2label, _ = self._get_label_dicts()
+        self.label2id = {v: k for k, v in self.id2label.items()}
+        self.num_labels = len(self.id2label)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        images, labels = batch["pixel_values"], batch["labels"]
+        if self.trainer is not None and self.trainer.training:
+            images, labels = random_resized_crop_and_flip(
+                images, IMAGE_SIZE, scale=CROP_SCALE, flip_p=0.5, labels=labels
+            )
+        mean = self.mean.to(images.device)
+        std = self.std.to(images.device)
+        return {"pixel_values": (images.float() / 255.0 - mean) / std, "labels": labels.long()}
 
     def prepare_data(self):
-        self.data_dir.mkdir(exist_ok=True)
-        load_dataset("scene_parse_150", cache_dir=str(self.data_dir), trust_remote_code=True, revision=self.revision)
+        if self.synthetic or (self.cache_dir / "info.json").exists():
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        info: dict[str, Any] = {"image_size": IMAGE_SIZE, "shard_size": SHARD_SIZE, "splits": {}}
+        for split in SPLITS:
+            ds = self._load_dataset(split)
+            num_shards = -(-len(ds) // SHARD_SIZE)
+            log_info(f"packing {len(ds)} {split} images into {num_shards} shards...")
+            with ProcessPoolExecutor(max_workers=self.prepare_workers) as pool:
+                shards = [pool.submit(pack_shard, ds, self.cache_dir, split, k) for k in range(num_shards)]
+                invalid = sorted(i for shard in shards for i in shard.result())
+            log_info(f"{len(invalid)} invalid {split} images")
+            info["splits"][split] = {"num_samples": len(ds), "invalid": invalid}
+        # written last, marks the cache as complete
+        with open(self.cache_dir / "info.json", "w", encoding="utf8") as f:
+            json.dump(info, f, indent=4)
+        log_info("scene_parse_150 cache written")
 
     def setup(self, stage: str):
         """setup is called from every process across all the nodes. Setting state here is recommended.
         """
+        if self.synthetic:
+            self.setup_synthetic(stage)
+            return
         if stage == "fit":
-            self.data_train = self._load_dataset("train")
-            self.data_val = self._load_dataset("validation")
-            self.data_train.set_transform(self.train_transforms)
-            self.data_val.set_transform(self.val_transforms)
+            self.data_train = SegmentationShards(self.cache_dir, "train")
+            self.data_val = SegmentationShards(self.cache_dir, "validation")
         if stage == "validate":
-            self.data_val = self._load_dataset("validation")
-            self.data_val.set_transform(self.val_transforms)
+            self.data_val = SegmentationShards(self.cache_dir, "validation")
+        # no labels available for test split, so we use val
         if stage == "test":
-            # no labels available for test split, so we use val
-            self.data_test = self._load_dataset("validation")
-            self.data_test.set_transform(self.val_transforms)
+            self.data_test = SegmentationShards(self.cache_dir, "validation")
         if stage == "predict":
-            self.data_predict = self._load_dataset("test")
-            self.data_predict.set_transform(self.val_transforms)
+            self.data_predict = SegmentationShards(self.cache_dir, "validation")
 
-    def _load_dataset(self, split: str) -> Dataset:
-        ds = load_dataset(
+    def synthetic_dataset(self, split: str):
+        # like the real data, test uses the validation split
+        split = "train" if split == "train" else "validation"
+        return SyntheticDataset(SPLIT_SIZES[split], synthetic_sample, split)
+
+    def _load_dataset(self, split: str) -> HFDataset:
+        return load_dataset(
             "scene_parse_150",
             cache_dir=str(self.data_dir),
             split=split,
             trust_remote_code=True,
             revision=self.revision
-        )
-        return self._remove_invalid_images(ds)  # type:ignore
-
-    def _remove_invalid_images(self, dataset: Dataset) -> Dataset:
-        return dataset.filter(lambda d: np.array(d["image"]).ndim >= 3)
+        )  # type:ignore
 
     def _get_label_dicts(self) -> tuple[dict[int, str], dict[str, int]]:
         repo_id = "huggingface/label-files"
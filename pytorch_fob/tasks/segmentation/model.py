@@ -1,12 +1,10 @@
-import logging
 import torch
 from torch.nn.functional import interpolate
-from mmseg.evaluation.metrics import IoUMetric
-from mmengine.logging import MMLogger
 from transformers import SegformerForSemanticSegmentation, SegformerConfig
 from pytorch_fob.tasks import TaskModel
 from pytorch_fob.engine.parameter_groups import GroupedModel, ParameterGroup, wd_group_named_parameters, merge_parameter_splits
 from pytorch_fob.engine.configs import TaskConfig
+from pytorch_fob.engine.utils import log_warn
 from pytorch_fob.optimizers import Optimizer
 from .segformer_contiguous import SegformerForSemanticSegmentationContiguous
 
@@ -29,6 +27,42 @@ class SegFormerGroupedModel(GroupedModel):
         return merge_parameter_splits(split1, split2)
 
 
+class ConfusionMatrixIoU():
+    """
+    Accumulates the confusion matrix (labels x predictions) of all pixels batch by batch on the device,
+    which is all that is needed for the IoU metrics of mmsegmentation's `IoUMetric`.
+    """
+    def __init__(self, num_classes: int, ignore_index: int = 255) -> None:
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+        self.matrix = torch.zeros(num_classes, num_classes, dtype=torch.long)
+
+    def update(self, preds: torch.Tensor, labels: torch.Tensor):
+        if self.matrix.device != preds.device:
+            self.matrix = self.matrix.to(preds.device)
+        valid = labels != self.ignore_index
+        index = labels[valid] * self.num_classes + preds[valid]
+        self.matrix += torch.bincount(index, minlength=self.num_classes**2).view(self.num_classes, self.num_classes)
+
+    def compute(self, matrix: torch.Tensor) -> dict[str, float]:
+        """overall accuracy, mean IoU and mean accuracy (in percent) of the classes which occur"""
+        matrix = matrix.double()
+        intersect = matrix.diagonal()
+        area_label = matrix.sum(dim=1)
+        area_pred = matrix.sum(dim=0)
+        iou = intersect / (area_label + area_pred - intersect)
+        acc = intersect / area_label
+        metrics = {
+            "aAcc": intersect.sum() / area_label.sum(),
+            "mIoU": iou.nanmean(),
+            "mAcc": acc.nanmean()
+        }
+        return {k: round(v.item() * 100, 2) for k, v in metrics.items()}
+
+    def reset(self):
+        self.matrix.zero_()
+
+
 class SegmentationModel(TaskModel):
     """
     Lightning Module for SceneParse150 semantic segmentation task.
@@ -47,29 +81,34 @@ class SegmentationModel(TaskModel):
             config: TaskConfig
             ):
         model_name = config.model.name
-        model_config = SegformerConfig.from_pretrained(
-            model_name,
-            cache_dir=config.data_dir,
-            id2label=id2label,
-            label2id=label2id
-        )
         if config.model.contiguous_memory:
             model_class = SegformerForSemanticSegmentationContiguous
         else:
             model_class = SegformerForSemanticSegmentation
-        if config.model.use_pretrained_model:
+        if config.get("synthetic", False):
+            # nothing is downloaded, the default config is the architecture of mit-b0
+            if model_name != "nvidia/mit-b0" or config.model.use_pretrained_model:
+                log_warn("synthetic data uses the randomly initialized mit-b0 architecture")
+            model = model_class(SegformerConfig(id2label=id2label, label2id=label2id))
+        elif config.model.use_pretrained_model:
             model = model_class.from_pretrained(
                 "nvidia/segformer-b0-finetuned-ade-512-512",
                 cache_dir=config.data_dir
             )
         else:
+            model_config = SegformerConfig.from_pretrained(
+                model_name,
+                cache_dir=config.data_dir,
+                id2label=id2label,
+                label2id=label2id
+            )
             model = model_class.from_pretrained(
                 model_name,
                 cache_dir=config.data_dir,
                 config=model_config
             )
         super().__init__(SegFormerGroupedModel(model), optimizer, config)  # type:ignore
-        self.metric = self._get_metric()
+        self.metric = ConfusionMatrixIoU(len(id2label))
 
     def forward(self, x):
         return self.model(**x)
@@ -95,26 +134,16 @@ class SegmentationModel(TaskModel):
             size=labels.shape[-2:],
             mode="bilinear",
             align_corners=False
-        ).argmax(dim=1).detach().cpu().split(logits.size(0))
-        labels = labels.detach().cpu().split(logits.size(0))
-        samples = [{
-            'pred_sem_seg': {'data': pred},
-            'gt_sem_seg': {'data': label},
-        } for pred, label in zip(preds, labels)]
-        self.metric.process({}, samples)
+        ).argmax(dim=1)
+        self.metric.update(preds.detach(), labels.detach())
 
     def _reset_metric(self):
-        self.metric = self._get_metric()
-
-    def _get_metric(self):
-        metric = IoUMetric()
-        logger: MMLogger = MMLogger.get_current_instance()
-        logger.setLevel(logging.WARN)
-        metric.dataset_meta = {"classes": list(range(150))}
-        return metric
+        self.metric.reset()
 
     def _compute_and_log_metrics(self, stage: str):
-        metrics = self.metric.compute_metrics(self.metric.results)
+        """metrics of the confusion matrix summed over all processes"""
+        matrix = self.trainer.strategy.reduce(self.metric.matrix.to(self.device), reduce_op="sum")
+        metrics = self.metric.compute(matrix)
         for k, v in metrics.items():
             self.log(f"{stage}_{k}", v, sync_dist=True)
         self._reset_metric()
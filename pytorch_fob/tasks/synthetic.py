@@ -0,0 +1,67 @@
+from typing import Any, Callable, Optional
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+SPLIT_SEEDS = {"train": 0, "validation": 1, "test": 2}
+
+
+def sample_generator(seed: int, index: int) -> torch.Generator:
+    """generator which only depends on the split seed and the index of the sample"""
+    generator = torch.Generator()
+    generator.manual_seed((seed << 32) + index)
+    return generator
+
+
+def random_int(generator: torch.Generator, low: int, high: int) -> int:
+    """random integer in [low, high)"""
+    return int(torch.randint(low, high, (1,), generator=generator))
+
+
+def random_image(generator: torch.Generator, height: int, width: int, channels: int = 3) -> np.ndarray:
+    """uint8 image in HWC layout like the images decoded from the datasets"""
+    return torch.randint(0, 256, (height, width, channels), generator=generator, dtype=torch.uint8).numpy()
+
+
+class SyntheticDataset(Dataset):
+    """
+    Random samples with the shapes and dtypes of a real dataset, for benchmarking without any I/O.
+    Sample `index` is created on access by `make_sample(generator, index)` from a generator seeded with
+    the split and the index only, so it is the same in every epoch, worker process and rank.
+    """
+    def __init__(
+            self,
+            length: int,
+            make_sample: Callable[[torch.Generator, int], Any],
+            split: str = "train"
+            ) -> None:
+        self.length = length
+        self.make_sample = make_sample
+        self.seed = SPLIT_SEEDS[split]
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> Any:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(f"index {index} is out of range for {self.length} samples")
+        return self.make_sample(sample_generator(self.seed, index), index)
+
+
+def classification_sample(
+        generator: torch.Generator,
+        index: int,
+        shape: tuple[int, int, int],
+        num_classes: int,
+        transform: Optional[Callable] = None
+        ) -> tuple[Any, int]:
+    """(image, label) with a HWC uint8 image of `shape`, passed through the `transform` of the task"""
+    image: Any = random_image(generator, *shape)
+    label = random_int(generator, 0, num_classes)
+    if transform is not None:
+        image = transform(image)
+    return image, label
+
@@ -8,19 +8,30 @@ from sklearn.datasets import fetch_california_housing
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import QuantileTransformer, StandardScaler
 from pytorch_fob.tasks import TaskDataModule
+from pytorch_fob.tasks.synthetic import SyntheticDataset
 from pytorch_fob.engine.utils import log_debug
 
 
+N_FEATURES = 8
+
+
+def synthetic_sample(generator: torch.Generator, index: int) -> tuple[Tensor, Tensor]:
+    """standard normal features and target, like after the preprocessing"""
+    values = torch.randn(N_FEATURES + 1, generator=generator)
+    return values[:-1], values[-1]
+
+
 class TabularDataset(Dataset):
     def __init__(self, features: np.ndarray, targets: np.ndarray) -> None:
         self.features = features
         self.targets = targets
+        self.tensors = (torch.from_numpy(features), torch.from_numpy(targets))
 
     def __len__(self) -> int:
         return len(self.targets)
 
     def __getitem__(self, index) -> tuple[Tensor, Tensor]:
-        return torch.from_numpy(self.features[index]), torch.as_tensor(self.targets[index])
+        return self.tensors[0][index], self.tensors[1][index]
 
 
 class TabularDataModule(TaskDataModule):
@@ -29,6 +40,8 @@ class TabularDataModule(TaskDataModule):
     """
 
     def prepare_data(self):
+        if self.synthetic:
+            return
         self.data_dir.mkdir(exist_ok=True)
         fetch_california_housing(data_home=str(self.data_dir), download_if_missing=True)
         log_debug("succesfully downloaded tabular dataset.")
@@ -36,6 +49,9 @@ class TabularDataModule(TaskDataModule):
     def setup(self, stage: str):
         """setup is called from every process across all the nodes. Setting state here is recommended.
         """
+        if self.synthetic:
+            self.setup_synthetic(stage)
+            return
         features, targets = fetch_california_housing(data_home=str(self.data_dir), return_X_y=True)
         targets = targets.astype(np.float32)  # type:ignore
         features = features.astype(np.float32)  # type:ignore
@@ -76,6 +92,10 @@ class TabularDataModule(TaskDataModule):
                 target_preprocessor(targets[test_idx])
             )
 
+    def synthetic_dataset(self, split: str):
+        length = {"train": self.config.train_size, "validation": self.config.val_size, "test": self.config.test_size}
+        return SyntheticDataset(length[split], synthetic_sample, split)
+
     def _load_test_idx(self) -> np.ndarray:
         # using test idx from https://github.com/yandex-research/rtdl-revisiting-models
         path = Path(__file__).resolve().parent / "idx_test.npy"
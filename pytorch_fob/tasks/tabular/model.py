@@ -1,8 +1,8 @@
 import torch
-from sklearn.metrics import r2_score, root_mean_squared_error
 from rtdl_revisiting_models import FTTransformer, _CLSEmbedding, LinearEmbeddings, CategoricalEmbeddings
 from pytorch_fob.engine.configs import TaskConfig
 from pytorch_fob.engine.parameter_groups import GroupedModel, ParameterGroup, group_named_parameters
+from pytorch_fob.engine.utils import log_warn
 from pytorch_fob.tasks import TaskModel
 from pytorch_fob.optimizers import Optimizer
 
@@ -26,6 +26,49 @@ class GroupedFTTransformer(GroupedModel):
         )
 
 
+class RegressionMetrics():
+    """
+    Accumulates the number of samples, the sums of the targets and their squares and the sum of squared errors
+    batch by batch on the device, which is all that is needed for the RMSE and the R2 score of all samples.
+    """
+    def __init__(self) -> None:
+        self.sums = torch.zeros(4, dtype=torch.float64)
+
+    def update(self, preds: torch.Tensor, targets: torch.Tensor):
+        if self.sums.device != preds.device:
+            self.sums = self.sums.to(preds.device)
+        preds = preds.detach().double()
+        targets = targets.detach().double()
+        self.sums += torch.stack([
+            targets.new_full((), targets.numel()),
+            targets.sum(),
+            targets.square().sum(),
+            (preds - targets).square().sum()
+        ])
+
+    def compute(self, sums: torch.Tensor) -> dict[str, float]:
+        """
+        rmse and r2 score like `sklearn.metrics.root_mean_squared_error` and `sklearn.metrics.r2_score`,
+        NaN without any samples
+        """
+        n, sum_targets, sum_squares, squared_error = sums.tolist()
+        if n == 0:
+            return {"rmse": float("nan"), "r2_score": float("nan")}
+        total = sum_squares - sum_targets**2 / n
+        if total > 0:
+            r2 = 1.0 - squared_error / total
+        else:
+            # constant targets, like `force_finite` of sklearn
+            r2 = 1.0 if squared_error == 0 else 0.0
+        return {
+            "rmse": (squared_error / n)**0.5,
+            "r2_score": r2
+        }
+
+    def reset(self):
+        self.sums.zero_()
+
+
 class TabularModel(TaskModel):
     """
     Lightning Module for tabular data task.
@@ -48,6 +91,9 @@ class TabularModel(TaskModel):
         )
         super().__init__(GroupedFTTransformer(model), optimizer, config)
         self.loss_fn = torch.nn.MSELoss()
+        self.train_metrics: bool = config.get("train_metrics", False)
+        # validation runs during the training epoch, so it needs its own accumulator
+        self.metrics = {"train": RegressionMetrics(), "eval": RegressionMetrics()}
 
     def forward(self, x):
         return self.model(x_cont=x, x_cat=None).squeeze(-1)
@@ -56,33 +102,56 @@ class TabularModel(TaskModel):
         features, labels = batch
         preds = self.forward(features)
         loss = self.compute_and_log_loss(preds, labels, "train_loss")
-        self.compute_and_log_metrics(preds, labels, stage="train")
+        if self.train_metrics:
+            self.metrics["train"].update(preds, labels)
         return loss
 
     def validation_step(self, batch, batch_idx):
         features, labels = batch
         preds = self.forward(features)
         self.compute_and_log_loss(preds, labels, "val_loss")
-        self.compute_and_log_metrics(preds, labels, stage="val")
+        self.metrics["eval"].update(preds, labels)
 
     def test_step(self, batch, batch_idx):
         features, labels = batch
         preds = self.forward(features)
         self.compute_and_log_loss(preds, labels, "test_loss")
-        self.compute_and_log_metrics(preds, labels, stage="test")
+        self.metrics["eval"].update(preds, labels)
 
     def compute_and_log_loss(self, preds: torch.Tensor, targets: torch.Tensor, log_label: str) -> torch.Tensor:
         loss = self.loss_fn(preds, targets)
         self.log(log_label, loss)
         return loss
 
-    def compute_and_log_metrics(self, preds: torch.Tensor, targets: torch.Tensor, stage: str):
-        preds = preds.detach().cpu().float().numpy()
-        targets = targets.detach().cpu().float().numpy()
-        metrics = {
-            "rmse": root_mean_squared_error(targets, preds),
-            "r2_score": r2_score(targets, preds)
-        }
+    def compute_and_log_metrics(self, metric: RegressionMetrics, stage: str) -> dict[str, float]:
+        """metrics of all samples of the epoch, summed over all processes"""
+        sums = self.trainer.strategy.reduce(metric.sums.to(self.device), reduce_op="sum")
+        metrics = metric.compute(sums)
+        if sums[0] == 0:
+            # e.g. no batches in this epoch, the same on all processes
+            log_warn(f"No samples to compute the {stage} metrics, skipping them.")
+            metric.reset()
+            return metrics
         for k, v in metrics.items():
-            self.log(f"{stage}_{k}", v) # type: ignore
+            self.log(f"{stage}_{k}", v, sync_dist=True)
+        metric.reset()
         return metrics
+
+    def on_train_epoch_start(self) -> None:
+        self.metrics["train"].reset()
+
+    def on_train_epoch_end(self) -> None:
+        if self.train_metrics:
+            self.compute_and_log_metrics(self.metrics["train"], "train")
+
+    def on_validation_start(self) -> None:
+        self.metrics["eval"].reset()
+
+    def on_validation_epoch_end(self) -> None:
+        self.compute_and_log_metrics(self.metrics["eval"], "val")
+
+    def on_test_start(self) -> None:
+        self.metrics["eval"].reset()
+
+    def on_test_epoch_end(self) -> None:
+        self.compute_and_log_metrics(self.metrics["eval"], "test")
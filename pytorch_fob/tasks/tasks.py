@@ -1,10 +1,13 @@
 import importlib
-from typing import Any
+from typing import Any, Iterator, Optional, Sequence
 from pathlib import Path
+import numpy as np
+import torch
 from lightning import LightningModule, LightningDataModule
 from lightning.pytorch.utilities.types import OptimizerLRScheduler
-from torch import nn
-from torch.utils.data import DataLoader
+from torch import nn, Tensor
+from torch.utils.data import BatchSampler, DataLoader, Dataset, DistributedSampler, Sampler, TensorDataset, \
+    default_collate
 from pytorch_fob.optimizers import Optimizer
 from pytorch_fob.engine.configs import TaskConfig
 from pytorch_fob.engine.parameter_groups import GroupedModel
@@ -23,6 +26,175 @@ def task_names() -> list[str]:
     return [d.name for d in Path(__file__).parent.iterdir() if d.is_dir() and d.name not in EXCLUDE]
 
 
+def dataset_tensors(data: Dataset) -> tuple[Tensor, ...]:
+    """
+    Returns all samples of a map-style dataset as a tuple of stacked tensors.
+    Datasets which already keep their data as tensors can provide them with a `tensors` attribute.
+    """
+    tensors = getattr(data, "tensors", None)
+    if tensors is not None:
+        return tuple(tensors)
+    return tuple(default_collate([data[i] for i in range(len(data))]))  # type: ignore
+
+
+class TensorBatchLoader():
+    """
+    Dataloader for datasets which fit into (device) memory.
+    Keeps the data as contiguous tensors, shuffles them with one permutation per epoch
+    and yields batches by slicing, without worker processes or per sample collation.
+    With `world_size > 1` each rank gets its own part of the data like with a `DistributedSampler`.
+    """
+    def __init__(
+            self,
+            tensors: Sequence[Tensor],
+            batch_size: int,
+            shuffle: bool = False,
+            drop_last: bool = False,
+            seed: int = 0,
+            rank: int = 0,
+            world_size: int = 1
+            ) -> None:
+        assert all(len(t) == len(tensors[0]) for t in tensors), "all tensors need the same number of samples"
+        self.tensors = tuple(tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def _num_samples(self) -> int:
+        return -(-len(self.tensors[0]) // self.world_size)
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self._num_samples() // self.batch_size
+        return -(-self._num_samples() // self.batch_size)
+
+    def _indices(self) -> Optional[Tensor]:
+        n = len(self.tensors[0])
+        if not self.shuffle and self.world_size == 1:
+            return None
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(n, generator=generator)
+        else:
+            indices = torch.arange(n)
+        if self.world_size > 1:
+            padding = self._num_samples() * self.world_size - n
+            indices = torch.cat([indices, indices[:padding]])[self.rank::self.world_size]
+        return indices
+
+    def __iter__(self) -> Iterator[tuple[Tensor, ...]]:
+        indices = self._indices()
+        self.epoch += 1
+        if indices is None:
+            tensors = self.tensors
+        else:
+            tensors = tuple(t[indices.to(t.device)] for t in self.tensors)
+        for i in range(len(self)):
+            yield tuple(t[i * self.batch_size:(i + 1) * self.batch_size] for t in tensors)
+
+
+class EpochBatchSampler(BatchSampler):
+    """
+    Batch sampler which packs all batches of an epoch at once with `_pack`,
+    e.g. batches of a varying number of samples up to some budget.
+
+    Lightning reads the number of batches only once, so every epoch has as many batches as the first one:
+    the samples of the least filled batches are moved to batches with room left (the budget is only exceeded
+    if there is none) and the batches with the most samples are split in half.
+
+    The sampler builds the same batches on every rank; if Lightning injects a `DistributedSampler`,
+    each rank takes every `num_replicas`-th batch so that all ranks do the same number of steps.
+    """
+    def __init__(self, sampler: Sampler | Sequence[int], drop_last: bool = False) -> None:
+        # no call to super().__init__, the batch size is not fixed
+        self.sampler = sampler
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._cache: tuple[int, list[list[int]]] = (-1, [])
+        self._num_batches: Optional[int] = None
+
+    def __iter__(self) -> Iterator[list[int]]:
+        # the epoch is chosen when the iteration starts, Lightning stops after `len(self)` batches
+        # without exhausting the iterator, so code after the last batch might never run
+        epoch = self._current_epoch()
+        if not isinstance(self.sampler, DistributedSampler):
+            self.epoch += 1
+        yield from self._batches(epoch)
+
+    def __len__(self) -> int:
+        return len(self._batches(self._current_epoch()))
+
+    def _current_epoch(self) -> int:
+        if isinstance(self.sampler, DistributedSampler):
+            return self.sampler.epoch  # set by Lightning
+        return self.epoch
+
+    def _batches(self, epoch: int) -> list[list[int]]:
+        if self._cache[0] != epoch:
+            self._cache = (epoch, self._build_batches(epoch))
+        batches = self._cache[1]
+        if isinstance(self.sampler, DistributedSampler):
+            world, rank = self.sampler.num_replicas, self.sampler.rank
+            if self.drop_last:
+                batches = batches[:len(batches) - len(batches) % world]
+            elif len(batches) % world != 0:
+                batches = batches + batches[:world - len(batches) % world]
+            batches = batches[rank::world]
+        return batches
+
+    def _build_batches(self, epoch: int) -> list[list[int]]:
+        if self._num_batches is None:
+            self._num_batches = len(self._pack(0))
+        return self._fix_num_batches(self._pack(epoch), self._num_batches)
+
+    def _fix_num_batches(self, batches: list[list[int]], num_batches: int) -> list[list[int]]:
+        batches = [list(batch) for batch in batches]
+        if len(batches) > num_batches:
+            stats = np.array([self._batch_stats(batch) for batch in batches], dtype=np.float64)
+        while len(batches) > num_batches:
+            loads = self._batch_loads(stats)
+            emptied = int(np.argmin(loads))
+            loads[emptied] = np.inf
+            for sample in batches[emptied]:
+                added = self._add_sample(stats, sample)
+                fits = np.flatnonzero((self._batch_loads(added) <= 1.0) & (loads < np.inf))
+                # the first batch with room, or the least filled one
+                k = int(fits[0]) if len(fits) > 0 else int(np.argmin(loads))
+                batches[k].append(sample)
+                stats[k] = added[k]
+                loads[k] = self._batch_loads(stats[k:k + 1])[0]
+            batches.pop(emptied)
+            stats = np.delete(stats, emptied, axis=0)
+        while len(batches) < num_batches:
+            i = max(range(len(batches)), key=lambda k: len(batches[k]))
+            if len(batches[i]) < 2:
+                break
+            half = len(batches[i]) // 2
+            batches[i:i + 1] = [batches[i][:half], batches[i][half:]]
+        return batches
+
+    def _pack(self, epoch: int) -> list[list[int]]:
+        """all batches of `epoch` (as lists of sample indices) within the budget, the same on every rank"""
+        raise NotImplementedError
+
+    def _batch_stats(self, batch: list[int]) -> Sequence[float]:
+        """the quantities of `batch` the budget depends on"""
+        raise NotImplementedError
+
+    def _add_sample(self, stats: np.ndarray, sample: int) -> np.ndarray:
+        """the stats (one row per batch) with `sample` added to every batch"""
+        raise NotImplementedError
+
+    def _batch_loads(self, stats: np.ndarray) -> np.ndarray:
+        """the used fraction of the budget of each batch (one row of stats per batch), above 1 if exceeded"""
+        raise NotImplementedError
+
+
 class TaskModel(LightningModule):
     def __init__(
             self,
@@ -55,6 +227,32 @@ class TaskDataModule(LightningDataModule):
         self.data_test: Any
         self.data_predict: Any
         self.collate_fn = None
+        self.tensor_loader: Optional[str] = config.get("tensor_loader", None)
+        if self.tensor_loader not in [None, "cpu", "device"]:
+            raise ValueError(f"unknown tensor_loader '{self.tensor_loader}', use one of null, cpu or device")
+        self.synthetic: bool = config.get("synthetic", False)
+
+    def synthetic_dataset(self, split: str) -> Dataset:
+        """
+        Random samples with the shapes and sizes of the real `split` ('train', 'validation' or 'test'),
+        used instead of the dataset with `task.synthetic: true`.
+        """
+        raise NotImplementedError(f"task '{self.config.name}' does not support synthetic data")
+
+    def setup_synthetic(self, stage: str):
+        """`setup` with the synthetic datasets, tasks call it instead of loading their data"""
+        if stage == "fit":
+            self.data_train = self.synthetic_dataset("train")
+            self.data_val = self.synthetic_dataset("validation")
+
+        if stage == "validate":
+            self.data_val = self.synthetic_dataset("validation")
+
+        if stage == "test":
+            self.data_test = self.synthetic_dataset("test")
+
+        if stage == "predict":
+            self.data_predict = self.synthetic_dataset("test")
 
     def check_dataset(self, data):
         """Make sure that all tasks have correctly configured their data sets"""
@@ -64,39 +262,42 @@ class TaskDataModule(LightningDataModule):
             raise NotImplementedError("Each task configures its own batch_size. \
                                       Please set it explicitely, to avoid confusion.")
 
-    def train_dataloader(self):
-        self.check_dataset(self.data_train)
+    def _dataloader(self, data, shuffle: bool = False):
+        self.check_dataset(data)
+        if self.tensor_loader is not None:
+            return self._tensor_batch_loader(data, shuffle)
         return DataLoader(
-            self.data_train,
-            shuffle=True,
+            data,
+            shuffle=shuffle,
             batch_size=self.batch_size,
             num_workers=self.workers,
             collate_fn=self.collate_fn
         )
 
-    def val_dataloader(self):
-        self.check_dataset(self.data_val)
-        return DataLoader(
-            self.data_val,
-            batch_size=self.batch_size,
-            num_workers=self.workers,
-            collate_fn=self.collate_fn
+    def _tensor_batch_loader(self, data, shuffle: bool) -> TensorBatchLoader:
+        tensors = dataset_tensors(data)
+        rank, world_size = 0, 1
+        if self.trainer is not None:
+            rank, world_size = self.trainer.global_rank, self.trainer.world_size
+            if self.tensor_loader == "device":
+                tensors = tuple(t.to(self.trainer.strategy.root_device) for t in tensors)
+        return TensorBatchLoader(
+            tensors,
+            self.batch_size,
+            shuffle=shuffle,
+            seed=torch.initial_seed(),
+            rank=rank,
+            world_size=world_size
         )
 
+    def train_dataloader(self):
+        return self._dataloader(self.data_train, shuffle=True)
+
+    def val_dataloader(self):
+        return self._dataloader(self.data_val)
+
     def test_dataloader(self):
-        self.check_dataset(self.data_test)
-        return DataLoader(
-            self.data_test,
-            batch_size=self.batch_size,
-            num_workers=self.workers,
-            collate_fn=self.collate_fn
-        )
+        return self._dataloader(self.data_test)
 
     def predict_dataloader(self):
-        self.check_dataset(self.data_predict)
-        return DataLoader(
-            self.data_predict,
-            batch_size=self.batch_size,
-            num_workers=self.workers,
-            collate_fn=self.collate_fn
-        )
+        return self._dataloader(self.data_predict)
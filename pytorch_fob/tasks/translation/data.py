@@ -1,16 +1,27 @@
 import json
-from typing import Callable
-from torch.utils.data import DataLoader
+from typing import Callable, Optional
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader, Dataset, SequentialSampler
 from datasets import DatasetDict
 import datasets
 from transformers import T5Tokenizer
-from transformers import DataCollatorForSeq2Seq
+from transformers import BatchEncoding, DataCollatorForSeq2Seq
 
 from pytorch_fob.tasks import TaskDataModule
+from pytorch_fob.tasks.synthetic import SPLIT_SEEDS, sample_generator
 from pytorch_fob.engine.configs import TaskConfig
 from pytorch_fob.engine.utils import log_info
+from pytorch_fob.tasks.translation.token_shards import TokenBudgetBatchSampler, TokenShardDataset, collate_batch, \
+    shards_exist, write_token_shards
 
 MAX_TOKENS_PER_SENTENCE = 128
+# wmt17 de-en, newstest2016 and newstest2017
+SPLIT_SIZES = {"train": 5_906_184, "validation": 2_999, "test": 3_004}
+# the number of t5 tokens of a sentence is roughly log-normal
+MEDIAN_TOKENS_PER_SENTENCE = 28
+SIGMA_TOKENS_PER_SENTENCE = 0.6
 
 def generate_collate_fn_train(tokenizer, src_language: str, tgt_language: str) -> Callable:
     collator = DataCollatorForSeq2Seq(tokenizer=tokenizer,
@@ -26,17 +37,95 @@ def generate_collate_fn_train(tokenizer, src_language: str, tgt_language: str) -
         return collator(res)
     return collate
 
-def generate_collate_fn_validtest(src_language: str, tgt_language: str) -> Callable:
-    def collate(batch) -> tuple[list[str], list[str]]:
-        src_text = []
-        tgt_text = []
-        for sample in batch:
-            src_text += [sample["translation"][src_language]]
-            tgt_text += [sample["translation"][tgt_language]]
-        return src_text, tgt_text
+def generate_collate_fn_validtest(tokenizer, src_language: str, tgt_language: str) -> Callable:
+    collate_tokens = generate_collate_fn_train(tokenizer, src_language, tgt_language)
+    def collate(batch) -> tuple[BatchEncoding, list[str]]:
+        tgt_text = [sample["translation"][tgt_language] for sample in batch]
+        return collate_tokens(batch), tgt_text
     return collate
 
 
+class SyntheticTokenizer():
+    """
+    Stands in for the t5 tokenizer with synthetic data, which has no text:
+    the vocabulary size and special tokens of t5-small, a sentence is decoded to the text of its token ids.
+    """
+    pad_token_id = 0
+    eos_token_id = 1
+    unk_token_id = 2
+    vocab_size = 32100
+
+    def __len__(self) -> int:
+        return self.vocab_size
+
+    def decode(self, token_ids, skip_special_tokens: bool = False) -> str:
+        special = {self.pad_token_id, self.eos_token_id} if skip_special_tokens else set()
+        if isinstance(token_ids, torch.Tensor):
+            token_ids = token_ids.tolist()
+        return " ".join(str(t) for t in token_ids if t not in special)
+
+    def batch_decode(self, sequences, skip_special_tokens: bool = False) -> list[str]:
+        return [self.decode(s, skip_special_tokens=skip_special_tokens) for s in sequences]
+
+
+class SyntheticTranslationDataset(Dataset):
+    """
+    Random sentence pairs with the number of samples and (log-normal) sentence lengths of wmt17,
+    fetched as whole padded batches like `TokenShardDataset`.
+    The lengths are drawn up front, the token ids of a sample only when it is fetched.
+    With `with_text` a batch also contains the target sentences as text, see `SyntheticTokenizer`.
+    """
+    def __init__(self, length: int, split: str, tokenizer: SyntheticTokenizer, with_text: bool = False) -> None:
+        super().__init__()
+        self.seed = SPLIT_SEEDS[split]
+        self.tokenizer = tokenizer
+        self.with_text = with_text
+        rng = np.random.default_rng(self.seed)
+        src_lengths = rng.lognormal(np.log(MEDIAN_TOKENS_PER_SENTENCE), SIGMA_TOKENS_PER_SENTENCE, length)
+        tgt_lengths = src_lengths * rng.lognormal(0.0, 0.2, length)
+        self.src_lengths = np.clip(np.rint(src_lengths), 2, MAX_TOKENS_PER_SENTENCE).astype(np.int16)
+        self.tgt_lengths = np.clip(np.rint(tgt_lengths), 2, MAX_TOKENS_PER_SENTENCE).astype(np.int16)
+
+    def __len__(self) -> int:
+        return len(self.src_lengths)
+
+    def _sentence_pair(self, index: int) -> tuple[torch.Tensor, torch.Tensor]:
+        src_len, tgt_len = int(self.src_lengths[index]), int(self.tgt_lengths[index])
+        tokens = torch.randint(self.tokenizer.unk_token_id + 1, len(self.tokenizer), (src_len + tgt_len,),
+                               generator=sample_generator(self.seed, index))
+        tokens[src_len - 1] = self.tokenizer.eos_token_id
+        tokens[-1] = self.tokenizer.eos_token_id
+        return tokens[:src_len], tokens[src_len:]
+
+    def __getitem__(self, index: int):
+        return self.__getitems__([index])
+
+    def __getitems__(self, indices: list[int]):
+        pairs = [self._sentence_pair(i) for i in indices]
+        src = [s for s, _ in pairs]
+        tgt = [t for _, t in pairs]
+        pad = self.tokenizer.pad_token_id
+        lengths = torch.tensor([len(s) for s in src])
+        tokens = BatchEncoding({
+            "input_ids": pad_sequence(src, batch_first=True, padding_value=pad),
+            "attention_mask": (torch.arange(int(lengths.max()))[None, :] < lengths[:, None]).long(),
+            "labels": pad_sequence(tgt, batch_first=True, padding_value=pad)
+        })
+        if not self.with_text:
+            return tokens
+        return tokens, self.tokenizer.batch_decode(tgt, skip_special_tokens=True)
+
+    def lengths(self) -> np.ndarray:
+        """number of tokens per sample, the longer of source and target"""
+        return np.maximum(self.src_lengths, self.tgt_lengths)
+
+
+def sort_by_length(ds: datasets.Dataset, column: str) -> datasets.Dataset:
+    """sorting by length reduces the padding in each batch, the order of evaluation samples does not matter"""
+    lengths = np.array([len(tokens) for tokens in ds[column]])
+    return ds.select(np.argsort(lengths, kind="stable"))
+
+
 class WMTDataModule(TaskDataModule):
     def __init__(self, config: TaskConfig):
         super().__init__(config)
@@ -45,11 +134,21 @@ class WMTDataModule(TaskDataModule):
             raise ValueError("translation direction needs to be de-en or en-de!")
         self.source_language: str = self.translation_direction.split("-")[0]
         self.target_language: str = self.translation_direction.split("-")[1]
-        self.collate_fn_validtest = generate_collate_fn_validtest(self.source_language, self.target_language)
         self.processed_data_dir = self.data_dir / "processed"
         self.cache_dir = self.data_dir / "cache"
         self.prepare_workers = max(1, min(self.workers, 5))
         self.info_file = self.processed_data_dir / "info.json"
+        self.token_shards: bool = config.get("token_shards", False)
+        self.max_tokens_per_batch: Optional[int] = config.get("max_tokens_per_batch", None)
+        self.shard_dir = self.processed_data_dir / "token_shards"
+        if self.max_tokens_per_batch is not None and not (self.token_shards or self.synthetic):
+            raise ValueError("max_tokens_per_batch requires token_shards to be enabled!")
+        if self.synthetic:
+            # batches are padded by the synthetic dataset, nothing needs to be downloaded
+            self.train_data_len = SPLIT_SIZES["train"]
+            self.tokenizer = SyntheticTokenizer()
+            self.collate_fn_validtest = collate_batch
+            return
         if self.info_file.exists():
             with open(self.info_file, "r", encoding="utf8") as f:
                 info = json.load(f)
@@ -57,6 +156,9 @@ class WMTDataModule(TaskDataModule):
         else:
             self.train_data_len = 0
         self.tokenizer = T5Tokenizer.from_pretrained("google-t5/t5-small", cache_dir=str(self.cache_dir))
+        self.collate_fn_validtest = generate_collate_fn_validtest(self.tokenizer,
+                                                                  self.source_language,
+                                                                  self.target_language)
 
     def _get_dataset(self) -> DatasetDict:
         ds = datasets.load_dataset("wmt17",
@@ -70,9 +172,13 @@ class WMTDataModule(TaskDataModule):
     def prepare_data(self):
         # download, IO, etc. Useful with shared filesystems
         # only called on 1 GPU/TPU in distributed
+        if self.synthetic:
+            return
         self.data_dir.mkdir(exist_ok=True)
         if self.info_file.exists():
             log_info("wmt already preprocessed")
+            if self.token_shards and not shards_exist(self.shard_dir):
+                self._write_token_shards(datasets.load_from_disk(str(self.processed_data_dir)))  # type: ignore
             return
         ds = self._get_dataset()
         log_info("tokenizing data...")
@@ -94,11 +200,21 @@ class WMTDataModule(TaskDataModule):
                        "train_data_len": len(ds["train"]),
                        "val_data_len": len(ds["validation"]),
                        "test_data_len": len(ds["test"])}, f, indent=4)
+        if self.token_shards:
+            self._write_token_shards(ds)
         log_info("wmt preprocessed")
 
+    def _write_token_shards(self, ds: DatasetDict):
+        log_info("writing token shards...")
+        write_token_shards(ds, self.shard_dir, ["de", "en"], len(self.tokenizer))
+
     def setup(self, stage):
         """setup is called from every process across all the nodes. Setting state here is recommended.
         """
+        if self.synthetic:
+            self.collate_fn = collate_batch
+            self.setup_synthetic(stage)
+            return
         ds = datasets.load_from_disk(str(self.processed_data_dir))
 
         data_collator = generate_collate_fn_train(self.tokenizer,
@@ -109,20 +225,44 @@ class WMTDataModule(TaskDataModule):
 
         # Assign train/val datasets for use in dataloaders
         if stage == "fit":
-            self.data_train = ds["train"]  # .select(range(200))
-            self.data_val = ds["validation"]
+            if self.token_shards:
+                self.data_train = TokenShardDataset(self.shard_dir, "train",
+                                                    self.source_language,
+                                                    self.target_language,
+                                                    self.tokenizer.pad_token_id)
+                self.collate_fn = collate_batch
+            else:
+                self.data_train = ds["train"]  # .select(range(200))
+            self.data_val = sort_by_length(ds["validation"], self.source_language)
 
         if stage == "validate":
-            self.data_val = ds["validation"]
+            self.data_val = sort_by_length(ds["validation"], self.source_language)
 
         # Assign test dataset for use in dataloader(s)
         if stage == "test":
-            self.data_test = ds["test"]
+            self.data_test = sort_by_length(ds["test"], self.source_language)
 
         if stage == "predict":
-            self.data_predict = ds["test"]
+            self.data_predict = sort_by_length(ds["test"], self.source_language)
+
+    def synthetic_dataset(self, split: str):
+        return SyntheticTranslationDataset(SPLIT_SIZES[split], split, self.tokenizer, with_text=split != "train")
+
     def train_dataloader(self):
         self.check_dataset(self.data_train)
+        if self.max_tokens_per_batch is not None:
+            # lightning replaces the sampler with a DistributedSampler in ddp, the batches are built by the batch sampler
+            batch_sampler = TokenBudgetBatchSampler(SequentialSampler(self.data_train),
+                                                    self.data_train.lengths(),  # type: ignore
+                                                    self.max_tokens_per_batch,
+                                                    shuffle=True,
+                                                    seed=torch.initial_seed())
+            return DataLoader(
+                self.data_train,
+                batch_sampler=batch_sampler,
+                num_workers=self.workers,
+                collate_fn=self.collate_fn
+            )
         return DataLoader(
             self.data_train,
             shuffle=True,
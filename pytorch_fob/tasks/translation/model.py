@@ -1,4 +1,5 @@
 import sys
+import torch
 from torch.nn import Module
 from transformers import AutoModelForSeq2SeqLM, T5Config
 from sacrebleu.metrics import BLEU
@@ -20,28 +21,66 @@ class GroupedTransformer(GroupedModel):
 
     def generate(self, inputs: list[str], tokenizer, device, num_beams=None, length_penalty=None) -> list[str]:
         token_inputs = tokenizer(inputs, return_tensors="pt", padding=True).to(device)
+        return self.generate_from_tokens(token_inputs["input_ids"], token_inputs["attention_mask"], tokenizer,
+                                         num_beams=num_beams, length_penalty=length_penalty)
+
+    def generate_from_tokens(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, tokenizer,
+                             num_beams=None, length_penalty=None) -> list[str]:
         num_beams = some(num_beams, default=self.num_beams)
         length_penalty = some(length_penalty, default=self.length_penalty)
-        output = self.model.generate(input_ids=token_inputs["input_ids"],
-                                     attention_mask=token_inputs["attention_mask"],
+        output = self.model.generate(input_ids=input_ids,
+                                     attention_mask=attention_mask,
                                      do_sample=False,
+                                     use_cache=True,
                                      max_length=MAX_TOKENS_PER_SENTENCE - 2,
                                      num_beams=num_beams,
                                      length_penalty=length_penalty)
         return tokenizer.batch_decode(output, skip_special_tokens=True)
 
 
+class CorpusBLEU():
+    """
+    Accumulates the sufficient statistics of corpus BLEU (hypothesis and reference length,
+    matching and total n-grams) batch by batch, so no decoded sentences need to be kept.
+    """
+    def __init__(self) -> None:
+        self.bleu = BLEU()
+        self.stats = torch.zeros(2 + 2 * self.bleu.max_ngram_order, dtype=torch.long)
+
+    def update(self, preds: list[str], target: list[str]):
+        assert len(preds) == len(target)
+        if len(preds) == 0:
+            return
+        stats = self.bleu._extract_corpus_statistics(  # pylint: disable=protected-access
+            [p.strip() for p in preds], [[t.strip() for t in target]]
+        )
+        self.stats += torch.tensor(stats, dtype=torch.long).sum(dim=0)
+
+    def compute(self, stats: torch.Tensor) -> float:
+        try:
+            result: BLEUScore = self.bleu._compute_score_from_stats(stats.tolist())  # pylint: disable=protected-access
+            return result.score
+        except ZeroDivisionError:
+            log_warn("Error: Bleu Score computing resulted in a ZeroDivisionError", file=sys.stderr)
+            return 0.0
+
+    def reset(self):
+        self.stats.zero_()
+
+
 class WMTModel(TaskModel):
     def __init__(self, optimizer: Optimizer, data_module: WMTDataModule, config: TaskConfig):
         self.batch_size = data_module.batch_size
         self.train_data_len = data_module.train_data_len
         self.tokenizer = data_module.tokenizer
-        self.bleu = BLEU()
-        self.metric_cache_pred: list[str] = []
-        self.metric_cache_trues: list[str] = []
+        self.bleu = CorpusBLEU()
         if self.tokenizer is None:
             raise Exception("prepare dataset before running the model!")
-        model_config = T5Config.from_pretrained("google-t5/t5-small", cache_dir=str(data_module.cache_dir))
+        if data_module.synthetic:
+            # the defaults are the architecture of t5-small
+            model_config = T5Config(decoder_start_token_id=data_module.tokenizer.pad_token_id)
+        else:
+            model_config = T5Config.from_pretrained("google-t5/t5-small", cache_dir=str(data_module.cache_dir))
         model = AutoModelForSeq2SeqLM.from_config(model_config)
         model = GroupedTransformer(model, config.model.num_beams, config.model.length_penalty)
         super().__init__(model, optimizer, config)
@@ -49,41 +88,31 @@ class WMTModel(TaskModel):
     def training_step(self, batch, _batch_idx):
         return self.compute_and_log_loss(batch, "train_loss")
 
-    def compute_bleu(self, preds: list[str], target: list[str]) -> float:
-        assert len(preds) == len(target)
-        try:
-            result : BLEUScore = self.bleu.corpus_score(hypotheses=[p.strip() for p in preds],
-                                                        references=[[t.strip() for t in target]])
-            return result.score
-        except ZeroDivisionError:
-            log_warn("Error: Bleu Score computing resulted in a ZeroDivisionError", file=sys.stderr)
-            return 0.0
+    def compute_bleu(self) -> float:
+        """corpus BLEU over all processes"""
+        stats = self.trainer.strategy.reduce(self.bleu.stats.to(self.device), reduce_op="sum")
+        return self.bleu.compute(stats.cpu())
 
     def validation_step(self, batch, _batch_idx):
-        src, tgt = batch
-        batch = self.tokenizer(src, text_target=tgt, padding=True, return_tensors="pt").to(self.device)
-        self.compute_and_log_loss(batch, "val_loss")
-        self.metric_cache_trues += tgt
-        self.metric_cache_pred += self.model.generate(src, self.tokenizer, self.device, num_beams=1, length_penalty=1.0)
+        tokens, tgt = batch
+        self.compute_and_log_loss(tokens, "val_loss")
+        self.bleu.update(self.model.generate_from_tokens(tokens.input_ids, tokens.attention_mask, self.tokenizer,
+                                                         num_beams=1, length_penalty=1.0), tgt)
 
     def test_step(self, batch, _batch_idx):
-        src, tgt = batch
-        batch = self.tokenizer(src, text_target=tgt, padding=True, return_tensors="pt").to(self.device)
-        self.compute_and_log_loss(batch, "test_loss")
-        self.metric_cache_trues += tgt
-        self.metric_cache_pred += self.model.generate(src, self.tokenizer, self.device)
+        tokens, tgt = batch
+        self.compute_and_log_loss(tokens, "test_loss")
+        self.bleu.update(self.model.generate_from_tokens(tokens.input_ids, tokens.attention_mask, self.tokenizer), tgt)
 
     def on_validation_epoch_end(self):
-        bleu = self.compute_bleu(self.metric_cache_pred, self.metric_cache_trues)
+        bleu = self.compute_bleu()
         self.log("val_bleu", bleu, batch_size=self.batch_size, sync_dist=True)
-        self.metric_cache_trues.clear()
-        self.metric_cache_pred.clear()
+        self.bleu.reset()
 
     def on_test_epoch_end(self) -> None:
-        bleu = self.compute_bleu(self.metric_cache_pred, self.metric_cache_trues)
+        bleu = self.compute_bleu()
         self.log("test_bleu", bleu, batch_size=self.batch_size, sync_dist=True)
-        self.metric_cache_trues.clear()
-        self.metric_cache_pred.clear()
+        self.bleu.reset()
 
     def compute_and_log_loss(self, batch, log_name: str):
         labels = batch.labels
@@ -0,0 +1,185 @@
+import json
+from itertools import chain
+from pathlib import Path
+from typing import Any, Optional, Sequence
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+from datasets import DatasetDict
+from transformers import BatchEncoding
+from pytorch_fob.engine.utils import log_info
+from pytorch_fob.tasks import EpochBatchSampler
+
+
+SHARD_INFO_FILE = "info.json"
+
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    return np.dtype(np.int16 if vocab_size <= np.iinfo(np.int16).max + 1 else np.int32)
+
+
+def shards_exist(shard_dir: Path) -> bool:
+    return (shard_dir / SHARD_INFO_FILE).is_file()
+
+
+def write_token_shards(ds: DatasetDict, shard_dir: Path, languages: Sequence[str], vocab_size: int):
+    """
+    Writes the token ids of each split and language into one flat binary file `<split>.<language>.bin`
+    and the start offset of each sentence into `<split>.<language>.offsets.npy`.
+    The info file is written last and marks the shards as complete.
+    """
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    dtype = token_dtype(vocab_size)
+    info: dict[str, Any] = {"dtype": dtype.name, "vocab_size": vocab_size, "splits": {}}
+    for split in ds.keys():
+        for language in languages:
+            log_info(f"writing token shard for {split} ({language})...")
+            lengths = []
+            with open(shard_dir / f"{split}.{language}.bin", "wb") as f:
+                for batch in ds[split].select_columns([language]).iter(batch_size=10_000):
+                    sentences = batch[language]
+                    batch_lengths = [len(s) for s in sentences]
+                    tokens = np.fromiter(chain.from_iterable(sentences), dtype=dtype, count=sum(batch_lengths))
+                    f.write(tokens.tobytes())
+                    lengths += batch_lengths
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            np.save(shard_dir / f"{split}.{language}.offsets.npy", offsets)
+        info["splits"][split] = {"num_samples": len(ds[split])}
+    with open(shard_dir / SHARD_INFO_FILE, "w", encoding="utf8") as f:
+        json.dump(info, f, indent=4)
+
+
+class TokenShard():
+    """Memory-mapped token ids of one split and language."""
+    def __init__(self, shard_dir: Path, split: str, language: str) -> None:
+        with open(shard_dir / SHARD_INFO_FILE, "r", encoding="utf8") as f:
+            self.dtype = np.dtype(json.load(f)["dtype"])
+        self.tokens_file = shard_dir / f"{split}.{language}.bin"
+        self.offsets = np.load(shard_dir / f"{split}.{language}.offsets.npy")
+        self._tokens: Optional[np.memmap] = None
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getstate__(self) -> dict[str, Any]:
+        # each dataloader worker opens its own memory map
+        return self.__dict__ | {"_tokens": None}
+
+    @property
+    def tokens(self) -> np.memmap:
+        if self._tokens is None:
+            self._tokens = np.memmap(self.tokens_file, dtype=self.dtype, mode="r")
+        return self._tokens
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def padded(self, indices: np.ndarray, pad_token_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the token ids of the sentences at `indices` right padded to the longest one,
+        together with the attention mask.
+        """
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        positions = np.arange(lengths.max(initial=0))
+        mask = positions[None, :] < lengths[:, None]
+        token_positions = np.where(mask, starts[:, None] + positions[None, :], 0)
+        ids = np.where(mask, self.tokens[token_positions], pad_token_id)
+        return ids.astype(np.int64), mask.astype(np.int64)
+
+
+class TokenShardDataset(Dataset):
+    """
+    Translation pairs read from token shards.
+    Fetching a whole batch at once (`__getitems__`) pads it with a few vectorized numpy operations.
+    """
+    def __init__(self, shard_dir: Path, split: str, src_language: str, tgt_language: str, pad_token_id: int) -> None:
+        super().__init__()
+        self.src = TokenShard(shard_dir, split, src_language)
+        self.tgt = TokenShard(shard_dir, split, tgt_language)
+        self.pad_token_id = pad_token_id
+        assert len(self.src) == len(self.tgt), "token shards of source and target language do not match"
+
+    def __len__(self) -> int:
+        return len(self.src)
+
+    def __getitem__(self, index: int) -> BatchEncoding:
+        return self.__getitems__([index])
+
+    def __getitems__(self, indices: list[int]) -> BatchEncoding:
+        idx = np.asarray(indices, dtype=np.int64)
+        input_ids, attention_mask = self.src.padded(idx, self.pad_token_id)
+        labels, _ = self.tgt.padded(idx, self.pad_token_id)
+        return BatchEncoding({
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy(attention_mask),
+            "labels": torch.from_numpy(labels)
+        })
+
+    def lengths(self) -> np.ndarray:
+        """number of tokens per sample, the longer of source and target"""
+        return np.maximum(self.src.lengths(), self.tgt.lengths())
+
+
+def collate_batch(batch: BatchEncoding) -> BatchEncoding:
+    """batches are already padded by `TokenShardDataset.__getitems__`"""
+    return batch
+
+
+class TokenBudgetBatchSampler(EpochBatchSampler):
+    """
+    Groups samples of similar length into batches of up to `max_tokens` (padded) tokens.
+    Samples are sorted by length within buckets of roughly `bucket_batches` batches,
+    then the order of all batches is shuffled.
+    """
+    def __init__(
+            self,
+            sampler: Sampler | Sequence[int],
+            lengths: np.ndarray,
+            max_tokens: int,
+            shuffle: bool = True,
+            seed: int = 0,
+            drop_last: bool = False,
+            bucket_batches: int = 100
+            ) -> None:
+        super().__init__(sampler, drop_last)
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        mean_length = float(lengths.mean()) if len(lengths) > 0 else 1.0
+        self.bucket_size = max(1, int(bucket_batches * max_tokens / max(1.0, mean_length)))
+
+    def _pack(self, epoch: int) -> list[list[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        n = len(self.lengths)
+        order = torch.randperm(n, generator=generator).numpy() if self.shuffle else np.arange(n)
+        batches: list[list[int]] = []
+        for start in range(0, n, self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            bucket_lengths = self.lengths[bucket]
+            first = 0
+            for i, length in enumerate(bucket_lengths):
+                # lengths are sorted, so the current sample is the longest of the batch
+                if i > first and (i - first + 1) * length > self.max_tokens:
+                    batches.append(bucket[first:i].tolist())
+                    first = i
+            if first < len(bucket):
+                batches.append(bucket[first:].tolist())
+        if self.drop_last and len(batches) > 0:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches
+
+    def _batch_stats(self, batch: list[int]) -> Sequence[float]:
+        return len(batch), self.lengths[batch].max()
+
+    def _add_sample(self, stats: np.ndarray, sample: int) -> np.ndarray:
+        return np.stack([stats[:, 0] + 1, np.maximum(stats[:, 1], self.lengths[sample])], axis=1)
+
+    def _batch_loads(self, stats: np.ndarray) -> np.ndarray:
+        return stats[:, 0] * stats[:, 1] / self.max_tokens